@@ -0,0 +1,297 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import asyncio
+import logging
+
+from calabo.grbl import BaseGrbl, ResponseException, \
+    DEFAULT_BOOT_RETRY_INTERVAL
+from calabo.grbl_settings import setting_to_string
+
+
+
+DEFAULT_STATUS_TIMEOUT = 1.0
+
+
+
+LOG = logging.getLogger("calabo.async_grbl")
+
+
+
+class GrblProtocol(asyncio.Protocol):
+    def __init__(self, grbl):
+        self._grbl = grbl
+
+
+    def data_received(self, data):
+        self._grbl._data_received(data)
+
+
+    def connection_lost(self, exc):
+        self._grbl._connection_lost(exc)
+
+
+
+class AsyncGrbl(BaseGrbl):
+    """\
+asyncio Grbl interface object.
+
+Responses are read by an asyncio transport on the serial device's file
+descriptor and dispatched through the response handlers of `BaseGrbl`,
+shared with `Grbl`, so several controllers can share one event loop.
+Commands and streams are serialized per controller; concurrent
+`read_state` calls share a single `?` request.
+
+Use as an asynchronous context manager:
+
+    async with AsyncGrbl(device) as grbl:
+        await grbl.move(x=10)
+"""
+
+    def __init__(self, device):
+        super().__init__(device)
+        self._transport = None
+        self._command_lock = None
+        self._waiter = None
+        self._status_future = None
+
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+
+        self._serial.__enter__()
+        pipe = os.fdopen(os.dup(self._serial._ser.fileno()), "rb", buffering=0)
+        (self._transport, _protocol) = await loop.connect_read_pipe(
+            lambda: GrblProtocol(self), pipe)
+
+        self._command_lock = asyncio.Lock()
+
+        await self.initialize()
+        return self
+
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        self._transport.close()
+        self._serial.__exit__(exception_type, exception_value, traceback)
+
+
+    def __enter__(self):  # pragma: no cover
+        raise TypeError("Use `async with` with AsyncGrbl")
+
+
+    def _data_received(self, data):
+        for line in self._serial.feed(data):
+            if line.startswith("<"):
+                self._status_received(line)
+                continue
+
+            try:
+                self._dispatch(line)
+            except Exception as e:
+                if self._state == "boot":
+                    LOG.debug("Ignoring response before salutation: %s",
+                              repr(line))
+                    continue
+                if self._waiter and not self._waiter.done():
+                    self._waiter.set_exception(e)
+                else:
+                    LOG.error("Unhandled response error: %s", repr(e))
+                continue
+
+            # While streaming, any response may have freed buffer space.
+            if self._state in ("ready", "stream") and \
+               self._waiter and not self._waiter.done():
+                self._waiter.set_result(None)
+
+
+    def _connection_lost(self, exc):
+        LOG.debug("Connection lost %s %s", self._serial._name, repr(exc))
+        for future in (self._waiter, self._status_future):
+            if future and not future.done():
+                future.set_exception(ConnectionError("Serial connection lost"))
+
+
+    def _status_received(self, line):
+        future = self._status_future
+        if not future or future.done():
+            LOG.debug("Unrequested status report %s", repr(line))
+            return
+
+        try:
+            future.set_result(self._parse_state(line))
+        except Exception as e:
+            future.set_exception(e)
+
+
+    async def _command(self, line, state):
+        """\
+Write `line` and wait until Grbl is ready again.
+"""
+        self._waiter = asyncio.get_running_loop().create_future()
+        self._write_command(line, state)
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+
+    async def initialize(self, soft_reset=None):
+        async with self._command_lock:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            deadline = start + self._boot_timeout
+
+            reset = self._reset_device
+            if not reset and soft_reset:
+                reset = self._soft_reset
+
+            while True:
+                self._waiter = loop.create_future()
+                self._set_state("boot")
+                if reset:
+                    reset()
+                timeout = min(
+                    deadline - loop.time(), DEFAULT_BOOT_RETRY_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._waiter, timeout)
+                    break
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        raise ResponseException(
+                            "No salutation received in %.1fs" %
+                            self._boot_timeout)
+                    LOG.debug("No salutation received. Sending soft reset")
+                    reset = self._soft_reset
+                finally:
+                    self._waiter = None
+
+            self._boot_time = loop.time() - start
+            LOG.info("Grbl %s ready in %.3fs", self._version, self._boot_time)
+
+            await self._read_settings()
+
+
+    async def reset(self):
+        self._state = None
+        self._homed = None
+        self._unlocked = None
+        self._settings = {}
+        self._last_response = None
+
+        await self.initialize(soft_reset=True)
+
+
+    async def _read_settings(self):
+        self._settings_read = {}
+        await self._command("$$", "read_settings")
+        self._settings_read_complete()
+
+
+    async def read_state(self, timeout=None):
+        """\
+Return the current Grbl state.
+
+Concurrent callers share the reply to a single `?` request.
+"""
+        if timeout is None:
+            timeout = DEFAULT_STATUS_TIMEOUT
+
+        future = self._status_future
+        if not future or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self._status_future = future
+            self.realtime("status")
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if self._status_future is future:
+                self._status_future = None
+            raise
+
+
+    async def _write_setting(self, key, value):
+        while not self._settable(await self.read_state()):
+            await asyncio.sleep(0.1)
+
+        value_str = setting_to_string(key, value)
+        await self._command("$%d=%s" % (key, value_str), "expect_ok")
+
+
+    async def setting(self, key, value=None):
+        """\
+Get or set a settings option.
+`key` may be a name or integer.
+"""
+        if value is None:
+            return self._setting_value(key)
+
+        (key, _name) = self._setting_key(key, value)
+
+        async with self._command_lock:
+            await self._write_setting(key, value)
+        self._setting_written(key, value)
+
+        return None
+
+
+    async def move(self, x):
+        async with self._command_lock:
+            await self._command("G0 X%f" % x, "expect_ok")
+
+
+    async def mill(self, x):
+        async with self._command_lock:
+            await self._command("G1 X%f" % x, "expect_ok")
+
+
+    async def probe(self, z_to):
+        async with self._command_lock:
+            self._probe = None
+            self._alarm = None
+            await self._command("G38.2 Z%f" % z_to, "expect_probe")
+            return self._probe_result()
+
+
+    async def stream(self, lines, progress=None):
+        """\
+Stream G-code `lines` using Grbl's character-counting protocol, as
+`Grbl.stream`, waiting for responses without blocking the event loop.
+"""
+        async with self._command_lock:
+            loop = asyncio.get_running_loop()
+            progress = self._stream_begin(progress)
+            lines = iter(lines)
+            line = None
+
+            try:
+                while True:
+                    (batch, line) = self._stream_batch(lines, line)
+                    if batch:
+                        self._stream_write(batch)
+
+                    if not self._stream_pending:
+                        break
+
+                    self._waiter = loop.create_future()
+                    try:
+                        await self._waiter
+                    finally:
+                        self._waiter = None
+            finally:
+                self._stream_progress = None
+
+            self._stream_finish()
+
+        return progress
@@ -17,17 +17,36 @@ Calabó
 Command-line CNC router control software.
 """
 
+import os
 import sys
-import time
 import json
+import time
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+from flask import Flask, Response, abort, request, g
+from cheroot.wsgi import Server as WSGIServer
+
+from .grbl import REALTIME_COMMANDS
+from .jog import JogException
+from .machine import Machine, MachineTimeoutException, \
+    MachineBusyException
+from .toolpath import ToolpathException
+from .metrics import Exposition, Histogram, CONTENT_TYPE, HTTP_BUCKETS
+
 
 
-from flask import Flask, abort, request
+DEFAULT_MACHINE = "default"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5000
 
-from .grbl import Grbl
-from .grbl_settings import SETTINGS
+# Each open event stream holds a server thread for as long as it is
+# connected, so the pool allows for several dashboards and requests.
+DEFAULT_SERVER_THREADS = 32
+# Connections accepted and waiting for a free server thread.
+SERVER_QUEUE_SIZE = 64
 
 
 
@@ -46,39 +65,224 @@ def app_calabo():  # pragma: no cover
 
 
 
-@app.route("/settings", methods=["GET"])
-def settings_get():
+def app_machine(machine_id):
+    machine = app_calabo().machine(machine_id)
+    if machine is None:
+        abort(404)
+    return machine
+
+
+
+@app.before_request
+def request_start():
+    g.start = time.monotonic()
+
+
+
+@app.after_request
+def request_end(response):
+    calabo = getattr(app, "calabo", None)
+    start = getattr(g, "start", None)
+    if calabo is not None and start is not None:
+        calabo.observe_request(
+            request.endpoint, request.method, time.monotonic() - start)
+    return response
+
+
+
+@app.errorhandler(MachineTimeoutException)
+def machine_timeout(e):
+    LOG.warning(str(e))
+    return str(e), 504
+
+
+
+@app.errorhandler(MachineBusyException)
+def machine_busy(e):
+    return str(e), 409
+
+
+
+@app.route("/machines", methods=["GET"])
+def machines_get():
     calabo = app_calabo()
+    return json.dumps(calabo.machines())
+
+
+
+@app.route("/settings", methods=["GET"])
+@app.route("/machines/<machine_id>/settings", methods=["GET"])
+def settings_get(machine_id=None):
+    machine = app_machine(machine_id)
     by_name = (request.args.get("by-name") == "true")
     from_device = (request.args.get("from-device") == "true")
-    data = calabo.settings(by_name=by_name, from_device=from_device)
+    data = machine.settings(by_name=by_name, from_device=from_device)
     return json.dumps(data)
 
 
 
 @app.route('/settings', methods=["POST"])
-def settings_post():
-    calabo = app_calabo()
-    calabo.settings(request.json)
+@app.route("/machines/<machine_id>/settings", methods=["POST"])
+def settings_post(machine_id=None):
+    machine = app_machine(machine_id)
+    machine.settings(request.json)
+    return ""
+
+
+
+@app.route("/status", methods=["GET"])
+@app.route("/machines/<machine_id>/status", methods=["GET"])
+def status_get(machine_id=None):
+    machine = app_machine(machine_id)
+    return json.dumps(machine.status())
+
+
+
+@app.route("/realtime/<command>", methods=["POST"])
+@app.route("/machines/<machine_id>/realtime/<command>", methods=["POST"])
+def realtime_post(command, machine_id=None):
+    """\
+Send a realtime command such as `feed-hold`, `cycle-start` or `reset`.
+"""
+    machine = app_machine(machine_id)
+    if command not in REALTIME_COMMANDS:
+        abort(404)
+    machine.realtime(command)
     return ""
 
 
 
+@app.route("/jog", methods=["POST"])
+@app.route("/machines/<machine_id>/jog", methods=["POST"])
+def jog_post(machine_id=None):
+    """\
+Jog at a velocity given as fractions of each axis' maximum rate, eg.
+`{"x": 0.5, "y": -1}`.
+
+Clients repeat the request while input continues. The jog is cancelled
+when the velocity is zero or no request arrives for a status interval.
+"""
+    machine = app_machine(machine_id)
+    try:
+        jog = machine.jog(request.json or {})
+    except JogException as e:
+        return str(e), 400
+    return json.dumps(jog)
+
+
+
+@app.route("/jobs", methods=["POST"])
+@app.route("/machines/<machine_id>/jobs", methods=["POST"])
+def jobs_post(machine_id=None):
+    machine = app_machine(machine_id)
+    job = machine.add_job(request.stream)
+    return json.dumps(job), 201
+
+
+
+@app.route("/estimate", methods=["POST"])
+@app.route("/machines/<machine_id>/estimate", methods=["POST"])
+def estimate_post(machine_id=None):
+    """\
+Estimate the time taken to run the G-code in the request body.
+"""
+    machine = app_machine(machine_id)
+    try:
+        estimate = machine.estimate(request.stream)
+    except ToolpathException as e:
+        return str(e), 400
+    return json.dumps(estimate)
+
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+@app.route("/machines/<machine_id>/jobs/<int:job_id>", methods=["GET"])
+def job_get(job_id, machine_id=None):
+    machine = app_machine(machine_id)
+    job = machine.job(job_id)
+    if job is None:
+        abort(404)
+    return json.dumps(job)
+
+
+
+@app.route("/events", methods=["GET"])
+@app.route("/machines/<machine_id>/events", methods=["GET"])
+def events_get(machine_id=None):
+    """\
+Stream status reports, job progress and alarms as Server-Sent Events.
+"""
+    machine = app_machine(machine_id)
+    return Response(machine.events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+    })
+
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_get():
+    """\
+Return metrics for all machines in Prometheus text format.
+"""
+    calabo = app_calabo()
+    return Response(calabo.metrics(), content_type=CONTENT_TYPE)
+
+
+
 @app.route('/quit', methods=["POST"])
 def quit():
     calabo = app_calabo()
-    calabo._quit_requested = True
-    shutdown = request.environ.get('werkzeug.server.shutdown')
-    shutdown()
+    calabo.quit()
     return ""
 
 
 
 class CalaboServer():
-    def __init__(self, device):
-        self._grbl = Grbl(device)
-        self._thread_flask = None
-        self._quit_requested = None
+    """\
+HTTP server for one or more Grbl devices.
+
+`device` is served as the machine `default`. Further devices may be
+given in `machines`, a dict of devices by machine ID. Routes without a
+`/machines/<id>` prefix use `device`, or the first machine if there is
+no `device`.
+
+HTTP is served on `host` and `port` by Cheroot, a production WSGI
+server, with a pool of `threads` threads. Connections are kept alive
+between requests, and responses without a length, such as event
+streams, are sent chunked.
+
+If `record_dir` is given, each machine's serial traffic is recorded to
+`<machine ID>.rec` in that directory.
+"""
+
+    def __init__(self, device=None, status_interval=None, job_dir=None,
+                 settings_cache=None, machines=None, host=None, port=None,
+                 record_dir=None, threads=None):
+        devices = {}
+        if device is not None:
+            devices[DEFAULT_MACHINE] = device
+        devices.update(machines or {})
+        if not devices:
+            raise ValueError("No devices supplied")
+
+        self._machines = {
+            machine_id: Machine(
+                machine_id, machine_device,
+                status_interval=status_interval,
+                job_dir=job_dir,
+                settings_cache=settings_cache,
+                record=None if record_dir is None else os.path.join(
+                    record_dir, "%s.rec" % machine_id))
+            for (machine_id, machine_device) in devices.items()
+        }
+        self._default = next(iter(self._machines))
+        self._host = host or DEFAULT_HOST
+        self._port = port or DEFAULT_PORT
+        self._threads = threads or DEFAULT_SERVER_THREADS
+        self._server = None
+        self._thread_http = None
+        self._quit = threading.Event()
+        self._http_latency = {}
 
         app.config.update({
             "ENV": "development",
@@ -89,44 +293,155 @@ class CalaboServer():
 
 
     def __enter__(self):
-        self._grbl.__enter__()
+        """\
+Connect to all machines in parallel, so that startup takes as long as
+the slowest device rather than the sum of all of them.
+"""
+        machines = list(self._machines.values())
+        with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+            futures = [executor.submit(m.__enter__) for m in machines]
+
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            for (machine, future) in zip(machines, futures):
+                if not future.exception():
+                    machine.__exit__(None, None, None)
+            raise errors[0]
+
         return self
 
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self._grbl.__exit__(exception_type, exception_value, traceback)
+        self.stop()
+        for machine in self._machines.values():
+            machine.__exit__(exception_type, exception_value, traceback)
+
+
+    def machine(self, machine_id=None):
+        """\
+Return the machine with `machine_id`, the default machine if `None`,
+or `None` if there is no such machine.
+"""
+        if machine_id is None:
+            machine_id = self._default
+        return self._machines.get(machine_id)
+
+
+    def machines(self):
+        return [machine.as_dict() for machine in self._machines.values()]
 
 
     def settings(self, key=None, value=None, by_name=None, from_device=None):
-        if key is None:
-            if from_device:
-                self._grbl._read_settings()
-            settings = self._grbl._settings
-            if by_name:
-                settings = {SETTINGS[k]["name"]: v for k, v in settings.items()}
+        return self.machine().settings(key, value, by_name, from_device)
 
-            return settings
 
-        if isinstance(key, dict):
-            for key, value in key.items():
-                self._grbl.setting(key, value)
-            return None
+    def realtime(self, command):
+        return self.machine().realtime(command)
 
-        if value is None:
-            return self._grbl._settings[key]
 
-        self._grbl.setting(key, value)
-        return None
+    def status(self):
+        return self.machine().status()
 
 
-    def run(self):
-        # Errors in this function are not shown
+    def jog(self, velocity):
+        return self.machine().jog(velocity)
+
+
+    def job_running(self):
+        return self.machine().job_running()
+
+
+    def add_job(self, stream):
+        return self.machine().add_job(stream)
+
+
+    def estimate(self, stream):
+        return self.machine().estimate(stream)
+
+
+    def job(self, job_id):
+        return self.machine().job(job_id)
+
+
+    def events(self, keepalive=None):
+        return self.machine().events(keepalive)
 
-        logging.getLogger("werkzeug").setLevel(logging.WARNING)
-        self._thread_flask = threading.Thread(target=app.run)
-        self._thread_flask.start()
 
-        while True:
-            if self._quit_requested:
-                break
-            time.sleep(0.5)
+    def observe_request(self, endpoint, method, duration):
+        """\
+Record the time taken by an HTTP handler.
+"""
+        key = (endpoint or "none", method)
+        histogram = self._http_latency.get(key)
+        if histogram is None:
+            histogram = self._http_latency.setdefault(
+                key, Histogram(HTTP_BUCKETS))
+        histogram.observe(duration)
+
+
+    def metrics(self):
+        """\
+Return metrics for all machines in Prometheus text format.
+"""
+        exposition = Exposition()
+        for machine in self._machines.values():
+            machine.collect_metrics(exposition)
+        for ((endpoint, method), histogram) in list(
+                self._http_latency.items()):
+            exposition.histogram(
+                "calabo_http_request_seconds",
+                "Time taken by HTTP request handlers.",
+                histogram, {"endpoint": endpoint, "method": method})
+        return exposition.render()
+
+
+    def start(self):
+        """\
+Start serving HTTP requests in a background thread.
+"""
+        self._quit.clear()
+        self._server = WSGIServer(
+            (self._host, self._port), app, numthreads=self._threads,
+            request_queue_size=SERVER_QUEUE_SIZE)
+        self._server.prepare()
+        self._thread_http = threading.Thread(
+            target=self._server.serve, name="calabo-http")
+        self._thread_http.daemon = True
+        self._thread_http.start()
+        LOG.info("Serving on http://%s:%d",
+                 self._host, self._server.bind_addr[1])
+
+
+    def stop(self):
+        """\
+Stop accepting connections and close the server.
+
+Event streams are ended, so that their threads are free to stop, and
+other requests in progress are allowed to finish.
+"""
+        if not self._server:
+            return
+        for machine in self._machines.values():
+            machine.end_events()
+        self._server.stop()
+        self._thread_http.join()
+        self._server = None
+        LOG.info("Server stopped")
+
+
+    def quit(self):
+        """\
+Ask `run` to return. Safe to call from a request handler.
+"""
+        self._quit.set()
+
+
+    def run(self):
+        """\
+Serve HTTP requests until `quit` is called.
+"""
+        self.start()
+        try:
+            self._quit.wait()
+        finally:
+            self.stop()
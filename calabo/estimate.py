@@ -0,0 +1,362 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Job duration estimates.
+
+Moves are split into planner blocks as Grbl splits them, with arcs
+expanded into line segments, and planned with the same trapezoidal
+velocity profiles, junction speeds and look-ahead as Grbl's planner.
+
+Grbl plans each block knowing only the blocks in its buffer, and must
+be able to stop at the end of the last one. Streaming keeps the buffer
+full, so the speed at which a block is entered is limited by stopping
+within the next `PLANNER_BLOCKS` blocks. With that limit the backward
+pass is a minimum over a sliding window of the cumulative stopping
+distance, and the forward pass a running minimum, so both run as array
+operations over a chunk of blocks at a time.
+
+Speeds are planned in squared speed, in which acceleration over a
+distance is a constant sum.
+
+Requires NumPy.
+"""
+
+import math
+import logging
+
+from calabo.grbl_settings import SETTINGS
+from calabo.toolpath import np, arcs, read_moves, require_numpy, COUNT
+
+
+
+# Blocks in Grbl's planner buffer.
+PLANNER_BLOCKS = 15
+
+MAX_RATE_KEYS = (110, 111, 112)
+ACCELERATION_KEYS = (120, 121, 122)
+JUNCTION_DEVIATION_KEY = 11
+ARC_TOLERANCE_KEY = 12
+
+# As Grbl's `MINIMUM_FEED_RATE`, in millimeters per minute.
+MINIMUM_FEED_RATE = 1.0
+
+# Junction angle cosines treated as a reversal or a straight line.
+JUNCTION_COS_LIMIT = 0.999999
+
+
+
+LOG = logging.getLogger("calabo.estimate")
+
+
+
+def setting(settings, key):
+    if key in settings:
+        return settings[key]
+    return SETTINGS[key]["default"]
+
+
+
+def dot(a, b):
+    """\
+Return the dot products of the rows of `a` and `b`.
+"""
+    return np.einsum("ij,ij->i", a, b)
+
+
+
+def limit_by_axis(limits, unit):
+    """\
+Return the largest value along each direction in `unit` that keeps every
+axis within its limit in `limits`, as Grbl's
+`limit_value_by_axis_maximum`.
+"""
+    with np.errstate(divide="ignore"):
+        ratio = limits / np.abs(unit)
+    result = ratio[:, 0].copy()
+    for i in range(1, ratio.shape[1]):
+        np.minimum(result, ratio[:, i], out=result)
+    return result
+
+
+
+class Planner():
+    """\
+Plan blocks added in chunks and total the time taken to run them.
+
+Blocks are given as arrays of their lengths, accelerations, squared
+nominal speeds and squared maximum entry speeds. The last `lookahead`
+blocks are held back until more blocks arrive or `finish` is called,
+as their entry speeds depend on the blocks after them.
+"""
+
+    def __init__(self, lookahead=None):
+        self._window = lookahead or PLANNER_BLOCKS
+        self._blocks = [np.empty(0) for _i in range(4)]
+        # Squared entry speed of the first held block, once fixed.
+        self._entry = math.inf
+        self.seconds = 0.0
+        self.blocks = 0
+
+
+    def add(self, length, acceleration, nominal, entry):
+        self._blocks = [
+            np.concatenate((held, new)) for (held, new) in
+            zip(self._blocks, (length, acceleration, nominal, entry))
+        ]
+        if len(self._blocks[0]) > 2 * self._window:
+            self._plan(final=False)
+
+
+    def finish(self):
+        """\
+Plan the remaining blocks, stopping at the end of the last one, and
+return the total time in seconds.
+"""
+        self._plan(final=True)
+        return self.seconds
+
+
+    def _plan(self, final):
+        (length, acceleration, nominal, entry) = self._blocks
+        window = self._window
+        count = len(length)
+        if not count:
+            return
+
+        # Squared speed gained accelerating over each block, and its
+        # running total before each block.
+        gain = 2 * acceleration * length
+        total = np.concatenate(([0], np.cumsum(gain)))
+
+        # Blocks past the end of the held blocks are only known to be
+        # able to stop, as if their entry speed were zero.
+        reach = np.concatenate((entry + total[:-1], np.full(window, total[-1])))
+        limit = np.concatenate((total, np.full(window, total[-1])))
+
+        # Backward pass: the fastest entry from which every later block in
+        # the window can be reached, and the end of the window stopped at.
+        planned = count + 1 if final else count - window + 1
+        entry_max = limit[window:window + planned].copy()
+        for i in range(window):
+            np.minimum(entry_max, reach[i:i + planned], out=entry_max)
+        entry_max -= total[:planned]
+
+        # Forward pass: no faster than reached accelerating from the
+        # entry to the first block.
+        speed = entry_max - total[:planned]
+        speed[0] = min(speed[0], self._entry)
+        np.minimum.accumulate(speed, out=speed)
+        speed += total[:planned]
+        np.maximum(speed, 0, out=speed)
+        if final:
+            speed[-1] = 0
+
+        done = planned - 1
+        self.seconds += float(np.sum(block_times(
+            length[:done], acceleration[:done], nominal[:done],
+            speed[:-1], speed[1:])))
+        self.blocks += done
+
+        self._entry = speed[-1]
+        self._blocks = [array[done:] for array in self._blocks]
+
+
+
+def block_times(length, acceleration, nominal, entry, exit):
+    """\
+Return the time taken by each block with a trapezoidal velocity profile,
+given squared nominal, entry and exit speeds.
+"""
+    peak = np.minimum(nominal, (2 * acceleration * length + entry + exit) / 2)
+    peak = np.maximum(peak, np.maximum(entry, exit))
+    cruise = length - (2 * peak - entry - exit) / (2 * acceleration)
+    np.maximum(cruise, 0, out=cruise)
+    peak_speed = np.sqrt(peak)
+    return (
+        (2 * peak_speed - np.sqrt(entry) - np.sqrt(exit)) / acceleration +
+        cruise / peak_speed
+    )
+
+
+
+class Estimator():
+    """\
+Convert `Moves` into planner blocks, carrying the previous block's
+direction and speed between chunks.
+
+`settings` are Grbl settings by number. Settings that are missing take
+their default values.
+"""
+
+    def __init__(self, settings=None, lookahead=None):
+        require_numpy()
+        settings = settings or {}
+        self._max_rate = np.array(
+            [setting(settings, k) for k in MAX_RATE_KEYS], dtype=float)
+        self._acceleration = np.array(
+            [setting(settings, k) for k in ACCELERATION_KEYS], dtype=float)
+        self._junction_deviation = setting(settings, JUNCTION_DEVIATION_KEY)
+        self._arc_tolerance = setting(settings, ARC_TOLERANCE_KEY)
+
+        self._planner = Planner(lookahead)
+        self._unit = None
+        self._nominal = 0.0
+        self._stop = True
+        self.distance = 0.0
+        self.rapid_distance = 0.0
+        self.dwell = 0.0
+        self.lines = 0
+
+
+    def segments(self, moves):
+        """\
+Return the start and end of each line segment in `moves`, and the
+index of its move and the number of segments in that move.
+"""
+        count = np.ones(len(moves), dtype=COUNT)
+        arc = np.isin(moves.motion, (20, 30))
+        if arc.any():
+            (axes, center, radius, travel) = arcs(moves, arc)
+            tolerance = self._arc_tolerance
+            with np.errstate(invalid="ignore"):
+                arc_count = np.floor(np.abs(0.5 * travel * radius) / np.sqrt(
+                    tolerance * (2 * radius - tolerance)))
+            count[arc] = np.fmax(arc_count, 1)
+
+        total = int(np.sum(count))
+        move = np.repeat(np.arange(len(moves)), count)
+        first = np.cumsum(count, dtype=COUNT) - count
+        step = np.arange(1, total + 1, dtype=COUNT) - np.repeat(first, count)
+
+        end = moves.end[move]
+        if arc.any():
+            # Intermediate points on arcs, each rotated from the start.
+            rows = np.flatnonzero(arc[move] & (step < count[move]))
+            index = (np.cumsum(arc, dtype=COUNT) - 1)[move[rows]]
+            fraction = step[rows] / count[move[rows]]
+            angle = travel[index] * fraction
+            (a0, a1, a2) = axes[index].T
+            start = moves.start[move[rows]]
+            r0 = start[np.arange(len(rows)), a0] - center[index, a0]
+            r1 = start[np.arange(len(rows)), a1] - center[index, a1]
+            (cos, sin) = (np.cos(angle), np.sin(angle))
+            end[rows, a0] = center[index, a0] + r0 * cos - r1 * sin
+            end[rows, a1] = center[index, a1] + r0 * sin + r1 * cos
+            linear = start[np.arange(len(rows)), a2]
+            end[rows, a2] = linear + fraction * (
+                moves.end[move[rows], a2] - linear)
+
+        start = np.empty_like(end)
+        start[1:] = end[:-1]
+        start[first] = moves.start
+        return (start, end, move, count[move])
+
+
+    def add(self, moves):
+        self.lines += moves.lines
+        self.dwell += moves.dwell
+        (start, end, move, count) = self.segments(moves)
+
+        delta = end - start
+        length = np.sqrt(dot(delta, delta))
+        # Grbl discards blocks without any steps.
+        keep = length > 0
+        (delta, length, move, count) = \
+            (delta[keep], length[keep], move[keep], count[keep])
+        line = moves.line[move]
+
+        # Stops before any of the blocks, including those still to come.
+        stops = np.searchsorted(moves.stops, line, side="right")
+        stop = np.diff(stops, prepend=0) > 0
+        if len(stop):
+            stop[0] |= self._stop
+            self._stop = len(moves.stops) > stops[-1]
+        else:
+            self._stop |= len(moves.stops) > 0
+        if not len(length):
+            return
+
+        unit = delta / length[:, None]
+        rapid = moves.motion[move] == 0
+        rapid_rate = limit_by_axis(self._max_rate, unit)
+        feed = moves.feed[move]
+        rate = np.where(moves.inverse[move], feed * length * count, feed)
+        rate = np.where(rapid, rapid_rate, np.minimum(rate, rapid_rate))
+        speed = np.maximum(rate, MINIMUM_FEED_RATE) / 60
+        nominal = speed ** 2
+        acceleration = limit_by_axis(self._acceleration, unit)
+
+        self.distance += float(np.sum(length))
+        self.rapid_distance += float(np.sum(length[rapid]))
+
+        # Junction speeds, limited by the centripetal acceleration on a
+        # circle within the junction deviation of the corner.
+        previous = np.concatenate(
+            ([self._unit if self._unit is not None else unit[0]], unit[:-1]))
+        previous_nominal = np.concatenate(([self._nominal], nominal[:-1]))
+        cos = -dot(previous, unit)
+        junction = unit - previous
+        with np.errstate(invalid="ignore", divide="ignore"):
+            junction /= np.sqrt(dot(junction, junction))[:, None]
+            sin_half = np.sqrt(0.5 * (1 - cos))
+            junction_speed = (
+                limit_by_axis(self._acceleration, junction) *
+                self._junction_deviation * sin_half / (1 - sin_half))
+        junction_speed = np.where(cos > JUNCTION_COS_LIMIT, 0, junction_speed)
+        junction_speed = np.where(
+            cos < -JUNCTION_COS_LIMIT, math.inf, junction_speed)
+
+        entry = np.minimum(junction_speed, np.minimum(nominal, previous_nominal))
+        entry[stop] = 0
+
+        self._unit = unit[-1]
+        self._nominal = nominal[-1]
+        self._planner.add(length, acceleration, nominal, entry)
+
+
+    def finish(self):
+        """\
+Return the estimate as a dict.
+"""
+        motion = self._planner.finish()
+        return {
+            "seconds": motion + self.dwell,
+            "dwell": self.dwell,
+            "distance": self.distance,
+            "rapid_distance": self.rapid_distance,
+            "lines": self.lines,
+            "blocks": self._planner.blocks,
+        }
+
+
+
+def estimate(fp, settings=None, chunk_size=None):
+    """\
+Estimate the time taken to run the G-code read from the binary
+file-like `fp` on a Grbl controller with `settings`.
+
+Returns a dict of the estimated `seconds`, including `dwell` seconds,
+the `distance` moved and `rapid_distance` of that in millimeters, and
+the number of `lines` and planner `blocks`.
+
+Raises `ToolpathException` if the G-code cannot be parsed or NumPy is
+not installed.
+"""
+    estimator = Estimator(settings)
+    for moves in read_moves(fp, chunk_size):
+        estimator.add(moves)
+    result = estimator.finish()
+    LOG.debug("Estimated %.1fs for %d lines",
+              result["seconds"], result["lines"])
+    return result
@@ -0,0 +1,149 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event fan-out.
+
+Events published once are delivered to any number of subscribers, such
+as Server-Sent Events clients, without further device traffic.
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+
+
+DEFAULT_KEEPALIVE = 15.0
+
+
+
+LOG = logging.getLogger("calabo.events")
+
+
+
+class Subscription():
+    """\
+Pending events for one subscriber.
+
+Only the latest value of each event type is kept, so a slow subscriber
+skips intermediate values instead of buffering them.
+"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self.closed = False
+
+
+    def put(self, event, data):
+        with self._condition:
+            self._pending.pop(event, None)
+            self._pending[event] = data
+            self._condition.notify()
+
+
+    def get(self, timeout=None):
+        """\
+Return the oldest pending `(event, data)`, or `None` on timeout or close.
+"""
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._pending or self.closed, timeout):
+                return None
+            if not self._pending:
+                return None
+            return self._pending.popitem(last=False)
+
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+
+
+class EventHub():
+    """\
+Publish events to all current subscribers.
+
+The latest value of each event type published with `retain` is kept and
+sent to new subscribers when they join. Events that describe a moment
+rather than a state, such as alarms, are published without `retain` so
+that later subscribers do not mistake them for current.
+"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._latest = OrderedDict()
+
+
+    def publish(self, event, data, retain=True):
+        with self._lock:
+            if retain:
+                self._latest[event] = data
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            subscription.put(event, data)
+
+
+    def subscribe(self):
+        subscription = Subscription()
+        with self._lock:
+            for (event, data) in self._latest.items():
+                subscription.put(event, data)
+            self._subscribers.add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+        subscription.close()
+
+
+    def close(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+
+        for subscription in subscribers:
+            subscription.close()
+
+
+    def stream(self, keepalive=None):
+        """\
+Yield events formatted as a Server-Sent Events stream.
+
+A comment is sent after `keepalive` seconds without events so that
+closed connections are noticed.
+"""
+        if keepalive is None:
+            keepalive = DEFAULT_KEEPALIVE
+
+        subscription = self.subscribe()
+        try:
+            while not subscription.closed:
+                item = subscription.get(keepalive)
+                if item is None:
+                    if subscription.closed:
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                (event, data) = item
+                yield "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,245 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+G-code preprocessing.
+
+Reduces G-code to the fewest bytes Grbl needs to run it identically.
+"""
+
+import re
+import math
+import logging
+
+
+
+# Fraction of one step that rounding may move a coordinate.
+ROUNDING_STEP_FRACTION = 0.1
+
+# Steps-per-millimeter settings for each axis.
+AXIS_STEPS_KEYS = {
+    "X": 100,
+    "Y": 101,
+    "Z": 102,
+}
+
+# Arc offset words and the axis whose resolution they share.
+ARC_OFFSET_AXES = {
+    "I": "X",
+    "J": "Y",
+    "K": "Z",
+}
+
+# Modal groups whose words may be dropped when they repeat the current mode.
+MODAL_GROUPS = {
+    "G0": "motion",
+    "G1": "motion",
+    "G2": "motion",
+    "G3": "motion",
+    "G38.2": "motion",
+    "G38.3": "motion",
+    "G38.4": "motion",
+    "G38.5": "motion",
+    "G80": "motion",
+    "G17": "plane",
+    "G18": "plane",
+    "G19": "plane",
+    "G20": "units",
+    "G21": "units",
+    "G90": "distance",
+    "G91": "distance",
+    "G93": "feed",
+    "G94": "feed",
+}
+
+# Modes Grbl restores at program end with `M2` or `M30`. Units are kept.
+PROGRAM_END_MODES = {
+    "motion": "G1",
+    "plane": "G17",
+    "distance": "G90",
+    "feed": "G94",
+}
+
+# Non-modal commands whose axis words do not describe motion.
+NON_MODAL = ("G4", "G10", "G28", "G28.1", "G30", "G30.1", "G53", "G92", "G92.1")
+
+RE_COMMENT = re.compile(r"\([^)]*\)|;.*")
+RE_WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+
+
+
+LOG = logging.getLogger("calabo.gcode")
+
+
+
+class GcodeException(Exception):
+    pass
+
+
+
+def axis_decimals(settings):
+    """\
+Return the decimal places needed for each axis in millimeters.
+
+Derived from the `$100-$102` steps-per-millimeter values in `settings`,
+so that rounding moves a coordinate by less than a tenth of a step.
+Axes without a usable setting are not rounded.
+"""
+    decimals = {}
+    for (axis, key) in AXIS_STEPS_KEYS.items():
+        steps = settings.get(key)
+        if not steps or steps <= 0:
+            continue
+        decimals[axis] = max(0, math.ceil(
+            math.log10(steps / ROUNDING_STEP_FRACTION / 2)))
+    return decimals
+
+
+
+def format_number(value, decimals):
+    """\
+Format `value` with at most `decimals` places and no redundant characters.
+"""
+    text = "%.*f" % (decimals, value)
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", ""):
+        return "0"
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return text
+
+
+
+def source_decimals(text):
+    (_, _, fraction) = text.partition(".")
+    return len(fraction)
+
+
+
+def compact(lines, decimals=None, stats=None):
+    """\
+Yield `lines` of G-code reduced to their shortest equivalent form.
+
+Comments, whitespace and blank lines are removed, words that repeat the
+current modal state (motion mode, plane, units, distance and feed rate
+modes, and feed rate) are dropped, and numbers lose trailing zeros.
+Modes are tracked through program end with `M2` or `M30` as Grbl resets
+them.
+Axis and arc words are rounded to the resolution given by `decimals`,
+a dict of decimal places in millimeters per axis as returned by
+`axis_decimals`, except for axis words in incremental distance mode.
+
+System commands beginning with `$` are passed through unchanged.
+
+`stats`, if supplied, is a dict updated in place with `bytes_in` and
+`bytes_out` counts, each including one byte per line ending.
+"""
+    if decimals is None:
+        decimals = {}
+    decimals_mm = decimals
+    # An inch is 25.4mm, so two more places keep the same resolution.
+    decimals_inch = {k: v + 2 for (k, v) in decimals.items()}
+
+    if stats is None:
+        stats = {}
+    stats.update({
+        "bytes_in": 0,
+        "bytes_out": 0,
+    })
+
+    modes = {}
+    feed = None
+    relative = False
+
+    for line in lines:
+        stats["bytes_in"] += len(line.rstrip("\r\n")) + 1
+
+        line = line.strip()
+        if line.startswith("$"):
+            stats["bytes_out"] += len(line) + 1
+            yield line
+            continue
+
+        code = RE_COMMENT.sub("", line).replace(" ", "").replace("\t", "")
+        code = code.upper()
+        if not code or code == "%":
+            continue
+
+        words = RE_WORD.findall(code)
+        if sum(len(k) + len(v) for (k, v) in words) != len(code):
+            raise GcodeException("Could not parse G-code line %s" % repr(line))
+
+        commands = ["G" + format_number(float(v), source_decimals(v))
+                    for (k, v) in words if k == "G"]
+        non_modal = any(c in NON_MODAL for c in commands)
+        program_end = any(
+            k == "M" and float(v) in (2, 30) for (k, v) in words)
+
+        for command in commands:
+            if command in ("G20", "G21"):
+                if modes.get("units") != command:
+                    # The same feed rate number means a different speed.
+                    feed = None
+                decimals = decimals_inch if command == "G20" else decimals_mm
+            if command in ("G93", "G94"):
+                if modes.get("feed") != command:
+                    # Grbl needs a new feed rate after changing feed mode.
+                    feed = None
+            if command in ("G90", "G91"):
+                relative = command == "G91"
+
+        out = []
+        for (k, v) in words:
+            if k == "G":
+                command = "G" + format_number(float(v), source_decimals(v))
+                group = MODAL_GROUPS.get(command)
+                if group:
+                    if modes.get(group) == command and \
+                       not (group == "motion" and non_modal):
+                        continue
+                    modes[group] = command
+                out.append(command)
+                continue
+
+            value = float(v)
+
+            if k == "F":
+                if value == feed and modes.get("feed") != "G93":
+                    continue
+                feed = value
+
+            places = source_decimals(v)
+            axis = ARC_OFFSET_AXES.get(k, k)
+            # Rounding errors in incremental moves would accumulate.
+            incremental = relative and k in AXIS_STEPS_KEYS
+            if axis in decimals and not incremental:
+                places = min(places, decimals[axis])
+            elif k == "R" and decimals:
+                places = min(places, max(decimals.values()))
+
+            out.append(k + format_number(value, places))
+
+        if program_end:
+            modes.update(PROGRAM_END_MODES)
+            feed = None
+            relative = False
+
+        if not out:
+            continue
+
+        code = "".join(out)
+        stats["bytes_out"] += len(code) + 1
+        yield code
@@ -14,16 +14,66 @@
 import re
 import time
 import logging
-from collections import defaultdict
+import functools
+import threading
+from collections import defaultdict, deque
 
 import calabo.grbl_exc
-from calabo.serial import Serial
-from calabo.grbl_settings import STATES, SETTINGS, SETTINGS_KEYS, \
+from calabo.serial import Serial, ConnectionClosedException
+from calabo.status import StatusParser, StatusCache, StatusException
+from calabo.metrics import Histogram
+from calabo.settings import device_identity
+from calabo.grbl_settings import SETTINGS, SETTINGS_KEYS, \
     setting_from_string, setting_to_string
 
 
 
-HANDLERS = []
+# Response handlers indexed by the first character of the response.
+HANDLERS = defaultdict(list)
+
+# Size of Grbl's serial receive buffer in bytes.
+RX_BUFFER_SIZE = 128
+
+# Settings that must be written before others, as `(first, then)` pairs.
+# Soft limits cannot be enabled unless homing is enabled (error 10).
+SETTING_DEPENDENCIES = (
+    (22, 20),
+)
+
+# An Arduino bootloader can take over a second before Grbl starts.
+DEFAULT_BOOT_TIMEOUT = 5.0
+DEFAULT_BOOT_RETRY_INTERVAL = 2.0
+
+SOFT_RESET = "\x18"
+
+# Single-byte commands that Grbl acts on as soon as they are received.
+REALTIME_COMMANDS = {
+    "status": "?",
+    "cycle-start": "~",
+    "feed-hold": "!",
+    "reset": SOFT_RESET,
+    "safety-door": "\x84",
+    "jog-cancel": "\x85",
+    "feed-override-reset": "\x90",
+    "feed-override-plus-10": "\x91",
+    "feed-override-minus-10": "\x92",
+    "feed-override-plus-1": "\x93",
+    "feed-override-minus-1": "\x94",
+    "rapid-override-reset": "\x95",
+    "rapid-override-50": "\x96",
+    "rapid-override-25": "\x97",
+    "spindle-override-reset": "\x99",
+    "spindle-override-plus-10": "\x9a",
+    "spindle-override-minus-10": "\x9b",
+    "spindle-override-plus-1": "\x9c",
+    "spindle-override-minus-1": "\x9d",
+    "spindle-stop": "\x9e",
+    "flood-coolant": "\xa0",
+    "mist-coolant": "\xa1",
+}
+
+DEFAULT_STATUS_INTERVAL = 0.2
+DEFAULT_STATUS_TIMEOUT = 1.0
 
 
 
@@ -37,153 +87,254 @@ class ResponseException(Exception):
 class SettingsException(Exception):
     pass
 
+class RealtimeException(Exception):
+    pass
+
+class StreamException(Exception):
+    pass
+
+
+def handle(prefix, pattern=None):
+    """\
+Register a handler for responses starting with `prefix`.
 
-def handle(pattern):
+Without `pattern` the handler is called with the whole response.
+With `pattern` the response must also match the regular expression and
+the handler is called with its groups. Handlers for the same first
+character are tried in the order they are registered.
+"""
     global HANDLERS
 
-    regex = re.compile(pattern)
+    regex = None
+    if pattern is not None:
+        regex = re.compile(pattern)
 
     def d(f):
-        HANDLERS.append((regex, f))
+        HANDLERS[prefix[0]].append((prefix, regex, f))
         return f
 
     return d
 
 
 
-class Grbl():
+def locked(f):
     """\
-Grbl interface object.
+Hold the Grbl link lock for the duration of a method call.
 """
 
-    def __init__(self, device):
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+
+    return wrapper
+
+
+
+class BaseGrbl():
+    """\
+Grbl response handling and state shared by `Grbl` and `AsyncGrbl`.
+
+Responses are dispatched to the handlers registered with `handle`.
+Subclasses read responses and wait for them, blocking or asynchronously.
+
+`device` is an address, or a dict with the `address`, an optional
+`reset` function and an optional `port` object to use instead of
+opening the address. `recorder` is an optional `Recorder` for the
+serial traffic.
+"""
+
+    def __init__(self, device, settings_cache=None, boot_timeout=None,
+                 events=None, recorder=None):
+        port = None
         if hasattr(device, "get"):
             device_address = device["address"]
-            self._reset_device = device["reset"]
+            self._reset_device = device.get("reset")
+            port = device.get("port")
         else:
             device_address = device
             self._reset_device = None
 
-        self._serial = Serial(device_address, name="ctrl", write_eol="\n")
+        self._serial = Serial(device_address, name="ctrl", write_eol="\n",
+                              port=port, recorder=recorder)
+        self._device_address = device_address
+        self._device_identity = None
         self._state = None
         self._homed = None
         self._unlocked = None
         self._settings = {}
+        self._settings_read = None
+        self._settings_cache = settings_cache
         self._last_response = None
+        self._version = None
+        self._boot_timeout = boot_timeout or DEFAULT_BOOT_TIMEOUT
+        self._boot_time = None
+        self._alarm = None
+        self._probe = None
+        self._events = events
 
+        self._stream_pending = deque()
+        self._stream_sent = deque()
+        self._stream_in_flight = 0
+        self._stream_error = None
+        self._stream_progress = None
 
-    def __enter__(self):
-        self._serial.__enter__()
-        self.initialize()
-        return self
+        self._status = StatusCache()
+        self._status_parser = StatusParser()
 
+        # Metrics.
+        self._command_sent = None
+        self._ok_latency = Histogram()
+        self._error_counts = defaultdict(int)
+        self._alarm_counts = defaultdict(int)
 
-    def __exit__(self, exception_type, exception_value, traceback):
-        self._serial.__exit__(exception_type, exception_value, traceback)
 
+    def _soft_reset(self):
+        self._serial.discard_input()
+        self.realtime("reset")
 
-    def initialize(self):
-        if self._reset_device:
-            self._reset_device()
-        else:
-            self._serial._ser.dtr = False
-            time.sleep(0.1)
-            self._serial._ser.dtr = True
 
-        time.sleep(0.1)
-        result = self._step()
-        if self._state != "ready":
-            raise ResponseException("No salutation received")
+    def realtime(self, command):
+        """\
+Write the realtime command named `command` immediately.
 
-        self._read_settings()
+Realtime commands do not wait for the serial link lock, are not queued
+behind streamed lines and do not count towards Grbl's receive buffer.
+See `REALTIME_COMMANDS` for names.
+"""
+        try:
+            char = REALTIME_COMMANDS[command]
+        except KeyError:
+            raise RealtimeException("Unknown realtime command %s" % command)
+        self._serial.write_realtime(char)
 
 
-    def reset(self):
-        self._state = None
-        self._homed = None
-        self._unlocked = None
-        self._settings = {}
-        self._last_response = None
+    def __repr__(self):  # pragma: no cover
+        return str(self._serial)
 
-        self.initialize()
 
+    @handle("ok")
+    def _ok(self, line):
+        if self._state == "stream":
+            self._stream_ack()
+            return
+        if self._state not in ("expect_ok", "expect_probe"):
+            raise ResponseException(
+                "Unexpected response received in state %s: 'ok'." %
+                self._state)
+        if self._command_sent is not None:
+            self._ok_latency.observe(time.monotonic() - self._command_sent)
+            self._command_sent = None
+        self._set_state("ready")
+
+
+    @handle("<")
+    def _status_report(self, text):
+        report = self._parse_status(text)
+        self._status.update(report)
+        if self._events:
+            self._events.publish("status", report.as_dict())
 
-    def __repr__(self):  # pragma: no cover
-        return str(self._serial)
 
+    @handle("Grbl ", r"^Grbl (\S+) \[.* for help\]$")
+    def _boot(self, version):
+        if self._state == "stream":
+            # Grbl discards everything in flight when it is reset.
+            self._stream_pending.clear()
+            self._stream_sent.clear()
+            self._stream_in_flight = 0
+            if self._stream_error is None:
+                self._stream_error = ResponseException(
+                    "Grbl was reset while streaming")
 
-    @handle(r"^Grbl .* for help\]$")
-    def _boot(self):
+        self._version = version
+        self._command_sent = None
         self._homed = False
+        self._alarm = None
         self._set_state("ready")
 
 
-    @handle(r"^\[MSG:.*]$")
-    def _msg(self):
-        pass
+    @handle("[MSG:")
+    def _msg(self, line):
+        LOG.debug("Message: %s", line[5:-1])
 
 
-    @handle(r"^\[PRB:([\d.]),([\d.]),([\d.]),([01])]$")
-    def _prb(self, x, y, z, status):
-        pass
+    @handle("[PRB:", r"^\[PRB:(-?[\d.]+),(-?[\d.]+),(-?[\d.]+):([01])\]$")
+    def _prb(self, x, y, z, success):
+        self._probe = (float(x), float(y), float(z), success == "1")
 
 
-    @handle(r"^ok$")
-    def _ok(self):
-        if self._state != "expect_ok":
-            raise ResponseException(
-                "Unexpected response received in state %s: 'ok'." %
-                self._state)
-        self._set_state("ready")
+    @handle("[")
+    def _feedback(self, line):
+        LOG.debug("Feedback: %s", line)
+
+
+    @handle("ALARM:", r"^ALARM:(\d+)$")
+    def _alarm_received(self, key):
+        key = int(key)
+        self._alarm = key
+        self._alarm_counts[key] += 1
+        text = calabo.grbl_exc.alarm.get(key, {}).get("text", "Unknown alarm")
+        LOG.warning("Alarm %d: %s", key, text)
+        if self._events:
+            # The current state, including any alarm, is in `status`.
+            self._events.publish(
+                "alarm", {"code": key, "text": text}, retain=False)
 
 
-    @handle(r"^error:(\d+)$")
+    @handle("error:", r"^error:(\d+)$")
     def _error(self, key):
         key = int(key)
+        self._error_counts[key] += 1
+        self._command_sent = None
 
         for k, v in calabo.grbl_exc.exc.items():
             if k == key:
-                raise v["class"](v["text"])
+                error = v["class"](v["text"])
+                break
+        else:
+            error = ResponseException(
+                "Unexpected error response '%s' received in state %s: 'ok'." % (
+                    key, self._state))
+
+        if self._state == "stream":
+            self._stream_ack(error)
+            return
 
-        raise ResponseException(
-            "Unexpected error response '%s' received in state %s: 'ok'." % (
-                key, self._state))
+        raise error
 
 
-    @handle(r"^\$(\d+)=(.+)$")
+    @handle("$", r"^\$(\d+)=(.+)$")
     def _setting(self, key, value_str):
         key = int(key)
         try:
             name = SETTINGS[key]["name"]
-        except IndexError:
+        except KeyError:
             raise SettingsException(
                 "Unknown settings key %d with value %s" % (key, value_str))
 
         value = setting_from_string(key, value_str)
-        self.setting(key, value, from_device=True)
+        self._store_setting(key, value)
 
 
-    def _step(self):
-        while True:
-            line = self._serial.read_line()
-            if line is None:
-                return None
+    def _dispatch(self, line):
+        self._last_response = line
 
-            self._last_response = line
+        if not line:
+            return
 
-            if not line:
+        for (prefix, regex, f) in HANDLERS.get(line[0], ()):
+            if not line.startswith(prefix):
                 continue
+            if regex is None:
+                f(self, line)
+                return
+            match = regex.match(line)
+            if match:
+                f(self, *match.groups())
+                return
 
-            for (regex, f) in HANDLERS:
-                match = regex.match(line)
-                if match:
-                    f(self, *match.groups())
-                    break
-            else:
-                raise ResponseException("Unexpected response: %s" % repr(line))
-
-            if self._state in ("ready", ):
-                break
+        raise ResponseException("Unexpected response: %s" % repr(line))
 
 
     def _set_state(self, state):
@@ -191,69 +342,636 @@ Grbl interface object.
         LOG.debug("set state %s" % self._state)
 
 
-    def _read_settings(self):
+    def _write_command(self, line, state):
+        """\
+Write `line`, timing its round trip, and expect a response in `state`.
+"""
+        self._command_sent = time.monotonic()
+        self._serial.write_line(line)
+        self._set_state(state)
+
+
+    def _settings_read_complete(self):
+        self._settings = self._settings_read
+        self._settings_read = None
+
+        if self._settings_cache:
+            try:
+                self._settings_cache.save(
+                    self._identity(), self._version, self._settings)
+            except OSError as e:
+                LOG.warning("Could not save settings snapshot: %s", e)
+
+
+    def _identity(self):
+        if self._device_identity is None:
+            self._device_identity = device_identity(self._device_address)
+        return self._device_identity
+
+
+    def _parse_status(self, text):
+        try:
+            return self._status_parser.parse(text)
+        except StatusException as e:
+            raise ResponseException(str(e))
+
+
+    def _parse_state(self, text):
+        return self._parse_status(text).state
+
+
+    def _settable(self, state):
+        """\
+Return `True` if settings may be written in Grbl state `state`.
+"""
+        if state in ("Alarm", ):
+            if self._unlocked is None:
+                # Grbl boots in alarm state when homing is enabled.
+                # but settings can still be set.
+                return True
+            raise calabo.grbl_exc.GrblAlarmError()
+        return state in ("Idle", "Jog")
+
+
+    def _setting_written(self, key, value):
+        self._settings[key] = value
+
+        if self._settings_cache:
+            self._settings_cache.invalidate(self._identity(), self._version)
+
+        # Grbl disables soft limits when homing is disabled.
+        if key == 22 and not value:
+            self._settings[20] = False
+
+        LOG.debug("Set setting %d %s %s", key, SETTINGS[key]["name"], value)
+
+
+    def _setting_key(self, key, value=None):
+        """\
+Return the integer key and name of a setting given either.
+"""
+        try:
+            key = int(key)
+        except ValueError:
+            pass
+
+        try:
+
+            if isinstance(key, int):
+                name = SETTINGS[key]["name"]
+            else:
+                name = key
+                key = SETTINGS_KEYS[name]
+        except KeyError:
+            raise SettingsException(
+                "Unknown settings key %s with value %s" % (key, value))
+
+        return (key, name)
+
+
+    def _setting_value(self, key):
+        """\
+Return the value of a setting read from the device.
+"""
+        (key, _name) = self._setting_key(key)
+        try:
+            return self._settings[key]
+        except KeyError:
+            raise SettingsException(
+                "Requesting settings key %d before initial values have "
+                "been read from device" % (key))
+
+
+    def _store_setting(self, key, value):
+        """\
+Store a setting value received from the device in response to `$$`.
+"""
+        if self._state != "read_settings":
+            raise ResponseException(
+                "Unexpected setting value received. %s %s" %
+                (self._state, self._last_response))
+
+        self._settings_read[key] = value
+        # A settings dump is not timed as a round trip.
+        self._command_sent = None
+        LOG.debug("Setting received from device %d (%d/%d) %s %s",
+                  key, len(self._settings_read), len(SETTINGS),
+                  SETTINGS[key]["name"], value)
+        if len(self._settings_read) == len(SETTINGS):
+            self._set_state("expect_ok")
+
+
+    def _probe_result(self):
+        if self._alarm is not None:
+            v = calabo.grbl_exc.alarm.get(self._alarm)
+            if v:
+                raise v["class"](v["text"])
+            raise calabo.grbl_exc.GrblAlarmError()
+
+        if self._probe is None:
+            raise ResponseException("No probe result received")
+
+        return self._probe[:3]
+
+
+    def _stream_ack(self, error=None):
+        if not self._stream_pending:
+            raise ResponseException(
+                "Response received with no streamed lines in flight: %s" %
+                repr(self._last_response))
+
+        self._stream_in_flight -= self._stream_pending.popleft()
+        if self._stream_sent:
+            self._ok_latency.observe(
+                time.monotonic() - self._stream_sent.popleft())
+
+        if self._stream_progress is not None:
+            self._stream_progress["acknowledged"] += 1
+
+        if error is not None:
+            LOG.debug("Streamed line rejected: %s", repr(error))
+            if self._stream_error is None:
+                self._stream_error = error
+
+
+    def _stream_begin(self, progress):
+        """\
+Enter the stream state, counting progress in the dict `progress`.
+"""
+        if progress is None:
+            progress = {}
+        progress.update({
+            "sent": 0,
+            "acknowledged": 0,
+            "bytes": 0,
+        })
+
+        self._stream_pending.clear()
+        self._stream_sent.clear()
+        self._stream_in_flight = 0
+        self._stream_error = None
+        self._stream_progress = progress
+        self._set_state("stream")
+        return progress
+
+
+    def _stream_batch(self, lines, line, flush=False):
+        """\
+Take lines from the iterator `lines`, starting with `line` if it is not
+`None`, while they fit in Grbl's receive buffer.
+
+Returns the lines taken and the next line, which did not fit, or `None`.
+"""
+        batch = []
+        while self._stream_error is None:
+            if line is None:
+                line = next(lines, None)
+                if line is None:
+                    break
+                line = line.strip()
+                if not line:
+                    line = None
+                    continue
+
+            size = self._serial.line_size(line)
+            if size > RX_BUFFER_SIZE:
+                self._stream_error = StreamException(
+                    "Line of %d bytes does not fit in Grbl's "
+                    "%d byte receive buffer: %s" % (
+                        size, RX_BUFFER_SIZE, repr(line)))
+                break
+            if (self._stream_pending or batch) and \
+               self._stream_in_flight + size > RX_BUFFER_SIZE:
+                break
+
+            batch.append(line)
+            self._stream_pending.append(size)
+            self._stream_in_flight += size
+            self._stream_progress["bytes"] += size
+            line = None
+            if flush:
+                break
+
+        return (batch, line)
+
+
+    def _stream_write(self, batch):
+        self._stream_sent.extend([time.monotonic()] * len(batch))
+        self._serial.write_lines(batch)
+        self._stream_progress["sent"] += len(batch)
+
+
+    def _stream_finish(self):
+        """\
+Leave the stream state, raising the first error received.
+"""
+        self._set_state("ready")
+
+        if self._stream_error is not None:
+            raise self._stream_error
+
+
+    def collect_metrics(self, exposition, labels):
+        """\
+Add serial traffic, round trip and controller metrics to `exposition`.
+"""
+        serial = self._serial
+        for (direction, size, lines) in (
+                ("in", serial.bytes_read, serial.lines_read),
+                ("out", serial.bytes_written, serial.lines_written)):
+            direction_labels = dict(labels, direction=direction)
+            exposition.counter(
+                "calabo_serial_bytes_total",
+                "Bytes transferred on the serial link.",
+                size, direction_labels)
+            exposition.counter(
+                "calabo_serial_lines_total",
+                "Lines transferred on the serial link.",
+                lines, direction_labels)
+
+        exposition.histogram(
+            "calabo_grbl_ok_seconds",
+            "Time from writing a line to receiving its response.",
+            self._ok_latency, labels)
+
+        exposition.gauge(
+            "calabo_grbl_rx_in_flight_bytes",
+            "Streamed bytes not yet acknowledged by Grbl.",
+            self._stream_in_flight, labels)
+
+        (_count, when, report) = self._status.snapshot()
+        if report is not None:
+            exposition.gauge(
+                "calabo_grbl_planner_blocks_free",
+                "Free planner blocks reported in Bf.",
+                report.planner_blocks, labels)
+            exposition.gauge(
+                "calabo_grbl_rx_buffer_free_bytes",
+                "Free serial receive buffer bytes reported in Bf.",
+                report.rx_bytes, labels)
+            exposition.gauge(
+                "calabo_grbl_status_age_seconds",
+                "Age of the latest status report.",
+                time.monotonic() - when, labels)
+
+        for (key, count) in sorted(self._error_counts.items()):
+            exposition.counter(
+                "calabo_grbl_errors_total", "Error responses by code.",
+                count, dict(labels, code=key))
+        for (key, count) in sorted(self._alarm_counts.items()):
+            exposition.counter(
+                "calabo_grbl_alarms_total", "Alarms by code.",
+                count, dict(labels, code=key))
+
+
+
+class Grbl(BaseGrbl):
+    """\
+Grbl interface object that blocks while waiting for responses.
+
+`settings_cache` is an optional `SettingsCache`. When a snapshot matching
+the device and firmware exists, `initialize` uses it and re-reads the
+settings from the device in the background.
+
+`events` is an optional `EventHub` to which status reports and alarms
+are published.
+
+See `BaseGrbl` for `device` and `recorder`.
+"""
+
+    def __init__(self, device, settings_cache=None, boot_timeout=None,
+                 events=None, recorder=None):
+        super().__init__(
+            device, settings_cache=settings_cache, boot_timeout=boot_timeout,
+            events=events, recorder=recorder)
+
+        self._settings_refresh = None
+
+        # Held by whichever thread is using the serial link.
+        self._lock = threading.RLock()
+        self._poller = None
+        self._poller_interval = None
+        self._poller_stop = threading.Event()
+
+
+    def __enter__(self):
+        self._serial.__enter__()
+        self.initialize()
+        return self
+
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop_status_poller()
+        if self._settings_refresh:
+            self._settings_refresh.join()
+        self._serial.__exit__(exception_type, exception_value, traceback)
+
+
+    @locked
+    def initialize(self, soft_reset=None):
+        """\
+Wait for the startup banner, then read settings.
+
+Opening the port resets most Arduino boards, so by default the first
+attempt just waits for Grbl to boot. Soft resets are sent if no banner
+arrives within `DEFAULT_BOOT_RETRY_INTERVAL`, or straight away if
+`soft_reset` is true, until `boot_timeout` has elapsed.
+"""
+        start = time.monotonic()
+        deadline = start + self._boot_timeout
+
+        if self._reset_device:
+            self._reset_device()
+        elif soft_reset:
+            self._soft_reset()
+
+        while not self._wait_boot(
+                min(deadline, time.monotonic() + DEFAULT_BOOT_RETRY_INTERVAL)):
+            if time.monotonic() >= deadline:
+                raise ResponseException(
+                    "No salutation received in %.1fs" % self._boot_timeout)
+            LOG.debug("No salutation received. Sending soft reset")
+            self._soft_reset()
+
+        self._boot_time = time.monotonic() - start
+        LOG.info("Grbl %s ready in %.3fs", self._version, self._boot_time)
+
+        if self._load_settings():
+            return
+
+        self._read_settings()
+
+
+    @locked
+    def reset(self):
+        self._state = None
+        self._homed = None
+        self._unlocked = None
         self._settings = {}
+        self._last_response = None
+
+        self.initialize(soft_reset=True)
+
+
+    def _wait_boot(self, deadline):
+        """\
+Read responses until the startup banner or `deadline`.
+
+Output before the banner, such as bootloader noise or responses to
+earlier commands, is ignored. Returns `True` if the banner was received.
+"""
+        self._set_state("boot")
+        while self._state != "ready":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            line = self._serial.read_line(timeout=remaining)
+            if line is None:
+                return False
+            try:
+                self._dispatch(line)
+            except (ResponseException, calabo.grbl_exc.GrblError):
+                LOG.debug("Ignoring response before salutation: %s",
+                          repr(line))
+        return True
+
+
+    def _step(self, timeout=False):
+        """\
+Read and dispatch responses until Grbl is ready.
+
+`timeout` is the overall time in seconds to wait, or `False` to wait
+indefinitely. Returns `None` on timeout.
+"""
+        deadline = None
+        if timeout is not False:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = False
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            line = self._serial.read_line(timeout=remaining)
+            if line is None:
+                return None
+
+            self._dispatch(line)
+
+            if self._state in ("ready", ):
+                break
+
+
+    @locked
+    def _read_settings(self):
+        """\
+Read all settings from the device with `$$`.
+
+Values are collected separately and replace `_settings` only once the
+read is complete, so readers never see a partial set.
+"""
+        self._settings_read = {}
         self._serial.write_line("$$")
         self._set_state("read_settings")
-        return self._step()
+        self._step()
+        self._settings_read_complete()
 
 
-    def _parse_state(self, text):
-        if not text.startswith("<"):
-            raise ResponseException("State does not start with <: %s" % repr(text))
-        if not text.endswith(">"):
-            raise ResponseException("State does not end with >: %s" % repr(text))
-        text = text[1:-1]
+    def _load_settings(self):
+        """\
+Use cached settings if available and refresh them in the background.
+
+Returns `True` if cached settings were loaded.
+"""
+        if not self._settings_cache:
+            return False
 
-        parts = text.split("|")
+        settings = self._settings_cache.load(self._identity(), self._version)
+        if settings is None:
+            return False
 
-        state = parts[0]
-        _substate = None
-        if ":" in state:
-            (state, _substate) = state.split(":", 1)
+        self._settings = settings
+        LOG.debug("Using cached settings for %s", self._identity())
 
-        if state not in STATES:
-            raise ResponseException("Unrecognised state %s in text %s" % (
-                repr(state), repr(text)))
+        self._settings_refresh = threading.Thread(
+            target=self._refresh_settings, name="calabo-settings-refresh")
+        self._settings_refresh.daemon = True
+        self._settings_refresh.start()
+        return True
 
-        return state
 
+    def _refresh_settings(self):
+        cached = self._settings
+        try:
+            self._read_settings()
+        except Exception as e:
+            LOG.warning("Could not refresh cached settings: %s", repr(e))
+            return
+
+        if self._settings != cached:
+            LOG.info("Settings on device differ from cached snapshot")
+
+
+    def _request_status(self, timeout=None):
+        """\
+Write `?` and read responses until a new status report has arrived.
+"""
+        if timeout is None:
+            timeout = DEFAULT_STATUS_TIMEOUT
+
+        (count, _when, _report) = self._status.snapshot()
+        self.realtime("status")
 
-    def read_state(self):
-        self._serial._ser.write(("?").encode("utf-8"))
-        response = ""
+        deadline = time.monotonic() + timeout
         while True:
-            char = self._serial._ser.read().decode("utf-8").strip()
-            response += char
-            if char == ">":
-                break
-            if len(response) > 255:
+            (latest, _when, report) = self._status.snapshot()
+            if latest > count:
+                return report
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ResponseException("No status report received")
+
+            line = self._serial.read_line(timeout=remaining)
+            if line is not None:
+                self._dispatch(line)
+
+
+    @locked
+    def read_state(self, timeout=None):
+        return self._request_status(timeout).state
+
+
+    def status(self, max_age=None):
+        """\
+Return the latest status report.
+
+The cached report is returned without touching the serial link unless
+there is none yet or it is older than `max_age` seconds.
+"""
+        (_count, when, report) = self._status.snapshot()
+        if report is not None:
+            if max_age is None or time.monotonic() - when <= max_age:
+                return report
+
+        with self._lock:
+            return self._request_status()
+
+
+    def start_status_poller(self, interval=None):
+        """\
+Request a status report every `interval` seconds in a background thread.
+"""
+        if self._poller:
+            return
+
+        if interval is None:
+            interval = DEFAULT_STATUS_INTERVAL
+
+        self._poller_interval = interval
+        self._poller_stop.clear()
+        self._poller = threading.Thread(
+            target=self._poll_status, args=(interval, ),
+            name="calabo-status-poller")
+        self._poller.daemon = True
+        self._poller.start()
+
+
+    def stop_status_poller(self):
+        if not self._poller:
+            return
+
+        self._poller_stop.set()
+        self._poller.join()
+        self._poller = None
+        self._poller_interval = None
+
+
+    def _poll_status(self, interval):
+        while not self._poller_stop.wait(interval):
+            if self._state is None:
+                # Not yet initialized.
+                continue
+
+            try:
+                if self._lock.acquire(blocking=False):
+                    try:
+                        self._request_status(timeout=interval)
+                    finally:
+                        self._lock.release()
+                else:
+                    # The thread holding the link will dispatch the reply.
+                    self.realtime("status")
+            except ConnectionClosedException:
                 break
+            except Exception as e:
+                LOG.warning("Status poll failed: %s", repr(e))
 
-        return self._parse_state(response)
 
+    def _wait_settable(self):
+        """\
+Wait until Grbl is in a state in which settings may be written.
+"""
+        state = self.status(max_age=self._poller_interval or 0).state
+        while not self._settable(state):
+            time.sleep(0.1)
+            state = self.read_state()
 
+
+    @locked
     def _write_setting(self, key, value):
         """`
 `key` should be an integer.
 `value` should be in its native type
 """
-        while True:
-            state = self.read_state()
-            if state in ("Alarm", ):
-                if self._unlocked is None:
-                    # Grbl boots in alarm state when homing is enabled.
-                    # but settings can still be set.
-                    break
-                raise calabo.grbl_exc.GrblAlarmError()
-            if state in ("Idle", "Jog"):
-                break
-            time.sleep(0.1)
+        self._wait_settable()
+
+        self._write_setting_line(key, value)
 
+
+    def _write_setting_line(self, key, value):
         value_str = setting_to_string(key, value)
-        self._serial.write_line("$%d=%s" % (key, value_str))
-        self._set_state("expect_ok")
+        self._write_command("$%d=%s" % (key, value_str), "expect_ok")
         self._step()
+        self._setting_written(key, value)
+
+
+    @locked
+    def write_settings(self, values):
+        """\
+Write several settings, skipping those that already have the requested value.
+
+`values` is a dict keyed by setting name or integer. Grbl's state is
+checked once and the changed settings are then written back to back,
+dependent settings last. Each write waits for its `ok` because Grbl
+stops reading serial input while it writes to EEPROM.
+
+Returns a list of the keys written.
+"""
+        changes = {}
+        for (key, value) in values.items():
+            (key, _name) = self._setting_key(key, value)
+            if key in self._settings and self._settings[key] == value:
+                continue
+            changes[key] = value
+
+        if not changes:
+            return []
+
+        first = {k for (k, _) in SETTING_DEPENDENCIES}
+        order = sorted(changes, key=lambda k: (k not in first, k))
+
+        self._wait_settable()
+
+        written = []
+        for key in order:
+            value = changes[key]
+            if key in self._settings and self._settings[key] == value:
+                # Changed as a side effect of an earlier write.
+                continue
+            self._write_setting_line(key, value)
+            written.append(key)
+
+        return written
 
 
     def setting(self, key, value=None, from_device=None):
@@ -263,66 +981,90 @@ Grbl interface object.
         Set `from_device` to True when reading initial values from device.
         """
 
-        try:
-            key = int(key)
-        except ValueError:
-            pass
-
-        try:
-
-            if isinstance(key, int):
-                name = SETTINGS[key]["name"]
-            else:
-                name = key
-                key = SETTINGS_KEYS[name]
-        except IndexError:
-            raise SettingsException(
-                "Unknown settings key %d with value %s" % (key, value))
-
         if value is None:
-            try:
-                return self._settings[key]
-            except IndexError:
-                raise SettingsException(
-                    "Requesting settings key %d before initial values have "
-                    "been read from device" % (key))
+            return self._setting_value(key)
 
-        if not from_device:
-            self._write_setting(key, value)
-
-        self._settings[key] = value
+        (key, name) = self._setting_key(key, value)
 
         if from_device:
-            if self._state != "read_settings":
-                raise ResponseException(
-                    "Unexpected setting value received. %s %s" %
-                    (self._state, self._last_response))
-            LOG.debug("Setting received from device %d (%d/%d) %s %s",
-                      key, len(self._settings), len(SETTINGS), name, value)
-            if len(self._settings) == len(SETTINGS):
-                self._set_state("expect_ok")
-        else:
-            LOG.debug("Set setting %d %s %s", key, name, value)
+            self._store_setting(key, value)
+            return None
+
+        self._write_setting(key, value)
 
         return None
 
 
+    @locked
     def move(self, x):
         cmd = "G0 X%f" % x
-        self._serial.write_line(cmd)
-        self._set_state("expect_ok")
+        self._write_command(cmd, "expect_ok")
         self._step()
 
 
+    @locked
     def mill(self, x):
         cmd = "G1 X%f" % x
-        self._serial.write_line(cmd)
-        self._set_state("expect_ok")
+        self._write_command(cmd, "expect_ok")
         self._step()
 
 
+    @locked
     def probe(self, z_to):
+        """\
+Probe towards `z_to` and return the probed `(x, y, z)` position.
+
+Raises the alarm reported by Grbl if the probe fails.
+"""
         cmd = "G38.2 Z%f" % z_to
-        self._serial.write_line(cmd)
-        self._set_state("expect_probe")
+        self._probe = None
+        self._alarm = None
+        self._write_command(cmd, "expect_probe")
         self._step()
+
+        return self._probe_result()
+
+
+    @locked
+    def stream(self, lines, progress=None, flush=False):
+        """\
+Stream G-code `lines` using Grbl's character-counting protocol.
+
+As many lines as fit in Grbl's serial receive buffer are kept in
+flight and written together, and each `ok` or `error:N` response is
+matched to the oldest unacknowledged line.
+
+`lines` may be any iterable, including a generator. `progress`, if
+supplied, is a dict updated in place with `sent`, `acknowledged` and
+`bytes` counts.
+
+With `flush`, each line is written as soon as it is produced instead of
+being batched, for sources such as jogging that produce lines over time.
+
+After an error no further lines are sent; once the lines already in
+flight have been acknowledged the first error is raised. A line too
+long for Grbl's receive buffer is an error and is not sent.
+"""
+
+        progress = self._stream_begin(progress)
+        lines = iter(lines)
+        line = None
+
+        try:
+            while True:
+                (batch, line) = self._stream_batch(lines, line, flush)
+                if batch:
+                    self._stream_write(batch)
+
+                if not self._stream_pending:
+                    break
+
+                response = self._serial.read_line()
+                if response is not None:
+                    self._dispatch(response)
+        finally:
+            self._stream_progress = None
+
+        self._stream_finish()
+
+        return progress
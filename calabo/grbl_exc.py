@@ -25,6 +25,10 @@ class GrblAlarmError(GrblError):
 
 
 exc = {
+    8: {
+        "name": "NotIdle",
+        "text": "Grbl '$' command cannot be used unless Grbl is idle.",
+    },
     9: {
         "name": "AlarmJogLock",
         "text": "G-code locked out during alarm or jog state",
@@ -41,9 +45,57 @@ exc = {
 
 
 
+alarm = {
+    1: {
+        "name": "HardLimit",
+        "text": "Hard limit triggered. Machine position is likely lost.",
+    },
+    2: {
+        "name": "SoftLimit",
+        "text": "G-code motion target exceeds machine travel.",
+    },
+    3: {
+        "name": "AbortCycle",
+        "text": "Reset while in motion. Machine position is likely lost.",
+    },
+    4: {
+        "name": "ProbeFailInitial",
+        "text": "Probe is not in the expected initial state.",
+    },
+    5: {
+        "name": "ProbeFailContact",
+        "text": "Probe did not contact the workpiece within travel.",
+    },
+    6: {
+        "name": "HomingFailReset",
+        "text": "Reset during active homing cycle.",
+    },
+    7: {
+        "name": "HomingFailDoor",
+        "text": "Safety door was opened during active homing cycle.",
+    },
+    8: {
+        "name": "HomingFailPulloff",
+        "text": "Homing cycle failed to clear limit switch when pulling off.",
+    },
+    9: {
+        "name": "HomingFailApproach",
+        "text": "Homing cycle could not find limit switch.",
+    },
+}
+
+
+
 for k, v in exc.items():
     name = "Grbl%sError" % v["name"]
     v["code"] = k
     attr = v
     v["class"] = type(name, (GrblError, ), attr)
     globals()[name] = v["class"]
+
+for k, v in alarm.items():
+    name = "Grbl%sAlarm" % v["name"]
+    v["code"] = k
+    attr = v
+    v["class"] = type(name, (GrblAlarmError, ), attr)
+    globals()[name] = v["class"]
@@ -0,0 +1,214 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+
+from calabo.gcode import compact
+from calabo.toolpath import ToolpathException
+from calabo.preflight import preflight, PreflightException
+
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_PROGRESS_INTERVAL = 0.2
+
+
+
+LOG = logging.getLogger("calabo.job")
+
+
+
+def store(stream, path, chunk_size=None):
+    """\
+Copy the file-like `stream` to `path` in chunks.
+
+Returns the number of bytes written.
+"""
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    size = 0
+    with open(path, "wb") as fp:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            fp.write(chunk)
+            size += len(chunk)
+
+    return size
+
+
+
+def read_lines(path):
+    """\
+Yield the lines of the G-code file at `path` one at a time.
+"""
+    with open(path, encoding="utf-8", errors="replace") as fp:
+        for line in fp:
+            yield line
+
+
+
+class Job():
+    """\
+A G-code file stored on disk and streamed to Grbl.
+
+Jobs start in the `storing` state until `store` has copied the G-code to
+`path`, are `checking` until `preflight` has run, then are
+`pending` until `run` is called on the scheduler's worker thread, or
+`rejected` if they would exceed the machine's travel.
+
+The file is read one line at a time, so jobs of any size run in constant
+memory. Progress is published to `events`, if supplied, at most every
+`DEFAULT_PROGRESS_INTERVAL` seconds and when the state changes.
+"""
+
+    def __init__(self, job_id, path, decimals=None, events=None):
+        self._id = job_id
+        self._path = path
+        self._decimals = decimals
+        self._events = events
+        self._size = 0
+        self._state = "storing"
+        self._progress = {
+            "sent": 0,
+            "acknowledged": 0,
+            "bytes": 0,
+        }
+        self._stats = {
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        self._error = None
+        self._estimate = None
+        self._bounds = None
+        self._start = None
+        self._end = None
+
+
+    def store(self, stream):
+        """\
+Copy the job's G-code from the file-like `stream` to its path.
+
+Returns the number of bytes written.
+"""
+        self._size = store(stream, self._path)
+        self._state = "checking"
+        return self._size
+
+
+    def preflight(self, settings, position=None, offsets=None):
+        """\
+Estimate the time taken to run the job with Grbl `settings`, and check
+that it stays within the machine's travel.
+
+The job is then `pending`, or `rejected` if it does not, in which case
+`PreflightException` is raised. If the G-code cannot be checked the job
+is still `pending` and `ToolpathException` is raised.
+"""
+        try:
+            with open(self._path, "rb") as fp:
+                result = preflight(fp, settings, position, offsets)
+            self._estimate = result["estimate"]
+            self._bounds = result["bounds"]
+            self._state = "pending"
+        except PreflightException as e:
+            self._error = str(e)
+            self._state = "rejected"
+            raise
+        except ToolpathException:
+            self._state = "pending"
+            raise
+        except Exception as e:
+            self._error = repr(e)
+            self._state = "failed"
+            raise
+        finally:
+            self.publish()
+
+
+    def lines(self):
+        """\
+Return the generator pipeline of lines to be streamed.
+
+Lines are compacted to reduce the bytes sent over the serial link,
+with coordinates rounded to `decimals` places per axis.
+"""
+        lines = compact(read_lines(self._path), self._decimals, self._stats)
+        if self._events:
+            lines = self._publish_progress(lines)
+        return lines
+
+
+    def _publish_progress(self, lines):
+        last = time.monotonic()
+        for line in lines:
+            yield line
+            now = time.monotonic()
+            if now - last >= DEFAULT_PROGRESS_INTERVAL:
+                self.publish()
+                last = now
+
+
+    def publish(self):
+        if self._events:
+            self._events.publish("job", self.as_dict())
+
+
+    def run(self, grbl):
+        self._state = "running"
+        self._start = time.monotonic()
+        LOG.info("Job %s started: %s", self._id, self._path)
+        self.publish()
+
+        try:
+            grbl.stream(self.lines(), self._progress)
+        except Exception as e:
+            self._error = repr(e)
+            self._state = "failed"
+            LOG.error("Job %s failed: %s", self._id, self._error)
+        else:
+            self._state = "complete"
+            LOG.info("Job %s complete. %d of %d bytes saved", self._id,
+                     self._stats["bytes_in"] - self._stats["bytes_out"],
+                     self._stats["bytes_in"])
+        finally:
+            self._end = time.monotonic()
+            self.publish()
+
+
+    def running(self):
+        return self._state in ("storing", "checking", "pending", "running")
+
+
+    def as_dict(self):
+        elapsed = None
+        if self._start is not None:
+            elapsed = (self._end or time.monotonic()) - self._start
+
+        return {
+            "id": self._id,
+            "state": self._state,
+            "size": self._size,
+            "sent": self._progress["sent"],
+            "acknowledged": self._progress["acknowledged"],
+            "bytes": self._progress["bytes"],
+            "bytes_saved": self._stats["bytes_in"] - self._stats["bytes_out"],
+            "elapsed": elapsed,
+            "estimate": self._estimate,
+            "bounds": self._bounds,
+            "error": self._error,
+        }
@@ -0,0 +1,258 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Continuous jogging.
+
+Velocity input, such as from a joystick or held keys, is turned into a
+stream of short `$J=` increments. Enough increments are queued in Grbl's
+planner to cover the distance needed to stop, so the machine keeps its
+speed, but no more, so that changes of input take effect quickly. When
+input stops the jog is cancelled with the jog cancel realtime command,
+which decelerates and discards the increments still queued.
+"""
+
+import math
+import time
+import logging
+import threading
+
+from calabo.gcode import axis_decimals, format_number
+
+
+
+# Maximum rate and acceleration settings for each axis that may be jogged.
+AXIS_KEYS = {
+    "X": (110, 120),
+    "Y": (111, 121),
+    "Z": (112, 122),
+}
+
+# Increments kept queued ahead of the machine.
+JOG_BLOCKS = 5
+
+# Shortest increment in seconds, to limit serial and planner overhead.
+MIN_JOG_INTERVAL = 0.02
+
+# Input is treated as stopped if not repeated within this many seconds.
+DEFAULT_JOG_TIMEOUT = 0.2
+
+DEFAULT_DECIMALS = 3
+
+
+
+LOG = logging.getLogger("calabo.jog")
+
+
+
+class JogException(Exception):
+    pass
+
+
+
+def jog_velocity(velocity):
+    """\
+Return `velocity` with upper case axis keys and values clamped to [-1, 1].
+
+Raises `JogException` for unknown axes or values that are not numbers.
+"""
+    if not isinstance(velocity, dict):
+        raise JogException("Jog velocity is not a dict: %s" % repr(velocity))
+
+    result = {}
+    for (axis, fraction) in velocity.items():
+        axis = str(axis).upper()
+        if axis not in AXIS_KEYS:
+            raise JogException("Unknown jog axis %s" % repr(axis))
+        try:
+            fraction = float(fraction)
+        except (TypeError, ValueError):
+            raise JogException("Jog velocity for axis %s is not a number: %s" % (
+                axis, repr(fraction)))
+        if math.isnan(fraction):
+            raise JogException("Jog velocity for axis %s is not a number" % axis)
+        result[axis] = max(-1.0, min(1.0, fraction))
+    return result
+
+
+
+def jog_increment(velocity, settings, decimals=None):
+    """\
+Return `(line, duration)` for one jog increment, or `None` if not moving.
+
+`velocity` is a dict of fractions of each axis' maximum rate, as
+returned by `jog_velocity`. `settings` is a dict of Grbl settings by key.
+
+The increment lasts long enough that `JOG_BLOCKS - 1` increments cover
+the distance needed to stop at the acceleration allowed in the direction
+of travel, and at least `MIN_JOG_INTERVAL` seconds.
+"""
+    if decimals is None:
+        decimals = {}
+
+    rates = {}
+    for (axis, fraction) in velocity.items():
+        rate = settings.get(AXIS_KEYS[axis][0])
+        if fraction and rate:
+            rates[axis] = fraction * rate
+
+    if not rates:
+        return None
+
+    # Millimeters per minute, as used by `F`.
+    feed = math.sqrt(sum(v * v for v in rates.values()))
+
+    # Each axis limits acceleration along the direction of travel.
+    accel = math.inf
+    for (axis, rate) in rates.items():
+        axis_accel = settings.get(AXIS_KEYS[axis][1])
+        if axis_accel:
+            accel = min(accel, axis_accel * feed / abs(rate))
+
+    speed = feed / 60
+    duration = max(MIN_JOG_INTERVAL, speed / (2 * accel * (JOG_BLOCKS - 1)))
+
+    words = []
+    for axis in sorted(rates):
+        distance = format_number(
+            rates[axis] / 60 * duration, decimals.get(axis, DEFAULT_DECIMALS))
+        if distance != "0":
+            words.append(axis + distance)
+
+    if not words:
+        return None
+
+    line = "$J=G91G21%sF%s" % ("".join(words), format_number(feed, 1))
+    return (line, duration)
+
+
+
+class Jogger():
+    """\
+Continuous jogging for one `Grbl` object.
+
+`update` sets the velocity and must be repeated at least every
+`timeout` seconds while input continues. `run` streams increments until
+input stops and is run by the caller, eg. on the machine's scheduler,
+whenever `update` returns `True`.
+"""
+
+    def __init__(self, grbl, timeout=None):
+        self._grbl = grbl
+        self._timeout = timeout or DEFAULT_JOG_TIMEOUT
+        self._condition = threading.Condition()
+        self._velocity = {}
+        self._deadline = None
+        self._running = False
+        self._progress = {
+            "sent": 0,
+            "acknowledged": 0,
+            "bytes": 0,
+        }
+        self._error = None
+
+
+    def update(self, velocity):
+        """\
+Set the jog velocity, a dict of fractions of each axis' maximum rate.
+
+A velocity of zero on all axes cancels the jog straight away.
+Returns `True` if a new jog must be started by calling `run`.
+"""
+        velocity = jog_velocity(velocity)
+
+        with self._condition:
+            self._velocity = velocity
+            self._deadline = time.monotonic() + self._timeout
+            self._condition.notify_all()
+
+            if not any(velocity.values()):
+                if self._running:
+                    self._grbl.realtime("jog-cancel")
+                return False
+
+            if self._running:
+                return False
+            self._running = True
+            self._error = None
+            return True
+
+
+    def stop(self):
+        self.update({})
+
+
+    def running(self):
+        return self._running
+
+
+    def lines(self):
+        """\
+Yield jog increments as they are needed until input stops.
+"""
+        settings = self._grbl._settings
+        decimals = axis_decimals(settings)
+
+        # When the increments already sent will have run out.
+        ahead = time.monotonic()
+
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    increment = None
+                    if now < self._deadline:
+                        increment = jog_increment(
+                            self._velocity, settings, decimals)
+                    if increment is None:
+                        self._grbl.realtime("jog-cancel")
+                        return
+
+                    (line, duration) = increment
+                    wait = max(ahead, now) - now - \
+                        (JOG_BLOCKS - 1) * duration
+                    if wait <= 0:
+                        break
+                    self._condition.wait(min(wait, self._deadline - now))
+
+            ahead = max(ahead, now) + duration
+            yield line
+
+
+    def run(self):
+        """\
+Stream jog increments until input stops, then cancel the jog.
+"""
+        LOG.debug("Jog started")
+        try:
+            self._grbl.stream(self.lines(), self._progress, flush=True)
+        except Exception as e:
+            self._error = repr(e)
+            LOG.warning("Jog failed: %s", self._error)
+        finally:
+            with self._condition:
+                self._running = False
+            # Increments still in Grbl's receive buffer when the jog was
+            # cancelled are planned afterwards.
+            self._grbl.realtime("jog-cancel")
+        LOG.debug("Jog stopped after %d increments", self._progress["sent"])
+
+
+    def as_dict(self):
+        return {
+            "running": self._running,
+            "velocity": self._velocity,
+            "sent": self._progress["sent"],
+            "acknowledged": self._progress["acknowledged"],
+            "error": self._error,
+        }
@@ -0,0 +1,256 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process serial loopback.
+
+`loopback_pair` returns two connected ports with the parts of the
+`serial.Serial` interface that `calabo.serial.Serial` uses, so a host
+and a simulated device can be connected without a pty.
+
+Each port reads from an OS pipe, so it has a file descriptor that works
+with `select` and asyncio just like a real serial port. Optional latency
+and bandwidth limits model a real link.
+"""
+
+import os
+import time
+import fcntl
+import struct
+import serial
+import termios
+import logging
+import threading
+from collections import deque
+
+
+
+BITS_PER_BYTE = 10
+
+
+
+LOG = logging.getLogger("calabo.loopback")
+
+
+
+class Channel():
+    """\
+One direction of a loopback link, carrying bytes into a pipe.
+
+Writes are delivered straight away unless `latency` or `baud_rate` is
+set, in which case a thread delivers each write whole once its last byte
+would have arrived. Bytes written while the reading port is closed are
+discarded.
+"""
+
+    def __init__(self, latency=None, baud_rate=None):
+        self._latency = latency or 0
+        self._byte_time = BITS_PER_BYTE / baud_rate if baud_rate else 0
+        self._lock = threading.Lock()
+        self._read_fd = None
+        self._write_fd = None
+        self._queue = deque()
+        self._queued = threading.Condition(self._lock)
+        self._free = 0
+        self._thread = None
+
+
+    def open(self):
+        with self._lock:
+            (self._read_fd, self._write_fd) = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            self._queue.clear()
+        return self._read_fd
+
+
+    def close(self):
+        with self._lock:
+            # Closing the write end first wakes readers waiting in `select`.
+            for fd in (self._write_fd, self._read_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._read_fd = None
+            self._write_fd = None
+            self._queue.clear()
+            self._queued.notify_all()
+
+
+    def send(self, data):
+        if not self._latency and not self._byte_time:
+            with self._lock:
+                self._deliver(data)
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._free = max(self._free, now) + len(data) * self._byte_time
+            self._queue.append((self._free + self._latency, data))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name="calabo-loopback")
+                self._thread.daemon = True
+                self._thread.start()
+            self._queued.notify_all()
+
+
+    def _deliver(self, data):
+        if self._write_fd is None:
+            return
+        view = memoryview(data)
+        while view:
+            written = os.write(self._write_fd, view)
+            view = view[written:]
+
+
+    def _work(self):
+        with self._lock:
+            while True:
+                if not self._queue:
+                    self._queued.wait()
+                    continue
+                (due, data) = self._queue[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._queued.wait(delay)
+                    continue
+                self._queue.popleft()
+                self._deliver(data)
+
+
+
+class LoopbackPort():
+    """\
+One end of a loopback link. Create with `loopback_pair`.
+
+Reads never block; `read` returns up to `size` bytes that have already
+arrived, like a `serial.Serial` port opened with `timeout=0`.
+
+`dtr` is wired to the other end's `dsr`. If the other end has a
+`dsr_hook`, it is called with the new value, eg. to reset a simulated
+board as an Arduino resets when DTR is asserted.
+"""
+
+    def __init__(self, name, incoming, outgoing):
+        self.name = name
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self._fd = None
+        self._peer = None
+        self._dtr = True
+        self.dsr = False
+        self.dsr_hook = None
+        self.is_open = False
+        self.open()
+
+
+    def open(self):
+        if self.is_open:
+            return
+        self._fd = self._incoming.open()
+        self.is_open = True
+
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._incoming.close()
+        self._fd = None
+
+
+    def _check_open(self):
+        if not self.is_open:
+            raise serial.serialutil.SerialException("Port is closed")
+
+
+    def fileno(self):
+        self._check_open()
+        return self._fd
+
+
+    @property
+    def in_waiting(self):
+        self._check_open()
+        try:
+            data = fcntl.ioctl(self._fd, termios.FIONREAD, b"\0\0\0\0")
+        except (TypeError, OSError):
+            raise serial.serialutil.SerialException("Port is closed")
+        return struct.unpack("I", data)[0]
+
+
+    def read(self, size=1):
+        self._check_open()
+        try:
+            data = os.read(self._fd, size)
+        except BlockingIOError:
+            return b""
+        except (TypeError, OSError):
+            raise serial.serialutil.SerialException("Port is closed")
+        if not data and size:
+            # End of file: the port was closed while waiting to read.
+            raise serial.serialutil.SerialException("Port is closed")
+        return data
+
+
+    def write(self, data):
+        self._check_open()
+        self._outgoing.send(bytes(data))
+        return len(data)
+
+
+    def reset_input_buffer(self):
+        self._check_open()
+        while True:
+            try:
+                if not os.read(self._fd, 4096):
+                    break
+            except BlockingIOError:
+                break
+
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+
+    @dtr.setter
+    def dtr(self, value):
+        self._dtr = bool(value)
+        peer = self._peer
+        changed = peer.dsr != self._dtr
+        peer.dsr = self._dtr
+        if changed and peer.dsr_hook:
+            peer.dsr_hook(self._dtr)
+
+
+    def __repr__(self):  # pragma: no cover
+        return "<LoopbackPort %s>" % self.name
+
+
+
+def loopback_pair(latency=None, baud_rate=None, names=None):
+    """\
+Return two connected `LoopbackPort` objects.
+
+`latency` is the delay in seconds before written bytes arrive and
+`baud_rate` limits throughput in each direction. Both default to none.
+"""
+    (name_a, name_b) = names or ("loopback-a", "loopback-b")
+    a_to_b = Channel(latency, baud_rate)
+    b_to_a = Channel(latency, baud_rate)
+    port_a = LoopbackPort(name_a, b_to_a, a_to_b)
+    port_b = LoopbackPort(name_b, a_to_b, b_to_a)
+    port_a._peer = port_b
+    port_b._peer = port_a
+    port_a.dsr = port_b.dsr = True
+    return (port_a, port_b)
@@ -0,0 +1,344 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import math
+import time
+import logging
+import tempfile
+import itertools
+import threading
+from concurrent.futures import TimeoutError
+
+from calabo.grbl import Grbl
+from calabo.grbl_settings import SETTINGS
+from calabo.job import Job
+from calabo.estimate import estimate
+from calabo.toolpath import ToolpathException
+from calabo.preflight import PreflightException
+from calabo.gcode import axis_decimals
+from calabo.settings import SettingsCache
+from calabo.events import EventHub
+from calabo.jog import Jogger
+from calabo.recorder import Recorder
+from calabo.scheduler import Scheduler, SchedulerStoppedException, \
+    PRIORITY_STREAM, PRIORITY_SETTINGS, PRIORITY_QUERY
+
+
+
+DEFAULT_CALL_TIMEOUT = 10.0
+
+
+
+LOG = logging.getLogger("calabo.machine")
+
+
+
+class MachineTimeoutException(Exception):
+    pass
+
+class MachineBusyException(Exception):
+    pass
+
+
+
+class Machine():
+    """\
+One Grbl device with its own command scheduler.
+
+Requests that use the serial link are run one at a time by the
+scheduler's worker thread, jobs first, then settings, then queries.
+Callers wait at most `call_timeout` seconds, so a stalled controller
+ties up only its own worker. Cached settings and status are read
+without involving the worker.
+
+If `record` is a path, serial traffic is recorded to it.
+"""
+
+    def __init__(self, machine_id, device, status_interval=None,
+                 job_dir=None, settings_cache=None, call_timeout=None,
+                 record=None):
+        if settings_cache is not None:
+            settings_cache = SettingsCache(settings_cache)
+
+        self._recorder = None
+        if record is not None:
+            self._recorder = Recorder(record)
+
+        self._id = machine_id
+        self._events = EventHub()
+        self._grbl = Grbl(
+            device, settings_cache=settings_cache, events=self._events,
+            recorder=self._recorder)
+        self._status_interval = status_interval
+        self._job_dir = job_dir
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._job_lock = threading.Lock()
+        self._call_timeout = call_timeout or DEFAULT_CALL_TIMEOUT
+        self._scheduler = Scheduler(self._grbl, name=machine_id)
+        self._jogger = Jogger(self._grbl, timeout=status_interval)
+
+
+    def __enter__(self):
+        if self._recorder:
+            self._recorder.start()
+        self._grbl.__enter__()
+        self._grbl.start_status_poller(self._status_interval)
+        self._scheduler.start()
+        return self
+
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self._jogger.stop()
+        self._scheduler.stop(self._call_timeout)
+        self._events.close()
+        self._grbl.__exit__(exception_type, exception_value, traceback)
+        if self._recorder:
+            self._recorder.stop()
+
+
+    def __repr__(self):  # pragma: no cover
+        return "<Machine %s %s>" % (self._id, self._grbl)
+
+
+    def call(self, f, *args, priority=PRIORITY_QUERY):
+        """\
+Run `f(*args)` through the scheduler and return its result.
+
+Raises `MachineTimeoutException` if the result is not ready within
+`call_timeout` seconds.
+"""
+        future = self._scheduler.submit(f, *args, priority=priority)
+        try:
+            return future.result(self._call_timeout)
+        except TimeoutError:
+            future.cancel()
+            raise MachineTimeoutException(
+                "Machine %s did not respond within %.1fs" % (
+                    self._id, self._call_timeout))
+
+
+    def settings(self, key=None, value=None, by_name=None, from_device=None):
+        if key is None:
+            if from_device:
+                self.call(self._grbl._read_settings,
+                          priority=PRIORITY_SETTINGS)
+            settings = self._grbl._settings
+            if by_name:
+                settings = {SETTINGS[k]["name"]: v for k, v in settings.items()}
+
+            return settings
+
+        if isinstance(key, dict):
+            self.call(self._grbl.write_settings, key,
+                      priority=PRIORITY_SETTINGS)
+            return None
+
+        if value is None:
+            return self._grbl._settings[key]
+
+        self.call(self._grbl.setting, key, value, priority=PRIORITY_SETTINGS)
+        return None
+
+
+    def realtime(self, command):
+        """\
+Write a realtime command straight away, bypassing the scheduler queue.
+"""
+        self._scheduler.realtime(command)
+
+
+    def status(self):
+        """\
+Return the latest machine status from the status poller's cache.
+"""
+        (_count, when, report) = self._grbl._status.snapshot()
+        if report is None:
+            self.call(self._grbl.status)
+            (_count, when, report) = self._grbl._status.snapshot()
+
+        status = report.as_dict()
+        status["age"] = time.monotonic() - when
+        return status
+
+
+    def jog(self, velocity):
+        """\
+Jog at `velocity`, a dict of fractions of each axis' maximum rate.
+
+The jog is cancelled if it is not repeated within the status interval.
+"""
+        with self._job_lock:
+            if self.job_running():
+                raise MachineBusyException(
+                    "Machine %s is running a job" % self._id)
+            if self._jogger.update(velocity):
+                self._scheduler.submit(
+                    self._jogger.run, priority=PRIORITY_STREAM)
+        return self._jogger.as_dict()
+
+
+    def jogging(self):
+        return self._jogger.running()
+
+
+    def job_running(self):
+        return any(job.running() for job in self._jobs.values())
+
+
+    def add_job(self, stream):
+        """\
+Store G-code read from the file-like `stream`, then check and stream it
+in the background.
+
+The job is checked from the machine's position once stored, and is
+rejected if it would exceed the machine's travel. Raises
+`MachineBusyException` if a job is running or the machine is jogging,
+in which case it is not stored.
+"""
+        # The job is registered before it is stored, so that concurrent
+        # requests cannot both start a job or a jog, without holding the
+        # lock while the upload is read.
+        with self._job_lock:
+            if self.job_running() or self.jogging():
+                raise MachineBusyException(
+                    "Machine %s is running a job or jogging" % self._id)
+
+            if self._job_dir is None:
+                self._job_dir = tempfile.mkdtemp(
+                    prefix="calabo-jobs-%s-" % self._id)
+            job_id = next(self._job_ids)
+
+            path = os.path.join(
+                self._job_dir, "%s-%d.gcode" % (self._id, job_id))
+            job = Job(job_id, path,
+                      decimals=axis_decimals(self._grbl._settings),
+                      events=self._events)
+            self._jobs[job_id] = job
+
+        try:
+            size = job.store(stream)
+        except Exception:
+            with self._job_lock:
+                del self._jobs[job_id]
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        LOG.info("Stored job %s/%d: %d bytes", self._id, job_id, size)
+
+        # Checking reads the whole file, so does not hold up the caller.
+        thread = threading.Thread(
+            target=self._check_job,
+            args=(job_id, path, self._start_position()),
+            name="calabo-preflight")
+        thread.daemon = True
+        thread.start()
+
+        return job.as_dict()
+
+
+    def _check_job(self, job_id, path, start):
+        """\
+Check a job from the machine position and offsets in `start`, then
+submit it to the scheduler unless it is rejected.
+"""
+        job = self._jobs[job_id]
+        try:
+            job.preflight(self._grbl._settings, *start)
+        except PreflightException as e:
+            LOG.warning("Rejected job %s/%d: %s", self._id, job_id, e)
+            os.remove(path)
+            return
+        except ToolpathException as e:
+            LOG.warning("Could not check job %s/%d: %s", self._id, job_id, e)
+        except Exception as e:
+            LOG.error("Could not check job %s/%d: %s",
+                      self._id, job_id, repr(e))
+            return
+
+        try:
+            self._scheduler.submit(
+                job.run, self._grbl, priority=PRIORITY_STREAM)
+        except SchedulerStoppedException:
+            LOG.debug("Machine %s stopped before job %d", self._id, job_id)
+
+
+
+    def _start_position(self):
+        """\
+Return the machine position and work offsets from which a job starts.
+
+Grbl reports only the offset in effect, which is taken to be that of
+`G54` after a reset. Offsets of other coordinate systems are unknown.
+"""
+        status = self.status()
+        position = status["mpos"] or (math.nan, ) * 3
+        offsets = {}
+        if status["wco"] is not None:
+            offsets[540] = status["wco"]
+        return (position, offsets)
+
+
+    def estimate(self, stream):
+        """\
+Estimate the time taken to run G-code read from the binary file-like
+`stream` with this machine's settings, without running it.
+"""
+        return estimate(stream, self._grbl._settings)
+
+
+    def job(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return job.as_dict()
+
+
+    def events(self, keepalive=None):
+        """\
+Return a generator of Server-Sent Events for one subscriber.
+
+Events come from the status poller and running jobs, so the number of
+subscribers does not affect serial traffic.
+"""
+        return self._events.stream(keepalive)
+
+
+    def end_events(self):
+        """\
+End all event streams. Clients may subscribe again.
+"""
+        self._events.close()
+
+
+    def collect_metrics(self, exposition):
+        labels = {"machine": self._id}
+        self._grbl.collect_metrics(exposition, labels)
+        exposition.gauge(
+            "calabo_scheduler_queue_depth",
+            "Commands waiting for the serial link.",
+            self._scheduler.depth(), labels)
+        exposition.gauge(
+            "calabo_job_running", "Whether a job is running.",
+            self.job_running(), labels)
+
+
+    def as_dict(self):
+        (_count, _when, report) = self._grbl._status.snapshot()
+        return {
+            "id": self._id,
+            "version": self._grbl._version,
+            "state": report.state if report else None,
+            "job_running": self.job_running(),
+        }
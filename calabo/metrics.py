@@ -0,0 +1,155 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics in Prometheus text format.
+
+Counters and histograms are plain attributes updated where the events
+happen. Everything else, such as buffer fill and queue depth, is read
+from existing state when the metrics are rendered, so there is no cost
+when nobody is scraping.
+"""
+
+import math
+import bisect
+import threading
+from collections import OrderedDict
+
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds for serial round trips.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 5.0)
+
+# Upper bounds in seconds for HTTP handlers.
+HTTP_BUCKETS = (
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 5.0, 10.0)
+
+
+
+class Histogram():
+    """\
+Counts of observations in fixed buckets, with their sum.
+"""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or LATENCY_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+    def snapshot(self):
+        """\
+Return `(cumulative, sum, count)`, where `cumulative` is a list of
+`(upper_bound, count)` ending with infinity.
+"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        cumulative = []
+        running = 0
+        for (bound, n) in zip(self.buckets + (math.inf, ), counts):
+            running += n
+            cumulative.append((bound, running))
+        return (cumulative, total, count)
+
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                     .replace("\n", "\\n"))
+        for (k, v) in labels.items())
+
+
+
+class Exposition():
+    """\
+Metric families collected for one scrape.
+
+Samples added under the same name are grouped under one `HELP` and
+`TYPE` header, in the order the names were first added.
+"""
+
+    def __init__(self):
+        self._families = OrderedDict()
+
+
+    def _family(self, name, kind, text):
+        family = self._families.get(name)
+        if family is None:
+            family = (kind, text, [])
+            self._families[name] = family
+        return family[2]
+
+
+    def counter(self, name, text, value, labels=None):
+        self._family(name, "counter", text).append(("", labels, value))
+
+
+    def gauge(self, name, text, value, labels=None):
+        self._family(name, "gauge", text).append(("", labels, value))
+
+
+    def histogram(self, name, text, histogram, labels=None):
+        samples = self._family(name, "histogram", text)
+        (cumulative, total, count) = histogram.snapshot()
+        for (bound, n) in cumulative:
+            bucket_labels = OrderedDict(labels or {})
+            bucket_labels["le"] = format_value(bound)
+            samples.append(("_bucket", bucket_labels, n))
+        samples.append(("_sum", labels, total))
+        samples.append(("_count", labels, count))
+
+
+    def render(self):
+        lines = []
+        for (name, (kind, text, samples)) in self._families.items():
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (suffix, labels, value) in samples:
+                lines.append("%s%s%s %s" % (
+                    name, suffix, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
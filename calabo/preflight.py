@@ -0,0 +1,161 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks on whole G-code files before they run.
+
+Grbl checks soft limits as each move is planned, so a job that leaves
+the machine's travel fails part way through. `preflight` finds the
+bounds of the whole toolpath in machine coordinates, and estimates its
+duration, in one pass over the file.
+
+Requires NumPy.
+"""
+
+import math
+import logging
+
+from calabo.toolpath import np, bounds, read_chunks, tokenize, line_words, \
+    require_numpy, Toolpath, AXES
+from calabo.estimate import setting, Estimator
+
+
+
+SOFT_LIMITS_KEY = 20
+MAX_TRAVEL_KEYS = (130, 131, 132)
+
+
+
+LOG = logging.getLogger("calabo.preflight")
+
+
+
+class PreflightException(Exception):
+    pass
+
+
+
+def travel_limits(settings):
+    """\
+Return the lowest and highest machine positions allowed on each axis.
+
+As Grbl homes to the positive end of each axis, machine positions run
+from minus the maximum travel to zero.
+"""
+    travel = np.array(
+        [setting(settings, k) for k in MAX_TRAVEL_KEYS], dtype=float)
+    return (-travel, np.zeros(len(travel)))
+
+
+
+class Bounds():
+    """\
+The lowest and highest machine positions reached by moves added in
+chunks, `NaN` where unknown.
+
+`unknown` marks the axes on which any position is unknown, such as
+after `G28` or in a coordinate system with an unknown offset, so that
+the bounds are incomplete.
+"""
+
+    def __init__(self):
+        require_numpy()
+        self.lower = np.full(len(AXES), np.nan)
+        self.upper = np.full(len(AXES), np.nan)
+        self.unknown = np.zeros(len(AXES), dtype=bool)
+
+
+    def add(self, moves):
+        (lower, upper) = bounds(moves)
+        self.lower = np.fmin(self.lower, lower)
+        self.upper = np.fmax(self.upper, upper)
+        for array in (moves.start, moves.end):
+            self.unknown |= np.isnan(array).any(axis=0)
+
+
+    def check(self, settings):
+        """\
+Raise `PreflightException` if the bounds exceed the travel limits in
+Grbl `settings`.
+"""
+        (lower, upper) = travel_limits(settings)
+        errors = []
+        for (i, axis) in enumerate(AXES):
+            if self.lower[i] < lower[i]:
+                errors.append("%s to %.3f is below %.3f" % (
+                    axis, self.lower[i], lower[i]))
+            if self.upper[i] > upper[i]:
+                errors.append("%s to %.3f is above %.3f" % (
+                    axis, self.upper[i], upper[i]))
+        if errors:
+            raise PreflightException(
+                "Job exceeds machine travel: %s" % "; ".join(errors))
+
+        if self.unknown.any():
+            LOG.warning(
+                "Travel not checked on %s: positions unknown",
+                ", ".join(axis for (i, axis) in enumerate(AXES)
+                          if self.unknown[i]))
+
+
+    def as_dict(self):
+        return {
+            axis.lower(): [
+                None if self.unknown[i] or math.isnan(value)
+                else float(value)
+                for value in (self.lower[i], self.upper[i])
+            ]
+            for (i, axis) in enumerate(AXES)
+        }
+
+
+
+def preflight(fp, settings=None, position=None, offsets=None,
+              chunk_size=None):
+    """\
+Check the G-code read from the binary file-like `fp` before running it
+on a Grbl controller with `settings`.
+
+`position` is the machine position and `offsets` the work coordinate
+offsets at the start, as for `Toolpath`.
+
+Returns a dict of the `estimate` and the `bounds` of the toolpath in
+machine coordinates as a list of the lowest and highest position on
+each axis, `None` where any position on the axis is unknown.
+
+Raises `PreflightException` if soft limits are enabled and the toolpath
+leaves the machine's travel, and `ToolpathException` if the G-code
+cannot be parsed or NumPy is not installed. Axes on which positions are
+unknown are only checked where they are known, with a warning.
+"""
+    settings = settings or {}
+    estimator = Estimator(settings)
+    result = Bounds()
+
+    # Durations do not depend on work offsets, so are estimated even if
+    # the offsets are unknown.
+    toolpath = Toolpath()
+    machine_toolpath = Toolpath(position, offsets)
+    for data in read_chunks(fp, chunk_size):
+        (lines, line, letter, value) = tokenize(data)
+        words = line_words(lines, line, letter, value)
+        estimator.add(toolpath.moves(lines, words))
+        result.add(machine_toolpath.moves(lines, words))
+
+    if setting(settings, SOFT_LIMITS_KEY):
+        result.check(settings)
+
+    return {
+        "estimate": estimator.finish(),
+        "bounds": result.as_dict(),
+    }
@@ -0,0 +1,276 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serial traffic recording and replay.
+
+A `Recorder` stores raw bytes read from and written to a serial port
+with the time they were transferred. Recording only appends to an
+in-memory ring buffer; a background thread writes the buffer to disk.
+
+A `ReplayPort` plays the device side of a recording back to a `Serial`
+object in place of a real port, with the same timing.
+"""
+
+import time
+import struct
+import logging
+import threading
+from collections import deque
+
+
+
+READ = 0
+WRITE = 1
+
+MAGIC = b"CALABOREC"
+VERSION = 1
+
+# Version and wall clock start time.
+HEADER = struct.Struct("<Bd")
+
+# Microseconds since start, direction and data length.
+RECORD = struct.Struct("<QBH")
+MAX_RECORD_DATA = 0xffff
+
+DEFAULT_CAPACITY = 65536
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+
+
+LOG = logging.getLogger("calabo.recorder")
+
+
+
+class RecordingException(Exception):
+    pass
+
+
+
+class Recorder():
+    """\
+Record serial traffic to the file at `path`.
+
+Up to `capacity` transfers are buffered in memory. If the writer thread
+falls behind, the oldest are dropped rather than slowing the serial link.
+"""
+
+    def __init__(self, path, capacity=None, flush_interval=None):
+        self._path = path
+        self._records = deque(maxlen=capacity or DEFAULT_CAPACITY)
+        self._flush_interval = flush_interval or DEFAULT_FLUSH_INTERVAL
+        self._start = None
+        self._fp = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._recorded = 0
+        self._written = 0
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+
+    def start(self):
+        self._fp = open(self._path, "wb")
+        self._fp.write(MAGIC + HEADER.pack(VERSION, time.time()))
+        self._start = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._work, name="calabo-recorder")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._flush()
+        self._fp.close()
+        self._fp = None
+
+        dropped = self._recorded - self._written
+        if dropped:
+            LOG.warning("Recording %s dropped %d transfers",
+                        self._path, dropped)
+
+
+    def record(self, direction, data):
+        """\
+Record `data` transferred in `direction`, `READ` or `WRITE`.
+"""
+        if self._start is None:
+            return
+        self._records.append((time.monotonic(), direction, data))
+        self._recorded += 1
+
+
+    def _work(self):
+        while not self._stop.wait(self._flush_interval):
+            self._flush()
+
+
+    def _flush(self):
+        chunks = []
+        while True:
+            try:
+                (when, direction, data) = self._records.popleft()
+            except IndexError:
+                break
+            micros = int((when - self._start) * 1e6)
+            for i in range(0, len(data), MAX_RECORD_DATA):
+                part = data[i:i + MAX_RECORD_DATA]
+                chunks.append(RECORD.pack(micros, direction, len(part)))
+                chunks.append(part)
+            self._written += 1
+
+        if chunks:
+            self._fp.write(b"".join(chunks))
+            self._fp.flush()
+
+
+
+def read_records(path):
+    """\
+Yield `(time, direction, data)` for each transfer in the recording at
+`path`, with `time` in seconds from the start of the recording.
+"""
+    with open(path, "rb") as fp:
+        header = fp.read(len(MAGIC) + HEADER.size)
+        if not header.startswith(MAGIC) or len(header) < len(MAGIC) + HEADER.size:
+            raise RecordingException("Not a Calabó recording: %s" % path)
+        (version, _wall_time) = HEADER.unpack(header[len(MAGIC):])
+        if version != VERSION:
+            raise RecordingException(
+                "Unsupported recording version %d: %s" % (version, path))
+
+        while True:
+            head = fp.read(RECORD.size)
+            if not head:
+                break
+            if len(head) < RECORD.size:
+                raise RecordingException("Truncated recording: %s" % path)
+            (micros, direction, size) = RECORD.unpack(head)
+            data = fp.read(size)
+            if len(data) < size:
+                raise RecordingException("Truncated recording: %s" % path)
+            yield (micros / 1e6, direction, data)
+
+
+
+class ReplayPort():
+    """\
+Stand-in for a `serial.Serial` port that replays the device side of a
+recording.
+
+Bytes the device sent become readable after the same delay they had
+after the preceding write in the recording, so response timing is
+reproduced even if the host is slower or faster than when recording.
+Writes are matched against the recorded writes; differences are counted
+in `mismatches` and logged.
+
+Status requests from a poller are timed independently of other traffic,
+so recordings replay most faithfully with the poller disabled.
+"""
+
+    def __init__(self, records):
+        if isinstance(records, str):
+            records = read_records(records)
+        self._records = deque(records)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._anchor = None
+        self.mismatches = 0
+        self.is_open = True
+
+
+    def _advance(self):
+        """\
+Move device output that is now due into the read buffer.
+"""
+        now = time.monotonic()
+        if self._anchor is None:
+            self._anchor = (0.0, now)
+        (recorded, actual) = self._anchor
+
+        records = self._records
+        while records and records[0][1] == READ and \
+              actual + records[0][0] - recorded <= now:
+            self._buffer += records.popleft()[2]
+
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._advance()
+            return len(self._buffer)
+
+
+    def read(self, size=1):
+        with self._lock:
+            self._advance()
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+
+    def write(self, data):
+        with self._lock:
+            self._advance()
+            records = self._records
+
+            # Output the device sent before this write is delivered now.
+            while records and records[0][1] == READ:
+                self._buffer += records.popleft()[2]
+
+            expected = bytearray()
+            when = None
+            while records and records[0][1] == WRITE and \
+                  len(expected) < len(data):
+                (when, _direction, recorded) = records.popleft()
+                expected += recorded
+
+            if bytes(expected) != bytes(data):
+                self.mismatches += 1
+                LOG.debug("Replay write %r does not match recorded %r",
+                          data, bytes(expected))
+
+            if when is not None:
+                self._anchor = (when, time.monotonic())
+
+        return len(data)
+
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._buffer.clear()
+
+
+    def done(self):
+        """\
+Return `True` once every recorded transfer has been replayed.
+"""
+        with self._lock:
+            return not self._records and not self._buffer
+
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,141 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Command scheduling for a Grbl link.
+
+All line-based commands for one device run on a single worker thread, in
+priority order and first come first served within a priority. Realtime
+commands are single bytes that Grbl acts on as soon as they arrive, so
+they are written straight away.
+"""
+
+import queue
+import logging
+import itertools
+import threading
+from concurrent.futures import Future
+
+
+
+# Lower numbers run first.
+PRIORITY_STREAM = 0
+PRIORITY_SETTINGS = 1
+PRIORITY_QUERY = 2
+
+# Stops the worker ahead of any pending command.
+PRIORITY_STOP = -1
+
+
+
+LOG = logging.getLogger("calabo.scheduler")
+
+
+
+class SchedulerStoppedException(Exception):
+    pass
+
+
+
+class Scheduler():
+    """\
+Priority command queue in front of one `Grbl` object.
+"""
+
+    def __init__(self, grbl, name=None):
+        self._grbl = grbl
+        self._name = name
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker = None
+        self._stopped = False
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+
+    def start(self):
+        self._stopped = False
+        self._worker = threading.Thread(
+            target=self._work, name="calabo-scheduler-%s" % self._name)
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def stop(self, timeout=None):
+        """\
+Stop the worker once the current command finishes.
+
+Commands still queued are cancelled.
+"""
+        if not self._worker:
+            return
+        self._stopped = True
+        self._queue.put((PRIORITY_STOP, next(self._sequence), None, None, None))
+        self._worker.join(timeout)
+        self._worker = None
+
+        while True:
+            try:
+                (_, _, future, _, _) = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if future:
+                future.cancel()
+
+
+    def _work(self):
+        while True:
+            (priority, _, future, f, args) = self._queue.get()
+            if priority == PRIORITY_STOP:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(f(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
+    def submit(self, f, *args, priority=PRIORITY_QUERY):
+        """\
+Queue `f(*args)` and return a `Future` for its result.
+"""
+        if self._stopped:
+            raise SchedulerStoppedException(
+                "Scheduler %s is stopped" % self._name)
+
+        future = Future()
+        self._queue.put((priority, next(self._sequence), future, f, args))
+        return future
+
+
+    def depth(self):
+        """\
+Return the approximate number of commands waiting to run.
+"""
+        return self._queue.qsize()
+
+
+    def realtime(self, command):
+        """\
+Write a realtime command immediately, ahead of any queued command.
+"""
+        self._grbl.realtime(command)
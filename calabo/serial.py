@@ -12,10 +12,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import io
+import re
 import time
+import select
 import serial
 import logging
+import threading
 
+from calabo.recorder import READ, WRITE
 
 
 DEFAULT_READ_LINE_TIMEOUT = 0.002
@@ -23,6 +27,14 @@ DEFAULT_READ_LINE_INTERVAL = 0.001
 DEFAULT_BAUD_RATE = 115200
 DEFAULT_EOL = "\n"
 
+# `select` waits on the port's file descriptor and wakes as soon as
+# bytes arrive. `poll` checks `in_waiting` every `interval` seconds and
+# is used for ports without a file descriptor.
+READ_MODES = ("select", "poll")
+
+CR = ord("\r")
+LF = ord("\n")
+
 
 
 LOG = logging.getLogger("calabo.serial")
@@ -35,19 +47,56 @@ class ConnectionClosedException(Exception):
 
 
 class Serial():
-    def __init__(self, device, name=None, write_eol=None, realtime_hooks=None):
+    """\
+Line-based access to a serial port.
+
+`port` is an optional object with the `serial.Serial` interface, such
+as a `ReplayPort` or `LoopbackPort`, to use instead of opening
+`device`. `recorder` is an optional `Recorder` to which all bytes read
+and written are passed.
+"""
+
+    def __init__(self, device, name=None, write_eol=None, realtime_hooks=None,
+                 read_mode=None, port=None, recorder=None):
         self._device = device
         self._name = name or device
         self._ser = None
+        self._port = port
+        self._recorder = recorder
+        self._read_mode = read_mode
         self._write_eol = write_eol or DEFAULT_EOL
         self._hooks = realtime_hooks
 
-        self._line = ""
-        self._last_char = ""
+        # Realtime hook characters are matched as single raw bytes.
+        self._hook_bytes = {}
+        if realtime_hooks:
+            self._hook_bytes = {
+                ord(k.encode("latin-1")): v for k, v in realtime_hooks.items()}
+        self._re_delimiter = re.compile(
+            b"[" + re.escape(bytes([CR, LF] + list(self._hook_bytes))) + b"]")
+
+        self._buffer = bytearray()
+        self._last_cr = False
+
+        # Realtime commands may be written from other threads.
+        self._write_lock = threading.Lock()
+
+        # Traffic counters, read by metrics.
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lines_read = 0
+        self.lines_written = 0
 
 
     def __enter__(self):
-        self._ser = serial.Serial(self._device, DEFAULT_BAUD_RATE)
+        if self._port is not None:
+            self._ser = self._port
+            if not getattr(self._ser, "is_open", True):
+                self._ser.open()
+        else:
+            self._ser = serial.Serial(self._device, DEFAULT_BAUD_RATE)
+        if self._read_mode is None:
+            self._read_mode = "select" if hasattr(self._ser, "fileno") else "poll"
         return self
 
 
@@ -55,60 +104,188 @@ class Serial():
         self._ser.close()
 
 
-    def write_line(self, line):
-        LOG.debug("Serial write %s %s", self._name, repr(line))
+    def _write(self, data, lines=0):
         try:
-            self._ser.write((line + self._write_eol).encode("utf-8"))
+            with self._write_lock:
+                self._ser.write(data)
+                self.bytes_written += len(data)
+                self.lines_written += lines
+                if self._recorder:
+                    self._recorder.record(WRITE, data)
         except (TypeError, serial.serialutil.SerialException):
             raise ConnectionClosedException()
 
 
+    def write_line(self, line):
+        LOG.debug("Serial write %s %r", self._name, line)
+        self._write((line + self._write_eol).encode("utf-8"), 1)
+
+
+    def write_lines(self, lines):
+        """\
+Write several lines to the port in a single call.
+"""
+        data = "".join(line + self._write_eol for line in lines)
+        LOG.debug("Serial write %s %r", self._name, data)
+        self._write(data.encode("utf-8"), len(lines))
+
+
+    def write_realtime(self, char):
+        """\
+Write a single realtime command character, bypassing line handling.
+"""
+        LOG.debug("Serial write %s %r", self._name, char)
+        self._write(char.encode("latin-1"))
+
+
+    def discard_input(self):
+        """\
+Discard buffered input that has not yet been read as lines.
+"""
+        self._buffer.clear()
+        self._last_cr = False
+        try:
+            self._ser.reset_input_buffer()
+        except (AttributeError, serial.serialutil.SerialException):
+            raise ConnectionClosedException()
+
+
+    def line_size(self, line):
+        """\
+Return the number of bytes `line` occupies on the wire, including EOL.
+"""
+        return len((line + self._write_eol).encode("utf-8"))
+
+
+    def _extract(self):
+        """\
+Remove and return the next complete line or realtime hook from the buffer.
+
+Returns `None` if the buffer holds no complete line.
+"""
+        buf = self._buffer
+        while True:
+            match = self._re_delimiter.search(buf)
+            if match is None:
+                return None
+
+            i = match.start()
+            byte = buf[i]
+
+            if byte == LF and i == 0 and self._last_cr:
+                # Second half of `CRLF`.
+                del buf[0]
+                self._last_cr = False
+                continue
+
+            if byte in (CR, LF):
+                line = buf[:i].decode("utf-8", errors="replace")
+                del buf[:i + 1]
+                self._last_cr = (byte == CR)
+                self.lines_read += 1
+                LOG.debug("Serial read %s %r", self._name, line)
+                return line
+
+            del buf[i]
+            return self._hook_bytes[byte]
+
+
+    def feed(self, data):
+        """\
+Add bytes received outside `read_line`, eg. by an asyncio transport.
+
+Returns a list of the complete lines and hooks now available.
+"""
+        self._buffer += data
+        self.bytes_read += len(data)
+        if self._recorder:
+            self._recorder.record(READ, data)
+        responses = []
+        while True:
+            response = self._extract()
+            if response is None:
+                return responses
+            responses.append(response)
+
+
+    def _wait(self, timeout, interval):
+        """\
+Wait up to `timeout` seconds, or indefinitely if `None`, for input.
+
+Returns `False` if the timeout expired with no input waiting.
+"""
+        if self._read_mode == "select":
+            try:
+                (ready, _, _) = select.select([self._ser.fileno()], [], [], timeout)
+            except (TypeError, ValueError, OSError,
+                    serial.serialutil.SerialException):
+                raise ConnectionClosedException()
+            return bool(ready)
+
+        if timeout is not None:
+            interval = min(interval, timeout)
+        time.sleep(interval)
+        return True
+
+
     def read_line(self, timeout=None, interval=None):
         """\
 Accepts `CR`, `LF`, or `CRLF`.
 
 Returns a line without line endings, a callable hook function, or `None` on timeout.
+
+`timeout` is the time in seconds to wait for a complete line, measured
+on the monotonic clock, or `False` to wait indefinitely. `interval` is
+the polling interval used in `poll` read mode.
+
+All bytes waiting on the port are read at once and complete lines are
+split out of the buffer, so several lines may be returned by
+successive calls without touching the port.
 """
         if timeout is None:
             timeout = DEFAULT_READ_LINE_TIMEOUT
         if interval is None:
             interval = DEFAULT_READ_LINE_INTERVAL
 
-        elapsed = 0
+        deadline = None
+        if timeout is not False:
+            deadline = time.monotonic() + timeout
+
         while True:
+            response = self._extract()
+            if response is not None:
+                return response
+
             try:
                 waiting = self._ser.in_waiting
-            except TypeError:
+            except (TypeError, serial.serialutil.SerialException):
                 raise ConnectionClosedException()
 
             if not waiting:
-                time.sleep(interval)
-                elapsed += interval
-
-                if timeout is not False and elapsed >= timeout:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                if not self._wait(remaining, interval):
                     break
+                if self._read_mode != "select":
+                    continue
+                # Readable but nothing counted as waiting: read one byte,
+                # which also surfaces a closed port as an exception.
+                waiting = 1
 
             try:
-                char = self._ser.read().decode("utf-8")
+                data = self._ser.read(waiting)
             except (TypeError, serial.serialutil.SerialException):
                 raise ConnectionClosedException()
+            self._buffer += data
+            self.bytes_read += len(data)
+            if self._recorder:
+                self._recorder.record(READ, data)
 
-            if char in "\r\n":
-                last_pair = self._last_char + char
-                self._last_char = char
-                if last_pair == "\r\n":
-                    pass
-                else:
-                    LOG.debug("Serial read %s %s", self._name, repr(self._line))
-                    response = self._line
-                    self._line = ""
-                    return response
-            elif self._hooks and char in self._hooks:
-                return self._hooks[char]
-            else:
-                self._line += char
-
-        LOG.debug("Serial timeout %s %s %s", self._name, timeout, self._line)
+        LOG.debug("Serial timeout %s %s %s", self._name, timeout,
+                  repr(bytes(self._buffer)))
         return None
 
 
@@ -0,0 +1,100 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+import logging
+
+from serial.tools import list_ports
+
+from calabo.grbl_settings import SETTINGS
+
+
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "calabo")
+
+
+
+LOG = logging.getLogger("calabo.settings")
+
+
+
+def device_identity(address):
+    """\
+Return a string identifying the device at `address`.
+
+USB devices are identified by vendor, product and serial number so that
+the identity survives the device being given a different port.
+"""
+    path = os.path.realpath(address)
+    for port in list_ports.comports():
+        if os.path.realpath(port.device) == path and port.serial_number:
+            return "usb:%04x:%04x:%s" % (port.vid, port.pid, port.serial_number)
+    return path
+
+
+
+class SettingsCache():
+    """\
+Snapshots of Grbl settings stored on disk.
+
+Each snapshot is keyed by device identity and firmware version, so a
+different board or a reflashed one is never given stale settings.
+"""
+
+    def __init__(self, path=None):
+        self._path = os.path.expanduser(path or DEFAULT_CACHE_DIR)
+
+
+    def _filename(self, identity, version):
+        key = hashlib.sha1(("%s\n%s" % (identity, version)).encode("utf-8"))
+        return os.path.join(self._path, "settings-%s.json" % key.hexdigest())
+
+
+    def load(self, identity, version):
+        """\
+Return the cached settings dict, or `None` if there is no complete snapshot.
+"""
+        try:
+            with open(self._filename(identity, version)) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        settings = {int(k): v for k, v in data["settings"].items()}
+        if set(settings) != set(SETTINGS):
+            return None
+
+        LOG.debug("Loaded settings snapshot for %s %s", identity, version)
+        return settings
+
+
+    def save(self, identity, version, settings):
+        os.makedirs(self._path, exist_ok=True)
+        path = self._filename(identity, version)
+        with open(path + ".tmp", "w") as fp:
+            json.dump({
+                "identity": identity,
+                "version": version,
+                "settings": settings,
+            }, fp, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+        LOG.debug("Saved settings snapshot for %s %s", identity, version)
+
+
+    def invalidate(self, identity, version):
+        try:
+            os.remove(self._filename(identity, version))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,206 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging
+import threading
+
+from calabo.grbl_settings import STATES
+
+
+
+LOG = logging.getLogger("calabo.status")
+
+
+
+class StatusException(Exception):
+    pass
+
+
+
+class StatusReport():
+    """\
+A parsed Grbl status report.
+
+Positions are tuples of floats in millimeters, or `None` if unknown.
+`planner_blocks` and `rx_bytes` are the free planner blocks and serial
+receive buffer bytes reported in `Bf:`. `overrides` is a tuple of feed,
+rapid and spindle override percentages.
+"""
+
+    __slots__ = (
+        "state",
+        "substate",
+        "mpos",
+        "wpos",
+        "wco",
+        "feed",
+        "speed",
+        "planner_blocks",
+        "rx_bytes",
+        "line",
+        "overrides",
+        "pins",
+        "accessories",
+    )
+
+
+    def __init__(self, state, substate=None):
+        self.state = state
+        self.substate = substate
+        self.mpos = None
+        self.wpos = None
+        self.wco = None
+        self.feed = None
+        self.speed = None
+        self.planner_blocks = None
+        self.rx_bytes = None
+        self.line = None
+        self.overrides = None
+        self.pins = None
+        self.accessories = None
+
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+    def __repr__(self):  # pragma: no cover
+        return "<StatusReport %s>" % self.state
+
+
+
+class StatusParser():
+    """\
+Single-pass parser for Grbl 1.1 status reports.
+
+Grbl only includes `WCO:` and `Ov:` in some reports, so the most recent
+values are carried forward into reports that omit them, and whichever of
+`MPos` and `WPos` was not reported is derived using the work offset.
+"""
+
+    def __init__(self):
+        self._wco = None
+        self._overrides = None
+
+
+    def parse(self, text):
+        if not text.startswith("<"):
+            raise StatusException(
+                "State does not start with <: %s" % repr(text))
+        if not text.endswith(">"):
+            raise StatusException(
+                "State does not end with >: %s" % repr(text))
+
+        fields = text[1:-1].split("|")
+
+        (state, _, substate) = fields[0].partition(":")
+        if state not in STATES:
+            raise StatusException("Unrecognised state %s in text %s" % (
+                repr(state), repr(text)))
+
+        field = fields[0]
+        try:
+            report = StatusReport(state, int(substate) if substate else None)
+
+            for field in fields[1:]:
+                (name, _, value) = field.partition(":")
+                if name == "MPos":
+                    report.mpos = tuple(map(float, value.split(",")))
+                elif name == "WPos":
+                    report.wpos = tuple(map(float, value.split(",")))
+                elif name == "Bf":
+                    (blocks, _, rx_bytes) = value.partition(",")
+                    report.planner_blocks = int(blocks)
+                    report.rx_bytes = int(rx_bytes)
+                elif name == "FS":
+                    (feed, _, speed) = value.partition(",")
+                    report.feed = float(feed)
+                    report.speed = float(speed)
+                elif name == "F":
+                    report.feed = float(value)
+                elif name == "WCO":
+                    self._wco = tuple(map(float, value.split(",")))
+                elif name == "Ov":
+                    self._overrides = tuple(map(int, value.split(",")))
+                elif name == "Ln":
+                    report.line = int(value)
+                elif name == "Pn":
+                    report.pins = value
+                elif name == "A":
+                    report.accessories = value
+                else:
+                    LOG.debug("Unrecognised status field %s", repr(field))
+        except ValueError:
+            raise StatusException("Malformed status field %s in text %s" % (
+                repr(field), repr(text)))
+
+        wco = self._wco
+        report.wco = wco
+        report.overrides = self._overrides
+
+        if wco is not None:
+            if report.wpos is None and report.mpos is not None:
+                report.wpos = tuple(m - o for (m, o) in zip(report.mpos, wco))
+            elif report.mpos is None and report.wpos is not None:
+                report.mpos = tuple(w + o for (w, o) in zip(report.wpos, wco))
+
+        return report
+
+
+
+class StatusCache():
+    """\
+Thread-safe holder for the most recent Grbl status report.
+
+Reports are replaced, never modified, so a report returned by
+`snapshot` may be used without further locking.
+"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._report = None
+        self._time = None
+        self._count = 0
+
+
+    def update(self, report):
+        with self._condition:
+            self._report = report
+            self._time = time.monotonic()
+            self._count += 1
+            self._condition.notify_all()
+
+
+    def snapshot(self):
+        """\
+Return `(count, time, report)` for the latest report.
+
+`count` increases by one with every update and `time` is on the
+monotonic clock. `report` is `None` before the first update.
+"""
+        with self._condition:
+            return (self._count, self._time, self._report)
+
+
+    def wait(self, count, timeout=None):
+        """\
+Wait for a report newer than `count`.
+
+Returns the new snapshot, or `None` on timeout.
+"""
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._count > count, timeout):
+                return None
+            return (self._count, self._time, self._report)
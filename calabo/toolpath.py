@@ -0,0 +1,644 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Vectorized G-code parsing.
+
+Whole files are analysed before they are streamed, so parsing works on
+chunks of whole lines with NumPy array operations instead of Python
+code per line. Words are split out and their numbers converted on the
+raw bytes of the chunk, modal state is carried forward through the chunk
+by accumulation, and positions are cumulative sums of relative moves
+reset at each absolute one.
+
+The result for each chunk is a `Moves` object with the start and end of
+every move in machine coordinates. Only the G-code that Grbl supports is
+recognised; other words are ignored.
+
+Requires NumPy.
+"""
+
+import math
+import logging
+import itertools
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+
+# Small chunks keep the temporary arrays for each one cheap to allocate.
+DEFAULT_CHUNK_SIZE = 128 * 1024
+
+AXES = "XYZ"
+
+# Words kept for each line, by letter.
+LINE_WORDS = "FIJKLPRXYZ"
+
+# G commands by modal group, as ten times their number.
+G_GROUPS = {
+    "motion": (0, 10, 20, 30, 382, 383, 384, 385, 800),
+    "plane": (170, 180, 190),
+    "units": (200, 210),
+    "distance": (900, 910),
+    "feed": (930, 940),
+    "coordinates": (540, 550, 560, 570, 580, 590),
+    "non_modal": (40, 100, 280, 281, 300, 301, 530, 920, 921),
+}
+
+# Modal state at power on.
+DEFAULT_MODES = {
+    "motion": 0,
+    "plane": 170,
+    "units": 210,
+    "distance": 900,
+    "feed": 940,
+    "coordinates": 540,
+}
+
+FEED_MOTION = (10, 20, 30, 382, 383, 384, 385)
+
+# Non-modal commands whose axis words are not a move.
+AXIS_NON_MODAL = (100, 920)
+
+# Non-modal commands that move through the point given by their axis
+# words, if any, to a position stored on the controller.
+HOME_NON_MODAL = (280, 300)
+
+# Non-modal commands that change work coordinate offsets.
+OFFSET_NON_MODAL = (100, 920, 921)
+
+# Non-modal commands after which Grbl waits for motion to stop.
+SYNC_NON_MODAL = (40, 100, 280, 300)
+
+# Indices of the first arc axis, second arc axis and linear axis.
+PLANE_AXES = {
+    170: (0, 1, 2),
+    180: (2, 0, 1),
+    190: (1, 2, 0),
+}
+
+# As Grbl's `ARC_ANGULAR_TRAVEL_EPSILON`.
+ARC_EPSILON = 5e-7
+
+MM_PER_INCH = 25.4
+
+POWERS_OF_TEN = 10.0 ** np.arange(23) if np else None
+
+# Running counts within a chunk, which is far smaller than 2GiB.
+COUNT = "int32"
+
+NEWLINE = ord("\n")
+WHITESPACE = b" \t\r"
+SKIP_LINE = (ord("$"), ord("%"))
+SKIP_CHARS = (b"$", b"%", b"(", b";")
+
+
+
+LOG = logging.getLogger("calabo.toolpath")
+
+
+
+class ToolpathException(Exception):
+    pass
+
+
+
+def require_numpy():
+    if np is None:
+        raise ToolpathException("G-code analysis requires NumPy")
+
+
+
+def read_chunks(fp, chunk_size=None):
+    """\
+Yield chunks of bytes read from the binary file-like `fp` that each end
+with a complete line.
+"""
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    remainder = b""
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        data = remainder + data
+        end = data.rfind(b"\n") + 1
+        if not end:
+            remainder = data
+            continue
+        remainder = data[end:]
+        yield data[:end]
+
+    if remainder:
+        yield remainder + b"\n"
+
+
+
+def _line_starts(is_newline):
+    return np.concatenate(([0], np.flatnonzero(is_newline)[:-1] + 1))
+
+
+
+def _relative_count(flags, starts, line_of):
+    """\
+Return a running count of `flags` since the start of each byte's line.
+"""
+    counts = np.cumsum(flags, dtype=COUNT)
+    before = counts[starts] - flags[starts]
+    return counts - before[line_of]
+
+
+
+def _powers(exponents):
+    """\
+Return powers of ten, exact up to the 22nd.
+"""
+    if len(exponents) and exponents.max() >= len(POWERS_OF_TEN):
+        return 10.0 ** exponents
+    return POWERS_OF_TEN[exponents]
+
+
+
+def _error_line(c, index):
+    return int(np.count_nonzero(c[:index] == NEWLINE)) + 1
+
+
+
+def tokenize(data):
+    """\
+Split `data`, bytes ending with a newline, into words.
+
+Returns `(lines, line, letter, value)`: the number of lines, and for
+each word its line index, letter index from `A` and number. Comments,
+whitespace and lines starting with `$` or `%` are skipped.
+
+Raises `ToolpathException` for text that is not a sequence of words.
+"""
+    data = data.upper().translate(None, WHITESPACE)
+    c = np.frombuffer(data, dtype=np.uint8)
+    is_newline = c == NEWLINE
+    lines = int(np.count_nonzero(is_newline))
+
+    if any(char in data for char in SKIP_CHARS):
+        c_line = np.cumsum(is_newline, dtype=COUNT) - is_newline
+        starts = _line_starts(is_newline)
+        skip = np.isin(c[starts], SKIP_LINE)[c_line]
+
+        # Parenthesis comments and everything after a semicolon.
+        opened = _relative_count(c == ord("("), starts, c_line)
+        closing = c == ord(")")
+        closed = _relative_count(closing, starts, c_line) - closing
+        skip |= opened > closed
+        skip |= _relative_count(c == ord(";"), starts, c_line) > 0
+
+        keep = ~skip | is_newline
+        c = c[keep]
+        is_newline = is_newline[keep]
+
+    is_letter = (c >= ord("A")) & (c <= ord("Z"))
+    is_digit = (c >= ord("0")) & (c <= ord("9"))
+    is_dot = c == ord(".")
+    is_sign = (c == ord("-")) | (c == ord("+"))
+    boundary = is_letter | is_newline
+
+    # Every byte belongs to the token of the letter or newline before it.
+    token = np.cumsum(boundary, dtype=COUNT) - 1
+    token_start = np.flatnonzero(boundary)
+    token_end = np.append(token_start[1:], len(c))
+    token_letter = is_letter[token_start]
+    tokens = len(token_start)
+
+    bad = ~(boundary | is_digit | is_dot | is_sign)
+    if len(c) and not boundary[0]:
+        bad[0] = True
+    # Numbers must follow a letter, with any sign first.
+    bad[token_start[~token_letter & (token_end - token_start > 1)] + 1] = True
+    sign_index = np.flatnonzero(is_sign)
+    sign_token = token[sign_index]
+    bad[sign_index[sign_index != token_start[sign_token] + 1]] = True
+    if bad.any():
+        raise ToolpathException(
+            "Could not parse G-code line %d" % _error_line(c, np.argmax(bad)))
+
+    # Tokens hold only a letter, a sign, digits and decimal points.
+    dot_index = np.flatnonzero(is_dot)
+    dot_token = token[dot_index]
+    dots = np.bincount(dot_token, minlength=tokens)
+    digits = token_end - token_start - 1 - dots
+    digits[sign_token] -= 1
+    bad = token_letter & ((digits == 0) | (dots > 1))
+    if bad.any():
+        raise ToolpathException(
+            "Could not parse G-code line %d" %
+            _error_line(c, token_start[np.argmax(bad)]))
+
+    # Digits are summed by place value, then scaled by the decimal places.
+    dot = token_start.copy()
+    dot[dot_token] = dot_index
+    places = np.where(dots > 0, token_end - dot - 1, 0)
+    digit_index = np.flatnonzero(is_digit)
+    digit_token = token[digit_index]
+    place = token_end[digit_token] - 1 - digit_index
+    place -= digit_index < dot[digit_token]
+    mantissa = np.bincount(
+        digit_token, weights=(c[digit_index] - ord("0")) * _powers(place),
+        minlength=tokens)
+    value = mantissa / _powers(places)
+    negative = sign_token[c[sign_index] == ord("-")]
+    value[negative] = -value[negative]
+
+    # Lines are counted by the newline tokens before each word.
+    is_end = ~token_letter
+    token_line = np.cumsum(is_end, dtype=COUNT) - is_end
+    letter_tokens = np.flatnonzero(token_letter)
+    return (
+        lines,
+        token_line[letter_tokens],
+        c[token_start[letter_tokens]] - ord("A"),
+        value[letter_tokens],
+    )
+
+
+
+def line_words(lines, line, letter, value):
+    """\
+Return a dict of arrays with one value per line for each word in
+`LINE_WORDS` and each modal group in `G_GROUPS`, `NaN` where absent.
+
+G commands are ten times their number, eg. `382` for `G38.2`, and `M` is
+`True` for lines with any M command.
+"""
+    words = {}
+    for char in LINE_WORDS:
+        array = np.full(lines, np.nan)
+        mask = letter == ord(char) - ord("A")
+        array[line[mask]] = value[mask]
+        words[char] = array
+
+    is_g = letter == ord("G") - ord("A")
+    g_line = line[is_g]
+    g_code = np.rint(value[is_g] * 10)
+    for (group, codes) in G_GROUPS.items():
+        array = np.full(lines, np.nan)
+        mask = np.isin(g_code, codes)
+        array[g_line[mask]] = g_code[mask]
+        words[group] = array
+
+    words["M"] = np.zeros(lines, dtype=bool)
+    words["M"][line[letter == ord("M") - ord("A")]] = True
+    return words
+
+
+
+def fill_forward(values, initial, present=None):
+    """\
+Return `values` with each `NaN` replaced by the last value before it,
+or by `initial` if there is none.
+
+If `present` is given, values where it is `False` are replaced instead,
+and `NaN` values where it is `True` are kept.
+"""
+    if present is None:
+        present = ~np.isnan(values)
+    index = np.where(present, np.arange(len(values)), -1)
+    np.maximum.accumulate(index, out=index)
+    return np.where(index >= 0, values[index], initial)
+
+
+
+def accumulate(words, relative, initial, present=None):
+    """\
+Return the position after each line from absolute and relative words.
+
+Positions are a running sum of relative words that restarts at each
+absolute word. If `present` is given it marks the words, and a `NaN`
+word makes positions unknown until the next absolute word.
+"""
+    if present is None:
+        present = ~np.isnan(words)
+    steps = np.cumsum(np.where(present & relative, words, 0))
+    absolute = present & ~relative
+    base = np.where(absolute, words - steps, np.nan)
+    return fill_forward(base, initial, absolute) + steps
+
+
+
+class Moves():
+    """\
+Moves from one chunk of G-code, one entry per line with motion.
+
+Positions are in millimeters in machine coordinates, `NaN` where they
+depend on an unknown work coordinate offset or follow a `G28` or `G30`
+move to a stored position. `motion` and `plane` are G command numbers
+times ten. `feed` is in millimeters per minute, or in moves per minute
+where `inverse` is set. `stops` are the numbers of lines before whose
+motion Grbl waits for motion to stop, which may be past the end of the
+chunk, and `dwell` the seconds of `G4` dwell in the chunk.
+"""
+
+    __slots__ = (
+        "lines",
+        "line",
+        "start",
+        "end",
+        "motion",
+        "plane",
+        "feed",
+        "inverse",
+        "offsets",
+        "radius",
+        "stops",
+        "dwell",
+    )
+
+
+    def __len__(self):
+        return len(self.line)
+
+
+
+class Toolpath():
+    """\
+Modal state carried through a G-code file parsed one chunk at a time.
+
+`position` is the machine position at the start, and `offsets` a dict
+of work coordinate offsets by G command number times ten, eg. `540` for
+`G54`. Offsets default to zero, but if `offsets` is given, any others
+are unknown until set by `G10`. The `G92` offset starts at zero.
+"""
+
+    def __init__(self, position=None, offsets=None):
+        require_numpy()
+        systems = G_GROUPS["coordinates"]
+        self.modes = dict(DEFAULT_MODES)
+        self.feed = math.nan
+        self.position = np.zeros(len(AXES))
+        if position is not None:
+            self.position[:] = position
+        self.offsets = np.zeros((len(systems), len(AXES)))
+        if offsets is not None:
+            self.offsets[:] = np.nan
+            for (code, offset) in offsets.items():
+                self.offsets[systems.index(code)] = offset
+        self.g92 = np.zeros(len(AXES))
+        self.lines = 0
+
+
+    def parse(self, data):
+        """\
+Return the `Moves` in `data`, bytes of whole lines, and update state.
+"""
+        (lines, line, letter, value) = tokenize(data)
+        words = line_words(lines, line, letter, value)
+        return self.moves(lines, words)
+
+
+    def modal(self, words):
+        """\
+Return the mode in effect on each line for every modal group, and
+update the modes carried to the next chunk.
+"""
+        modes = {}
+        for (group, initial) in self.modes.items():
+            modes[group] = fill_forward(words[group], initial)
+            if len(modes[group]):
+                self.modes[group] = modes[group][-1]
+        return modes
+
+
+    def set_offset(self, code, values, l_word, p_word, system):
+        """\
+Update offsets for the `G10`, `G92` or `G92.1` command `code` with axis
+`values` in millimeters, `NaN` where absent.
+"""
+        values = np.array(values)
+        present = ~np.isnan(values)
+        if code == 920:
+            offset = self.position - self.offsets[system] - values
+            self.g92[present] = offset[present]
+        elif code == 921:
+            self.g92[:] = 0
+        elif code == 100 and l_word in (2, 20):
+            if not np.isnan(p_word) and p_word:
+                system = int(p_word) - 1
+            if not 0 <= system < len(self.offsets):
+                return
+            if l_word == 20:
+                values = self.position - self.g92 - values
+            self.offsets[system][present] = values[present]
+
+
+    def moves(self, lines, words):
+        modes = self.modal(words)
+        first = self.lines + 1
+        self.lines += lines
+
+        scale = np.where(modes["units"] == 200, MM_PER_INCH, 1.0)
+        non_modal = words["non_modal"]
+        axes = [words[axis] * scale for axis in AXES]
+
+        has_axis = np.zeros(lines, dtype=bool)
+        for array in axes:
+            has_axis |= ~np.isnan(array)
+        home = np.isin(non_modal, HOME_NON_MODAL)
+        moving = has_axis & (home | (
+            ~np.isin(non_modal, AXIS_NON_MODAL) & (modes["motion"] != 800)))
+
+        # Absolute words are in work coordinates, except with `G53`.
+        machine = non_modal == 530
+        absolute = (modes["distance"] == 900) | machine
+        system = np.searchsorted(
+            G_GROUPS["coordinates"], modes["coordinates"])
+
+        # Offsets depend on the position where they are set, so positions
+        # are accumulated up to each line that sets one. After `G28` and
+        # `G30` the position is unknown until absolute words set it.
+        start = np.empty((lines, len(AXES)))
+        end = np.empty((lines, len(AXES)))
+        if lines:
+            start[0] = self.position
+        begin = 0
+        events = np.flatnonzero(np.isin(non_modal, OFFSET_NON_MODAL) | home)
+        for event in itertools.chain(events.tolist(), [lines]):
+            # The intermediate point of `G28` and `G30` is a move.
+            stop = event + 1 if event < lines and home[event] else event
+            part = slice(begin, stop)
+            offset = self.offsets[system[part]] + self.g92
+            offset[machine[part] | ~absolute[part]] = 0
+            for (i, array) in enumerate(axes):
+                present = moving[part] & ~np.isnan(array[part])
+                end[part, i] = accumulate(
+                    array[part] + offset[:, i], ~absolute[part],
+                    self.position[i], present)
+            if stop > begin:
+                self.position[:] = end[stop - 1]
+            if stop > event:
+                self.position[:] = np.nan
+            elif event < lines:
+                self.set_offset(
+                    non_modal[event], [array[event] for array in axes],
+                    words["L"][event], words["P"][event], system[event])
+                end[event] = self.position
+            begin = event + 1
+
+        start[1:] = end[:-1]
+        after = np.flatnonzero(home[:-1]) + 1
+        start[after] = np.nan
+
+        inverse = modes["feed"] == 930
+        feed_words = words["F"] * scale
+        feed = fill_forward(np.where(inverse, np.nan, feed_words), self.feed)
+        if lines:
+            self.feed = feed[-1]
+        feed = np.where(inverse, feed_words, feed)
+
+        index = np.flatnonzero(moving)
+        motion = np.where(home[index], 0, modes["motion"][index])
+        missing = np.isin(motion, FEED_MOTION) & np.isnan(feed[index])
+        if missing.any():
+            raise ToolpathException(
+                "Feed rate not set on line %d" %
+                (first + index[np.argmax(missing)]))
+
+        result = Moves()
+        result.lines = lines
+        result.line = first + index
+        result.start = start[index]
+        result.end = end[index]
+        result.motion = motion
+        result.plane = modes["plane"][index]
+        result.feed = feed[index]
+        result.inverse = inverse[index]
+        result.offsets = np.stack(
+            [words[k][index] * scale[index] for k in "IJK"], axis=1)
+        result.radius = words["R"][index] * scale[index]
+
+        # Probing waits for motion to stop both before and after the probe.
+        probe = (modes["motion"] >= 382) & (modes["motion"] <= 385) & moving
+        stops = words["M"] | np.isin(non_modal, SYNC_NON_MODAL) | probe
+        result.stops = first + np.union1d(
+            np.flatnonzero(stops), np.flatnonzero(probe) + 1)
+        result.dwell = float(np.nansum(words["P"][non_modal == 40]))
+        return result
+
+
+
+def arcs(moves, mask):
+    """\
+Return the geometry of the arc moves selected by `mask`.
+
+Returns `(axes, center, radius, travel)`: an array of the indices of the
+first and second arc axes and the linear axis for each arc, the arc
+centers, radii, and angular travel in radians, negative for clockwise.
+"""
+    start = moves.start[mask]
+    end = moves.end[mask]
+    radius = moves.radius[mask]
+    offsets = np.nan_to_num(moves.offsets[mask])
+    clockwise = moves.motion[mask] == 20
+    count = len(start)
+    rows = np.arange(count)
+
+    planes = sorted(PLANE_AXES)
+    axes = np.array([PLANE_AXES[p] for p in planes])
+    axes = axes[np.searchsorted(planes, moves.plane[mask])]
+    (a0, a1) = (axes[:, 0], axes[:, 1])
+
+    # Radius format: the center is found from the radius, as in Grbl.
+    r_format = ~np.isnan(radius)
+    if r_format.any():
+        x = end[rows, a0] - start[rows, a0]
+        y = end[rows, a1] - start[rows, a1]
+        h_x2_div_d = 4 * radius ** 2 - x ** 2 - y ** 2
+        invalid = r_format & ((h_x2_div_d < 0) | ((x == 0) & (y == 0)))
+        if invalid.any():
+            raise ToolpathException(
+                "Invalid arc radius on line %d" %
+                moves.line[np.flatnonzero(mask)[np.argmax(invalid)]])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            h_x2_div_d = -np.sqrt(h_x2_div_d) / np.hypot(x, y)
+        h_x2_div_d = np.where(clockwise, h_x2_div_d, -h_x2_div_d)
+        h_x2_div_d = np.where(radius < 0, -h_x2_div_d, h_x2_div_d)
+        offsets[rows[r_format], a0[r_format]] = \
+            (0.5 * (x - y * h_x2_div_d))[r_format]
+        offsets[rows[r_format], a1[r_format]] = \
+            (0.5 * (y + x * h_x2_div_d))[r_format]
+
+    i = offsets[rows, a0]
+    j = offsets[rows, a1]
+    radius = np.where(r_format, np.abs(radius), np.hypot(i, j))
+    center = start.copy()
+    center[rows, a0] += i
+    center[rows, a1] += j
+
+    rt0 = end[rows, a0] - center[rows, a0]
+    rt1 = end[rows, a1] - center[rows, a1]
+    travel = np.arctan2(-i * rt1 + j * rt0, -i * rt0 - j * rt1)
+    travel = np.where(clockwise & (travel >= -ARC_EPSILON),
+                      travel - 2 * math.pi, travel)
+    travel = np.where(~clockwise & (travel <= ARC_EPSILON),
+                      travel + 2 * math.pi, travel)
+
+    return (axes, center, radius, travel)
+
+
+
+def bounds(moves):
+    """\
+Return the lowest and highest positions reached by `moves` on each axis,
+`NaN` where none are known.
+
+Arcs are bounded by their circles, which contain the line segments Grbl
+cuts them into.
+"""
+    points = [moves.start, moves.end]
+    arc = np.isin(moves.motion, (20, 30))
+    if arc.any():
+        (axes, center, radius, travel) = arcs(moves, arc)
+        rows = np.arange(len(axes))
+        (a0, a1) = (axes[:, 0], axes[:, 1])
+        start = moves.start[arc]
+        begin = np.arctan2(start[rows, a1] - center[rows, a1],
+                           start[rows, a0] - center[rows, a0])
+        # The extremes of each arc axis are at quarter turns.
+        for (cos, sin) in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+            angle = math.atan2(sin, cos)
+            turn = np.where(travel > 0, angle - begin, begin - angle)
+            reached = np.mod(turn, 2 * math.pi) <= np.abs(travel)
+            point = start.copy()
+            point[rows, a0] = center[rows, a0] + radius * cos
+            point[rows, a1] = center[rows, a1] + radius * sin
+            points.append(point[reached])
+
+    lower = np.full(len(AXES), np.nan)
+    upper = np.full(len(AXES), np.nan)
+    for array in points:
+        if len(array):
+            lower = np.fmin(lower, np.fmin.reduce(array, axis=0))
+            upper = np.fmax(upper, np.fmax.reduce(array, axis=0))
+    return (lower, upper)
+
+
+
+def read_moves(fp, chunk_size=None, toolpath=None):
+    """\
+Yield `Moves` for each chunk of G-code read from the binary file-like `fp`.
+"""
+    if toolpath is None:
+        toolpath = Toolpath()
+    for data in read_chunks(fp, chunk_size):
+        yield toolpath.parse(data)
@@ -36,7 +36,10 @@ setuptools.setup(
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
         "Operating System :: OS Independent",
     ],
-    install_requires=["flask", "pyserial"],
+    install_requires=["flask", "pyserial", "cheroot"],
+    extras_require={
+        "estimate": ["numpy"],
+    },
     python_requires='>=3',
     scripts=["scripts/calabo-server"],
     setup_requires=["pytest-runner"],
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare two benchmark result files written with `--benchmark-json`.
+
+Exits with status 1 if any benchmark is worse by more than the threshold.
+"""
+
+import sys
+import json
+import argparse
+
+
+
+DEFAULT_THRESHOLD = 0.1
+
+
+
+def higher_is_better(unit):
+    return unit.endswith("/s")
+
+
+
+def compare(base, new, threshold=None):
+    """\
+Return a list of `(name, base, new, change, regressed)` for benchmarks
+present in both result dicts. `change` is the fractional improvement.
+"""
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLD
+
+    rows = []
+    for (name, result) in sorted(new["results"].items()):
+        base_result = base["results"].get(name)
+        if not base_result or base_result["unit"] != result["unit"]:
+            continue
+        (a, b) = (base_result["value"], result["value"])
+        if not a:
+            continue
+        change = (b - a) / a
+        if not higher_is_better(result["unit"]):
+            change = -change
+        rows.append((name, base_result, result, change, change < -threshold))
+    return rows
+
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare Calabó benchmark results.")
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="Fractional change counted as a regression (default %s)." %
+        DEFAULT_THRESHOLD)
+    parser.add_argument("base", help="Results to compare against.")
+    parser.add_argument("new", help="New results.")
+    args = parser.parse_args()
+
+    with open(args.base) as fp:
+        base = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    print("%s -> %s" % (base["version"], new["version"]))
+    regressed = False
+    for (name, a, b, change, worse) in compare(base, new, args.threshold):
+        print("%-28s %12.4g %12.4g %-10s %+6.1f%%%s" % (
+            name, a["value"], b["value"], b["unit"], 100 * change,
+            "  REGRESSION" if worse else ""))
+        regressed = regressed or worse
+
+    return 1 if regressed else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
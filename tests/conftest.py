@@ -13,9 +13,12 @@
 
 import os
 import sys
+import json
 import time
 import logging
+import platform
 import threading
+import contextlib
 
 import pytest
 
@@ -26,6 +29,7 @@ from mock_grbl import MockGrbl
 from calabo.calabo import CalaboServer
 from calabo.grbl import Grbl
 from calabo.grbl_settings import setting_index
+from calabo.version import __version__
 
 
 
@@ -36,6 +40,64 @@ LOG = logging.getLogger("conftest")
 def pytest_addoption(parser):
     parser.addoption("--device", action="store", default="/dev/ttyACM0")
     parser.addoption("--profile", action="store_true")
+    parser.addoption(
+        "--benchmark-json", action="store", default=None, metavar="PATH",
+        help="Write benchmark results to PATH as JSON.")
+
+
+
+class BenchmarkResults():
+    """\
+Benchmark results collected during a test session.
+"""
+
+    def __init__(self):
+        self.results = {}
+
+
+    def record(self, name, value, unit, **extra):
+        """\
+Record `value` in `unit` for the benchmark `name`, with optional extra
+values such as percentiles in the same unit.
+"""
+        self.results[name] = dict(extra, value=value, unit=unit)
+        LOG.info("%s: %s %s%s", name, format_result(value), unit, "".join(
+            ", %s %s" % (k, format_result(v)) for (k, v) in extra.items()))
+
+
+    def write(self, path):
+        with open(path, "w") as fp:
+            json.dump({
+                "version": __version__,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.time(),
+                "results": self.results,
+            }, fp, indent=2, sort_keys=True)
+
+
+
+def format_result(value):
+    if isinstance(value, float):
+        return "%.4g" % value
+    return str(value)
+
+
+
+BENCHMARK_RESULTS = BenchmarkResults()
+
+
+
+@pytest.fixture(scope="session")
+def benchmark():
+    return BENCHMARK_RESULTS
+
+
+
+def pytest_sessionfinish(session, exitstatus):
+    path = session.config.getoption("--benchmark-json")
+    if path and BENCHMARK_RESULTS.results:
+        BENCHMARK_RESULTS.write(path)
 
 
 
@@ -56,10 +118,7 @@ def _device_mock(request):
         thread = threading.Thread(target=mock_grbl.run)
         thread.daemon = True
         thread.start()
-        yield {
-            "address": mock_grbl._socat_stream._dev_remote,
-            "reset": mock_grbl.reset,
-        }
+        yield mock_grbl.device()
 
 
 
@@ -105,13 +164,27 @@ def grbl(device):
 @pytest.fixture
 def calabo_server(device):
     with CalaboServer(device) as calabo_server:
-        thread = threading.Thread(target=calabo_server.run)
-        thread.daemon = True
-        thread.start()
+        calabo_server.start()
+        yield calabo_server
+
 
-        # Allow HTTP server to start
-        time.sleep(0.1)
 
+@pytest.fixture
+def calabo_server_machines():
+    """\
+A Calabó server for three mock Grbl devices, `a`, `b` and `c`.
+"""
+    with contextlib.ExitStack() as stack:
+        machines = {}
+        for machine_id in ("a", "b", "c"):
+            mock_grbl = stack.enter_context(MockGrbl())
+            thread = threading.Thread(target=mock_grbl.run)
+            thread.daemon = True
+            thread.start()
+            machines[machine_id] = mock_grbl.device()
+
+        calabo_server = stack.enter_context(CalaboServer(machines=machines))
+        calabo_server.start()
         yield calabo_server
 
 
@@ -15,18 +15,31 @@
 Mock Grbl
 
 Mock Grbl implementation for testing Calabó.
+
+The mock simulates Grbl's timing closely enough to compare streaming
+strategies: serial transfer at the baud rate, a 128-byte receive buffer,
+a 15-block planner, and moves that take the time allowed by the
+`$110-$122` maximum rates and accelerations and `$11` junction deviation.
+With default settings the rates are so high that moves are effectively
+instant.
 """
 
 import re
 import sys
+import math
 import time
+import queue
 import errno
 import logging
+import functools
+import threading
+from collections import deque
 from subprocess import Popen, PIPE
 
 # Calabo imports
 sys.path.append("../")
 from calabo.serial import Serial, ConnectionClosedException
+from calabo.loopback import loopback_pair
 from calabo.grbl_settings import SETTINGS, setting_index, \
     setting_from_string, setting_to_string
 
@@ -34,6 +47,53 @@ from calabo.grbl_settings import SETTINGS, setting_index, \
 
 MAX_SOCAT_PARSE_LINES = 10
 
+RE_SETTING = re.compile(r"^\$(\d+)=(.+)$")
+RE_WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+
+# Realtime override commands as `(index, change)` where `change` is an
+# increment, or an absolute value for the rapid override.
+OVERRIDES = {
+    "\x90": (0, None),
+    "\x91": (0, 10),
+    "\x92": (0, -10),
+    "\x93": (0, 1),
+    "\x94": (0, -1),
+    "\x95": (1, 100),
+    "\x96": (1, 50),
+    "\x97": (1, 25),
+    "\x99": (2, None),
+    "\x9a": (2, 10),
+    "\x9b": (2, -10),
+    "\x9c": (2, 1),
+    "\x9d": (2, -1),
+}
+
+DEFAULT_BAUD_RATE = 115200
+BITS_PER_BYTE = 10
+
+RX_BUFFER_SIZE = 128
+PLANNER_BLOCKS = 15
+
+AXES = "XYZ"
+MAX_RATE_KEYS = (110, 111, 112)
+ACCELERATION_KEYS = (120, 121, 122)
+JUNCTION_DEVIATION_KEY = 11
+ARC_TOLERANCE_KEY = 12
+
+# Default settings are placeholders, so arc tolerance is capped to give
+# a realistic number of arc segments.
+MAX_ARC_TOLERANCE = 0.1
+
+# Arc planes as indices of the two arc axes and the linear axis.
+PLANES = {
+    17: (0, 1, 2),
+    18: (2, 0, 1),
+    19: (1, 2, 0),
+}
+
+# Longest time the simulation waits for input before advancing motion.
+MAX_TICK = 0.01
+
 
 
 LOG = logging.getLogger("mock_grbl")
@@ -45,6 +105,17 @@ class MockGrblSocketError(Exception):
 
 
 
+class MockGrblError(Exception):
+    """\
+A G-code line that Grbl would reject with `error:code`.
+"""
+
+    def __init__(self, code):
+        super().__init__("error:%d" % code)
+        self.code = code
+
+
+
 class SocatStream():
     def __init__(self):
         self._proc = None
@@ -92,66 +163,393 @@ class SocatStream():
 
 
 
+class PacedWriter():
+    """\
+Write lines no faster than `baud_rate` allows, in a background thread,
+so that the simulation is not held up while output is transmitted.
+"""
+
+    def __init__(self, serial, baud_rate):
+        self._serial = serial
+        self._byte_time = BITS_PER_BYTE / baud_rate
+        self._queue = queue.Queue()
+        self._free = 0
+        self._thread = threading.Thread(
+            target=self._work, name="mock-grbl-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def write_line(self, line):
+        size = len(line) + 2
+        now = time.monotonic()
+        self._free = max(self._free, now) + size * self._byte_time
+        self._queue.put((self._free, line))
+
+
+    def _work(self):
+        while True:
+            (due, line) = self._queue.get()
+            if line is None:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._serial.write_line(line)
+            except ConnectionClosedException:  # pragma: no cover
+                break
+
+
+    def close(self):
+        self._queue.put((0, None))
+        self._thread.join()
+
+
+
+def trapezoid(distance, entry, nominal, exit, accel):
+    """\
+Return `(peak, t_accel, t_cruise, t_decel)` for a move of `distance`
+starting at speed `entry` and ending at `exit`, limited to `nominal`.
+"""
+    if nominal <= 0:
+        return (0, 0, 0, 0)
+    if accel <= 0 or math.isinf(accel):
+        return (nominal, 0, distance / nominal, 0)
+
+    peak = nominal
+    d_accel = max(0, peak ** 2 - entry ** 2) / (2 * accel)
+    d_decel = max(0, peak ** 2 - exit ** 2) / (2 * accel)
+    if d_accel + d_decel > distance:
+        peak = min(nominal, math.sqrt(max(
+            entry ** 2, exit ** 2,
+            (2 * accel * distance + entry ** 2 + exit ** 2) / 2)))
+        d_accel = max(0, peak ** 2 - entry ** 2) / (2 * accel)
+        d_decel = max(0, peak ** 2 - exit ** 2) / (2 * accel)
+
+    t_cruise = max(0, distance - d_accel - d_decel) / peak
+    return (
+        peak,
+        max(0, peak - entry) / accel,
+        t_cruise,
+        max(0, peak - exit) / accel,
+    )
+
+
+
+class Block():
+    """\
+One planner block: a straight move or a dwell.
+
+Speeds are in millimeters per second.
+"""
+
+    __slots__ = (
+        "origin",
+        "target",
+        "unit",
+        "distance",
+        "nominal",
+        "accel",
+        "rapid",
+        "jog",
+        "dwell",
+        "max_entry",
+        "entry",
+        "exit",
+        "profile",
+        "duration",
+        "start",
+    )
+
+
+    def __init__(self, origin, target, nominal=0, accel=math.inf,
+                 rapid=False, jog=False, dwell=None):
+        self.origin = origin
+        self.target = target
+        delta = [t - o for (t, o) in zip(target, origin)]
+        self.distance = math.sqrt(sum(d * d for d in delta))
+        self.unit = [d / self.distance if self.distance else 0 for d in delta]
+        self.nominal = nominal
+        self.accel = accel
+        self.rapid = rapid
+        self.jog = jog
+        self.dwell = dwell
+        self.max_entry = 0
+        self.entry = 0
+        self.exit = 0
+        self.profile = None
+        self.duration = None
+        self.start = None
+
+
+    def plan(self, entry, exit, override=100):
+        self.entry = entry
+        nominal = self.nominal * override / 100
+        self.exit = min(exit, nominal)
+        if self.dwell is not None:
+            self.profile = (0, 0, 0, 0)
+            self.duration = self.dwell
+            return
+        self.profile = trapezoid(
+            self.distance, entry, nominal, self.exit, self.accel)
+        self.duration = sum(self.profile[1:])
+
+
+    def travelled(self, t):
+        """\
+Return the distance travelled and speed `t` seconds after the start.
+"""
+        if self.dwell is not None or not self.distance:
+            return (0, 0)
+        if t >= self.duration:
+            return (self.distance, self.exit)
+
+        (peak, t_accel, t_cruise, t_decel) = self.profile
+        if t < t_accel:
+            return (self.entry * t + 0.5 * self.accel * t * t,
+                    self.entry + self.accel * t)
+        s = (self.entry + peak) / 2 * t_accel
+        t -= t_accel
+        if t < t_cruise:
+            return (s + peak * t, peak)
+        s += peak * t_cruise
+        t = min(t - t_cruise, t_decel)
+        if not t:
+            return (min(s, self.distance), peak)
+        return (min(s + peak * t - 0.5 * self.accel * t * t, self.distance),
+                peak - self.accel * t)
+
+
+    def position(self, t):
+        (s, speed) = self.travelled(t)
+        return ([o + u * s for (o, u) in zip(self.origin, self.unit)], speed)
+
+
+
 class MockGrbl():
     """\
 Mock Grbl hardware object that provides a serial address for connection.
+
+`options` may include `settings`, a dict of initial settings by key,
+and `baud_rate`, the simulated serial speed, or `None` to write output
+without pacing.
+
+The mock is connected through an in-process loopback port, with
+`latency` seconds of delay if given in `options`. With the `pty` option
+it is connected through a `socat` pseudo-terminal pair instead, for
+testing code that opens a device path.
 """
 
     def __init__(self, options=None):
 
         self._socat_stream = None
+        self._port = None
+        self._host_port = None
+        self._pty = False
+        self._latency = None
         self._serial = None
+        self._writer = None
         self._settings = {k: v["default"] for k, v in SETTINGS.items()}
+        self._baud_rate = DEFAULT_BAUD_RATE
 
+        self._lock = threading.RLock()
         self._state = None
         self._locked = None
         self._feed_rate = None
+        self._motion = None
+        self._overrides = [100, 100, 100]
+        self._realtime_received = None
+        self._jog_lines = []
+
+        # Parser state.
+        self._position = [0.0, 0.0, 0.0]
+        self._relative = False
+        self._inches = False
+        self._plane = 17
+
+        # Simulated hardware.
+        self._rx = deque()
+        self._rx_bytes = 0
+        self._rx_arrival = 0
+        self._rx_overflows = 0
+        self._pending = deque()
+        self._pending_ok = False
+        self._planner = deque()
+        self._motion_end = None
+        self._machine_position = [0.0, 0.0, 0.0]
+        self._held_at = None
 
         if options and "settings" in options:
             self._settings.update(options["settings"])
+        if options and "baud_rate" in options:
+            self._baud_rate = options["baud_rate"]
+        if options:
+            self._pty = options.get("pty", False)
+            self._latency = options.get("latency")
 
     def __enter__(self):
-        self._socat_stream = SocatStream()
-        self._socat_stream.__enter__()
+        address = None
+        if self._pty:
+            self._socat_stream = SocatStream()
+            self._socat_stream.__enter__()
+            address = self._socat_stream._dev_local
+        else:
+            (self._port, self._host_port) = loopback_pair(
+                latency=self._latency, names=("mock", "ctrl"))
 
         self._serial = Serial(
-            self._socat_stream._dev_local,
-            name="mock", write_eol="\r\n",
-            realtime_hooks={
+            address, name="mock", write_eol="\r\n", port=self._port,
+            realtime_hooks=dict({
                 "?": self.write_state,
-            }
+                "\x18": self.reset,
+            }, **{
+                char: functools.partial(self.realtime, char)
+                for char in ["!", "~", "\x85"] + list(OVERRIDES)
+            })
         )
         self._serial.__enter__()
+        if self._baud_rate:
+            self._writer = PacedWriter(self._serial, self._baud_rate)
 
         return self
 
 
     def __exit__(self, exception_type, exception_value, traceback):
+        if self._writer:
+            self._writer.close()
         self._serial.__exit__(exception_type, exception_value, traceback)
-        self._socat_stream.__exit__(exception_type, exception_value, traceback)
+        if self._socat_stream:
+            self._socat_stream.__exit__(
+                exception_type, exception_value, traceback)
+        if self._host_port:
+            self._host_port.close()
+
+
+    def device(self):
+        """\
+Return a device dict for connecting a `Grbl` object to the mock.
+"""
+        if self._socat_stream:
+            return {
+                "address": self._socat_stream._dev_remote,
+                "reset": self.reset,
+                "mock": self,
+            }
+        return {
+            "address": "loopback",
+            "port": self._host_port,
+            "reset": self.reset,
+            "mock": self,
+        }
+
+
+    def write_line(self, line):
+        if self._writer:
+            self._writer.write_line(line)
+        else:
+            self._serial.write_line(line)
 
 
     def reset(self):
-        self._state = "Idle"
-        self._locked = False
-        self._feed_rate = None
+        with self._lock:
+            # Motion stops where it is.
+            self._machine_position = self._current_position()[0]
+            self._position = list(self._machine_position)
+            self._rx.clear()
+            self._rx_bytes = 0
+            self._pending.clear()
+            self._pending_ok = False
+            self._planner.clear()
+            self._motion_end = None
+            self._held_at = None
+
+            self._state = "Idle"
+            self._locked = False
+            self._feed_rate = None
+            self._motion = 0
+            self._relative = False
+            self._inches = False
+            self._plane = 17
+            self._overrides = [100, 100, 100]
 
-        if self._settings[setting_index("homing-cycle-enable")]:
-            self._state = "Alarm"
-            self._locked = True
+            if self._settings[setting_index("homing-cycle-enable")]:
+                self._state = "Alarm"
+                self._locked = True
 
-        self.salutation()
+            self.salutation()
 
 
     def write_calibration(self):
         for key, value in self._settings.items():
             value_str = setting_to_string(key, value)
-            self._serial.write_line("$%d=%s" % (key, value_str))
-        self._serial.write_line("ok")
+            self.write_line("$%d=%s" % (key, value_str))
+        self.write_line("ok")
 
 
     def write_state(self):
-        self._serial.write_line("<%s>" % self._state)
+        with self._lock:
+            self._update()
+            (position, speed) = self._current_position()
+            self.write_line(
+                "<%s|MPos:%.3f,%.3f,%.3f|Bf:%d,%d|FS:%d,0|WCO:0,0,0|"
+                "Ov:%d,%d,%d>" % (
+                    (self._state, ) + tuple(position) + (
+                        PLANNER_BLOCKS - len(self._planner),
+                        RX_BUFFER_SIZE - self._rx_bytes,
+                        round(speed * 60) if math.isfinite(speed) else 0,
+                    ) + tuple(self._overrides)))
+
+
+    def realtime(self, char):
+        self._realtime_received = (char, time.perf_counter())
+
+        with self._lock:
+            self._update()
+            now = time.monotonic()
+
+            if char == "!" and self._state in ("Run", "Jog"):
+                self._state = "Hold:0"
+                self._held_at = now
+            elif char == "~" and self._state.startswith("Hold"):
+                self._resume(now)
+            elif char == "\x85" and self._state == "Jog":
+                self._cancel_jog()
+            elif char in OVERRIDES:
+                (index, change) = OVERRIDES[char]
+                if index == 1:
+                    self._overrides[1] = change
+                elif change is None:
+                    self._overrides[index] = 100
+                else:
+                    self._overrides[index] = max(
+                        10, min(200, self._overrides[index] + change))
+
+
+    def _resume(self, now):
+        if self._held_at is not None:
+            paused = now - self._held_at
+            if self._planner and self._planner[0].start is not None:
+                self._planner[0].start += paused
+            if self._motion_end is not None:
+                self._motion_end += paused
+        self._held_at = None
+        self._state = "Run" if self._planner else "Idle"
+
+
+    def _cancel_jog(self):
+        """\
+Stop jogging where the machine is and discard queued jog motion.
+"""
+        self._machine_position = self._current_position()[0]
+        self._position = list(self._machine_position)
+        self._planner.clear()
+        self._pending.clear()
+        if self._pending_ok:
+            self._pending_ok = False
+            self.write_line("ok")
+        self._motion_end = None
+        self._state = "Idle"
 
 
     def set_setting(self, key, value_str):
@@ -159,7 +557,7 @@ Mock Grbl hardware object that provides a serial address for connection.
 
         # Do not allow soft limits to be enabled if homing is disabled
         if key == 20 and value and not self._settings[22]:
-            self._serial.write_line("error:10")
+            self.write_line("error:10")
             return
 
         # Disable soft-limits when homing is disabled
@@ -167,34 +565,433 @@ Mock Grbl hardware object that provides a serial address for connection.
             self._settings[20] = False
 
         self._settings[key] = value
-        self._serial.write_line("ok")
+        self.write_line("ok")
 
 
     def probe(self, z_to):
         if self._feed_rate is None:
-            self._serial.write_line("error:22")
+            self.write_line("error:22")
             return
 
         time.sleep(10)
-        self._serial.write_line("ALARM:5")
-        self._serial.write_line("[PRB:0.0000,0.0000,0.0000:0]")
-        self._serial.write_line("ok")
+        self.write_line("ALARM:5")
+        self.write_line("[PRB:0.0000,0.0000,0.0000:0]")
+        self.write_line("ok")
 
 
-    def move(self, x):
-        if self._locked:
-            self._serial.write_line("error:9")
+    def _limits(self, unit):
+        """\
+Return the maximum speed and acceleration along `unit`.
+"""
+        speed = math.inf
+        accel = math.inf
+        for (i, u) in enumerate(unit):
+            if not u:
+                continue
+            rate = self._settings.get(MAX_RATE_KEYS[i])
+            if rate:
+                speed = min(speed, rate / 60 / abs(u))
+            axis_accel = self._settings.get(ACCELERATION_KEYS[i])
+            if axis_accel:
+                accel = min(accel, axis_accel / abs(u))
+        return (speed, accel)
+
+
+    def _line_block(self, target, feed=None, rapid=False, jog=False):
+        block = Block(self._position, target, rapid=rapid, jog=jog)
+        (speed, accel) = self._limits(block.unit)
+        if feed is not None:
+            speed = min(speed, feed / 60)
+        block.nominal = speed
+        block.accel = accel
+        self._position = list(target)
+        return block
+
+
+    def _arc_blocks(self, target, offsets, radius, clockwise, feed):
+        """\
+Return arc segments from the current position to `target`, as Grbl's
+`mc_arc` generates them.
+"""
+        (a0, a1, linear) = PLANES[self._plane]
+        position = self._position
+
+        if radius is not None:
+            # Radius format: find the center.
+            x = target[a0] - position[a0]
+            y = target[a1] - position[a1]
+            h_x2_div_d = 4 * radius * radius - x * x - y * y
+            if h_x2_div_d < 0:
+                raise MockGrblError(33)
+            h_x2_div_d = -math.sqrt(h_x2_div_d) / math.hypot(x, y)
+            if not clockwise:
+                h_x2_div_d = -h_x2_div_d
+            if radius < 0:
+                h_x2_div_d = -h_x2_div_d
+                radius = -radius
+            offsets = [0, 0, 0]
+            offsets[a0] = 0.5 * (x - y * h_x2_div_d)
+            offsets[a1] = 0.5 * (y + x * h_x2_div_d)
+        else:
+            radius = math.hypot(offsets[a0], offsets[a1])
+
+        center_0 = position[a0] + offsets[a0]
+        center_1 = position[a1] + offsets[a1]
+        r_0 = -offsets[a0]
+        r_1 = -offsets[a1]
+        rt_0 = target[a0] - center_0
+        rt_1 = target[a1] - center_1
+
+        travel = math.atan2(r_0 * rt_1 - r_1 * rt_0, r_0 * rt_0 + r_1 * rt_1)
+        if clockwise:
+            if travel >= -1e-7:
+                travel -= 2 * math.pi
+        elif travel <= 1e-7:
+            travel += 2 * math.pi
+
+        tolerance = self._settings.get(ARC_TOLERANCE_KEY) or MAX_ARC_TOLERANCE
+        tolerance = min(tolerance, MAX_ARC_TOLERANCE, radius)
+        segments = max(1, int(abs(0.5 * travel * radius) / math.sqrt(
+            tolerance * (2 * radius - tolerance) or 1)))
+
+        linear_start = position[linear]
+        blocks = []
+        for i in range(1, segments):
+            angle = travel * i / segments
+            point = [0.0, 0.0, 0.0]
+            point[a0] = center_0 + r_0 * math.cos(angle) - r_1 * math.sin(angle)
+            point[a1] = center_1 + r_0 * math.sin(angle) + r_1 * math.cos(angle)
+            point[linear] = linear_start + \
+                (target[linear] - linear_start) * i / segments
+            blocks.append(self._line_block(point, feed))
+        blocks.append(self._line_block(target, feed))
+        return blocks
+
+
+    def _target(self, axes, relative=None):
+        if relative is None:
+            relative = self._relative
+        scale = 25.4 if self._inches else 1
+        target = list(self._position)
+        for (i, axis) in enumerate(AXES):
+            if axis in axes:
+                if relative:
+                    target[i] += axes[axis] * scale
+                else:
+                    target[i] = axes[axis] * scale
+        return target
+
+
+    def _parse(self, code):
+        words = RE_WORD.findall(code)
+        if not words or sum(len(k) + len(v) for (k, v) in words) != len(code):
+            return None
+        return [(k, float(v)) for (k, v) in words]
+
+
+    def jog(self, line):
+        if self._state not in ("Idle", "Jog"):
+            self.write_line("error:8")
             return
 
-        self._serial.write_line("ok")
+        words = self._parse(line[3:].upper().replace(" ", ""))
+        if words is None:
+            self.write_line("error:2")
+            return
 
+        relative = False
+        inches = self._inches
+        axes = {}
+        feed = None
+        for (k, v) in words:
+            if k == "G":
+                if v == 91:
+                    relative = True
+                elif v == 20:
+                    inches = True
+                elif v == 21:
+                    inches = False
+            elif k == "F":
+                feed = v
+            elif k in AXES:
+                axes[k] = v
+
+        if feed is None:
+            self.write_line("error:22")
+            return
 
-    def mill(self, x):
-        if self._feed_rate is None:
-            self._serial.write_line("error:22")
+        self._jog_lines.append(line)
+        saved = self._inches
+        self._inches = inches
+        target = self._target(axes, relative)
+        self._inches = saved
+        scale = 25.4 if inches else 1
+        self._queue([self._line_block(target, feed * scale, jog=True)])
+
+
+    def gcode(self, line):
+        code = line.upper().replace(" ", "")
+        words = self._parse(code)
+        if words is None:
+            return False
+
+        if self._locked:
+            self.write_line("error:9")
+            return True
+
+        axes = {}
+        offsets = [0.0, 0.0, 0.0]
+        radius = None
+        dwell = None
+        non_modal = None
+        for (k, v) in words:
+            if k == "G":
+                if v in (0, 1, 2, 3, 38.2):
+                    self._motion = v
+                elif v == 90:
+                    self._relative = False
+                elif v == 91:
+                    self._relative = True
+                elif v == 20:
+                    self._inches = True
+                elif v == 21:
+                    self._inches = False
+                elif v in PLANES:
+                    self._plane = int(v)
+                else:
+                    non_modal = v
+            elif k == "F":
+                self._feed_rate = v * (25.4 if self._inches else 1)
+            elif k in AXES:
+                axes[k] = v
+            elif k in "IJK":
+                offsets["IJK".index(k)] = v * (25.4 if self._inches else 1)
+            elif k == "R":
+                radius = v * (25.4 if self._inches else 1)
+            elif k == "P":
+                dwell = v
+
+        if non_modal == 4:
+            block = Block(self._position, self._position, dwell=dwell or 0)
+            self._queue([block])
+            return True
+
+        if not axes or non_modal is not None:
+            self.write_line("ok")
+            return True
+
+        if self._motion == 38.2:
+            self.probe(axes.get("Z"))
+            return True
+
+        if self._motion != 0 and self._feed_rate is None:
+            self.write_line("error:22")
+            return True
+
+        target = self._target(axes)
+        try:
+            if self._motion == 0:
+                blocks = [self._line_block(target, rapid=True)]
+            elif self._motion == 1:
+                blocks = [self._line_block(target, self._feed_rate)]
+            else:
+                blocks = self._arc_blocks(
+                    target, offsets, radius, self._motion == 2,
+                    self._feed_rate)
+        except MockGrblError as e:
+            self.write_line(str(e))
+            return True
+
+        self._queue(blocks)
+        return True
+
+
+    def _queue(self, blocks):
+        """\
+Plan `blocks` as the planner has room and acknowledge the line once
+they are all planned.
+"""
+        self._pending.extend(blocks)
+        self._pending_ok = True
+        self._fill_planner(time.monotonic())
+
+
+    def _fill_planner(self, now):
+        while self._pending and len(self._planner) < PLANNER_BLOCKS:
+            block = self._pending.popleft()
+            if block.distance or block.dwell is not None:
+                self._add_block(block, now)
+
+        if not self._pending and self._pending_ok:
+            self._pending_ok = False
+            self.write_line("ok")
+
+
+    def _add_block(self, block, now):
+        previous = self._planner[-1] if self._planner else None
+        if previous is not None and previous.dwell is None and \
+           block.dwell is None:
+            block.max_entry = self._junction_speed(previous, block)
+
+        if not self._planner:
+            self._motion_end = now
+        self._planner.append(block)
+        self._replan_current(now)
+
+        if self._state in ("Idle", ) and self._held_at is None:
+            self._state = "Jog" if block.jog else "Run"
+
+
+    def _junction_speed(self, previous, block):
+        """\
+Maximum speed through the junction between two moves, as in Grbl.
+"""
+        cos_theta = -sum(a * b for (a, b) in zip(previous.unit, block.unit))
+        limit = min(previous.nominal, block.nominal)
+        if cos_theta > 0.999999:
+            return 0
+        if cos_theta < -0.999999:
+            return limit
+        deviation = self._settings.get(JUNCTION_DEVIATION_KEY) or 0
+        sin_theta_d2 = math.sqrt(0.5 * (1 - cos_theta))
+        accel = min(previous.accel, block.accel)
+        if math.isinf(accel):
+            return limit
+        return min(limit, math.sqrt(
+            accel * deviation * sin_theta_d2 / (1 - sin_theta_d2)))
+
+
+    def _replan_current(self, now):
+        """\
+Replace the running block with its remainder from the current position,
+so that it need not slow down for a junction that is now followed.
+
+Grbl replans all but the few milliseconds of motion already handed to
+the stepper interrupt; this is close enough when lines arrive faster
+than blocks complete.
+"""
+        block = self._planner[0]
+        if len(self._planner) < 2 or block.start is None or \
+           block.dwell is not None or \
+           self._held_at is not None:
+            return
+
+        (position, speed) = block.position(max(0, now - block.start))
+        remainder = Block(position, block.target, block.nominal, block.accel,
+                          rapid=block.rapid, jog=block.jog)
+        if not remainder.distance:
             return
+        remainder.max_entry = block.max_entry
+        remainder.entry = speed
+        self._planner[0] = remainder
+        self._motion_end = now
+        self._start_block(remainder, now)
 
-        self._serial.write_line("ok")
+
+    def _start_block(self, block, start):
+        """\
+Fix the speed profile of the block about to run.
+
+The exit speed is the highest from which every following block can
+still stop, as in Grbl's backward planner pass.
+"""
+        exit = 0
+        following = list(self._planner)[1:]
+        for next_block in reversed(following):
+            exit = min(next_block.max_entry, math.sqrt(
+                exit * exit + 2 * next_block.accel * next_block.distance))
+
+        override = 100
+        if not block.jog:
+            override = self._overrides[1 if block.rapid else 0]
+
+        exit = min(exit, math.sqrt(
+            block.entry ** 2 + 2 * block.accel * block.distance))
+        block.plan(block.entry, exit, override)
+        block.start = start
+
+        if following:
+            following[0].entry = block.exit
+
+
+    def _update(self):
+        """\
+Advance motion to the current time and take lines from the receive
+buffer as the planner has room.
+"""
+        now = time.monotonic()
+        if self._held_at is not None:
+            now = self._held_at
+
+        while True:
+            while self._planner:
+                block = self._planner[0]
+                if block.start is None:
+                    self._start_block(block, self._motion_end)
+                end = block.start + block.duration
+                if end > now:
+                    break
+                self._machine_position = list(block.target)
+                self._motion_end = end
+                self._planner.popleft()
+                if self._planner:
+                    self._planner[0].entry = block.exit
+
+            if not self._planner and self._state in ("Run", "Jog"):
+                self._state = "Idle"
+
+            self._fill_planner(now)
+            if self._pending or not self._rx or \
+               self._rx[0][0] > time.monotonic():
+                break
+
+            (_arrival, line, size) = self._rx.popleft()
+            self._rx_bytes -= size
+            self.process_line(line)
+
+
+    def _current_position(self):
+        if self._planner and self._planner[0].start is not None:
+            block = self._planner[0]
+            now = self._held_at or time.monotonic()
+            return block.position(max(0, now - block.start))
+        return (list(self._machine_position), 0)
+
+
+    def _next_event(self):
+        """\
+Return seconds until the simulation next needs to advance, or `False`.
+"""
+        if not self._planner and not self._rx:
+            return False
+        now = time.monotonic()
+        times = [now + MAX_TICK]
+        if self._planner and self._held_at is None:
+            block = self._planner[0]
+            if block.start is not None:
+                times.append(block.start + block.duration)
+        if self._rx and not self._pending:
+            times.append(self._rx[0][0])
+        return max(0, min(times) - now)
+
+
+    def receive(self, line):
+        """\
+Add a line to the simulated receive buffer once it has been transferred.
+"""
+        size = len(line) + 1
+        now = time.monotonic()
+        arrival = now
+        if self._baud_rate:
+            arrival = max(now, self._rx_arrival) + \
+                size * BITS_PER_BYTE / self._baud_rate
+        self._rx_arrival = arrival
+
+        self._rx.append((arrival, line, size))
+        self._rx_bytes += size
+        if self._rx_bytes > RX_BUFFER_SIZE:
+            self._rx_overflows += 1
+            LOG.warning("Receive buffer overflow: %d bytes", self._rx_bytes)
 
 
     def process_line(self, line):
@@ -207,48 +1004,44 @@ Mock Grbl hardware object that provides a serial address for connection.
             self.write_calibration()
             return
 
-        match = re.compile(r"^\$(\d+)=(.+)$").match(line)
+        if line.startswith("$J="):
+            self.jog(line)
+            return
+
+        match = RE_SETTING.match(line)
         if match:
             key, value = match.groups()
             key = int(key)
             self.set_setting(key, value)
             return
 
-        match = re.compile(r"^G0 X([\d.]+)$").match(line)
-        if match:
-            (x, ) = match.groups()
-            self.move(x)
-            return
-
-        match = re.compile(r"^G1 X([\d.]+)$").match(line)
-        if match:
-            (x, ) = match.groups()
-            self.mill(x)
+        if self.gcode(line):
             return
 
-        match = re.compile(r"^G38.2 Z(-?[\d.]+)$").match(line)
-        if match:
-            (z_to, ) = match.groups()
-            self.probe(z_to)
-            return
-
-        self._serial.write_line(
+        self.write_line(
             "{MockGrbl unexpected request:%s}" % repr(line))
 
 
     def salutation(self):
-        self._serial.write_line("")
-        self._serial.write_line("Grbl 1.1f ['$' for help]")
+        self.write_line("")
+        self.write_line("Grbl 1.1f ['$' for help]")
         if self._settings[setting_index("homing-cycle-enable")]:
-            self._serial.write_line("[MSG:'$H'|'$X' to unlock]")
+            self.write_line("[MSG:'$H'|'$X' to unlock]")
         else:
             self._locked = False
 
 
     def run(self):
         while True:
+            with self._lock:
+                timeout = self._next_event()
             try:
-                line = self._serial.read_line(timeout=False)
+                line = self._serial.read_line(timeout=timeout)
             except ConnectionClosedException:  # pragma: no cover
                 break
-            self.process_line(line)
+            with self._lock:
+                if hasattr(line, "__call__"):
+                    line()
+                elif line is not None:
+                    self.receive(line)
+                self._update()
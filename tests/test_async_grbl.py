@@ -0,0 +1,123 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import asyncio
+import logging
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+import calabo.grbl_exc
+from calabo.async_grbl import AsyncGrbl
+
+
+
+LOG = logging.getLogger("test_async_grbl")
+
+
+
+def run(device, f):
+    """\
+Run the coroutine function `f` with an `AsyncGrbl` for `device`.
+"""
+    async def main():
+        async with AsyncGrbl(device) as grbl:
+            return await f(grbl)
+
+    return asyncio.run(main())
+
+
+
+def test_settings(device_mock):
+    async def f(grbl):
+        assert await grbl.setting("homing-cycle-enable") is False
+
+        await grbl.setting("homing-cycle-enable", True)
+        await grbl._read_settings()
+        assert await grbl.setting("homing-cycle-enable") is True
+
+    run(device_mock, f)
+
+
+
+def test_read_state(device_mock):
+    async def f(grbl):
+        # Many concurrent subscribers share status requests.
+        states = await asyncio.gather(
+            *[grbl.read_state() for i in range(200)])
+        assert set(states) == {"Idle"}
+
+    run(device_mock, f)
+
+
+
+def test_alarm(device_mock):
+    async def f(grbl):
+        await grbl.setting("homing-cycle-enable", True)
+        await grbl.reset()
+        assert await grbl.read_state() == "Alarm"
+        with pytest.raises(calabo.grbl_exc.GrblAlarmJogLockError):
+            await grbl.move(x=1)
+
+    run(device_mock, f)
+
+
+
+def test_commands(device_mock):
+    async def f(grbl):
+        # Concurrent commands are serialized.
+        await asyncio.gather(*[grbl.move(x=i) for i in range(20)])
+        with pytest.raises(calabo.grbl_exc.GrblFeedRateError):
+            await grbl.mill(x=10)
+
+    run(device_mock, f)
+
+
+
+def test_stream(device_mock):
+    """\
+Stream more lines than fit in Grbl's receive buffer at once.
+"""
+    async def f(grbl):
+        lines = ("G0 X%f" % (i / 10) for i in range(200))
+        # Status requests are answered while the stream waits.
+        (progress, _state) = await asyncio.gather(
+            grbl.stream(lines), grbl.read_state())
+        assert progress["sent"] == 200
+        assert progress["acknowledged"] == 200
+
+        # The link is usable for ordinary commands afterwards.
+        await grbl.move(x=1)
+
+    run(device_mock, f)
+
+
+
+def test_stream_error(device_mock):
+    """\
+Errors in a stream are raised once lines in flight are acknowledged.
+"""
+    async def f(grbl):
+        await grbl.setting("homing-cycle-enable", True)
+        await grbl.reset()
+
+        progress = {}
+        with pytest.raises(calabo.grbl_exc.GrblAlarmJogLockError):
+            await grbl.stream(["G0 X%f" % i for i in range(50)], progress)
+
+        assert progress["sent"] < 50
+        assert progress["acknowledged"] == progress["sent"]
+
+    run(device_mock, f)
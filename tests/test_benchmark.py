@@ -0,0 +1,303 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks against the mock Grbl device and in-memory ports.
+
+Results are logged at `INFO` level and, with `--benchmark-json PATH`,
+written to `PATH` for comparison between versions.
+"""
+
+import io
+import sys
+import time
+import logging
+import itertools
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+# Calabo imports
+sys.path.append("../")
+from calabo.grbl import Grbl
+from calabo.serial import Serial, READ_MODES
+from calabo.status import StatusParser
+from calabo.preflight import preflight
+
+from test_serial import BytesPort
+
+
+
+LOG = logging.getLogger("test_benchmark")
+
+
+
+ROUND_TRIPS = 200
+SETTINGS_READS = 20
+STREAM_LINES = 2000
+PREFLIGHT_LINES = 100000
+
+LOAD_CLIENTS = 8
+LOAD_REQUESTS = 250
+
+
+
+def record_latency(benchmark, name, samples):
+    """\
+Record the median and 99th percentile of `samples` in milliseconds.
+"""
+    samples = sorted(samples)
+    benchmark.record(
+        name, 1000 * statistics.median(samples), "ms",
+        p99=1000 * samples[int(len(samples) * 0.99)])
+
+
+
+def status_lines(count):
+    return [
+        "<Run|MPos:%0.3f,-20.000,-5.000|Bf:%d,127|FS:500,8000|Pn:XZ>" % (
+            i / 1000, i % 16)
+        for i in range(count)
+    ]
+
+
+
+def test_read_line(benchmark):
+    """\
+Bytes per second split into lines by `Serial.read_line`.
+"""
+    lines = (status_lines(10) + ["ok"] * 10) * 2000
+    data = "".join(line + "\r\n" for line in lines).encode("utf-8")
+    ser = Serial("bench")
+    ser._ser = BytesPort(data)
+
+    start = time.perf_counter()
+    count = 0
+    while ser.read_line(timeout=0) is not None:
+        count += 1
+    duration = time.perf_counter() - start
+
+    assert count == len(lines)
+    benchmark.record("serial_read_line", len(data) / duration, "bytes/s")
+
+
+
+def test_step(benchmark):
+    """\
+Lines per second read and dispatched by `Grbl._step`, with status
+reports and messages between acknowledgements.
+"""
+    grbl = Grbl("/dev/null")
+    block = status_lines(3) + ["[MSG:Pgm End]", "ok"]
+    commands = 4000
+    data = "".join(
+        line + "\r\n" for line in block * commands).encode("utf-8")
+    grbl._serial._ser = BytesPort(data)
+
+    start = time.perf_counter()
+    for i in range(commands):
+        grbl._set_state("expect_ok")
+        grbl._step(timeout=0)
+    duration = time.perf_counter() - start
+
+    assert grbl._state == "ready"
+    benchmark.record(
+        "grbl_step", len(block) * commands / duration, "lines/s")
+
+
+
+def test_settings_read(grbl_mock, benchmark):
+    """\
+Time to read all settings with `$$`.
+"""
+    samples = []
+    for i in range(SETTINGS_READS):
+        start = time.perf_counter()
+        grbl_mock._read_settings()
+        samples.append(time.perf_counter() - start)
+
+    record_latency(benchmark, "settings_read", samples)
+
+
+
+def test_stream(grbl_mock, benchmark):
+    """\
+Lines per second streamed with character counting.
+"""
+    lines = ["G0 X%0.3f Y%0.3f" % (i / 10, i / 20)
+             for i in range(STREAM_LINES)]
+
+    start = time.perf_counter()
+    progress = grbl_mock.stream(lines)
+    duration = time.perf_counter() - start
+
+    assert progress["acknowledged"] == STREAM_LINES
+    benchmark.record(
+        "stream", STREAM_LINES / duration, "lines/s",
+        bytes_per_second=progress["bytes"] / duration)
+
+
+
+@pytest.mark.parametrize("read_mode", READ_MODES)
+def test_ok_round_trip(grbl_mock, read_mode, benchmark):
+    """\
+Latency from writing a line to receiving its `ok`.
+"""
+    grbl = grbl_mock
+    grbl._serial._read_mode = read_mode
+
+    samples = []
+    for i in range(ROUND_TRIPS):
+        start = time.perf_counter()
+        grbl.move(x=i)
+        samples.append(time.perf_counter() - start)
+
+    record_latency(benchmark, "ok_round_trip_%s" % read_mode, samples)
+
+
+
+def test_realtime_latency(device_mock, benchmark):
+    """\
+Latency from `Grbl.realtime` to the byte being handled by the mock device.
+"""
+    mock = device_mock["mock"]
+
+    with Grbl(device_mock) as grbl:
+        samples = []
+        for i in range(ROUND_TRIPS):
+            mock._realtime_received = None
+            start = time.perf_counter()
+            grbl.realtime("feed-hold" if i % 2 else "cycle-start")
+            while mock._realtime_received is None:
+                time.sleep(0)
+            samples.append(mock._realtime_received[1] - start)
+
+    record_latency(benchmark, "realtime", samples)
+
+
+
+def test_realtime_http_latency(calabo_server, device, benchmark):
+    """\
+Latency from posting a realtime command over HTTP to the byte being
+handled by the mock device.
+"""
+    url = "http://127.0.0.1:5000/realtime/feed-hold"
+    mock = device["mock"]
+
+    samples = []
+    with requests.Session() as session:
+        for i in range(ROUND_TRIPS):
+            mock._realtime_received = None
+            start = time.perf_counter()
+            session.post(url)
+            while mock._realtime_received is None:
+                time.sleep(0)
+            samples.append(mock._realtime_received[1] - start)
+
+    record_latency(benchmark, "realtime_http", samples)
+
+
+
+def test_status_parse(benchmark):
+    """\
+Status reports parsed per second.
+"""
+    parser = StatusParser()
+    lines = status_lines(20000)
+    lines[::30] = [
+        "<Run|MPos:0.000,0.000,0.000|Bf:15,128|FS:500,8000"
+        "|WCO:-5.000,-5.000,-1.000>"
+    ] * len(lines[::30])
+
+    start = time.perf_counter()
+    for line in lines:
+        parser.parse(line)
+    duration = time.perf_counter() - start
+
+    benchmark.record("status_parse", len(lines) / duration, "reports/s")
+
+
+
+def test_dispatch(benchmark):
+    """\
+Responses dispatched per second, in the proportions seen while streaming.
+"""
+    grbl = Grbl("/dev/null")
+    grbl._set_state("stream")
+
+    lines = (
+        ["ok"] * 16 +
+        ["<Run|MPos:10.000,-20.000,-5.000|Bf:3,40|FS:500,8000>"] * 3 +
+        ["[MSG:Pgm End]", "error:22"]
+    ) * 2000
+    grbl._stream_pending.extend([0] * len(lines))
+
+    start = time.perf_counter()
+    for line in lines:
+        grbl._dispatch(line)
+    duration = time.perf_counter() - start
+
+    benchmark.record("dispatch", len(lines) / duration, "lines/s")
+
+
+
+def test_preflight(benchmark):
+    """\
+Bytes of G-code checked by `preflight` per second, for lines and arcs.
+"""
+    pytest.importorskip("numpy")
+
+    data = ("G1 F1200\n" + "".join(
+        "G1 X%.3f Y%.3f\n" % (i % 100, i % 50) if i % 4 else
+        "G2 X%.3f Y%.3f I5 J0\n" % (i % 100, i % 50)
+        for i in range(PREFLIGHT_LINES)
+    )).encode("ascii")
+
+    start = time.perf_counter()
+    preflight(io.BytesIO(data))
+    duration = time.perf_counter() - start
+
+    benchmark.record("preflight", len(data) / duration, "bytes/s")
+
+
+
+def test_settings_load(calabo_server, benchmark):
+    """\
+Requests per second and latency for `GET /settings` from several
+keep-alive clients in parallel.
+"""
+    url = "http://127.0.0.1:5000/settings"
+
+    def client(_):
+        samples = []
+        with requests.Session() as session:
+            for i in range(LOAD_REQUESTS):
+                start = time.perf_counter()
+                response = session.get(url)
+                samples.append(time.perf_counter() - start)
+                assert response.status_code == 200
+        return samples
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=LOAD_CLIENTS) as executor:
+        samples = sorted(itertools.chain.from_iterable(
+            executor.map(client, range(LOAD_CLIENTS))))
+    duration = time.perf_counter() - start
+
+    benchmark.record(
+        "http_get_settings", len(samples) / duration, "requests/s",
+        clients=LOAD_CLIENTS,
+        median_ms=1000 * statistics.median(samples),
+        p99_ms=1000 * samples[int(len(samples) * 0.99)])
@@ -0,0 +1,113 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import sys
+import math
+import logging
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# Calabo imports
+sys.path.append("../")
+from calabo.estimate import estimate, Planner, block_times
+
+
+
+LOG = logging.getLogger("test_estimate")
+
+
+
+SETTINGS = {
+    11: 0.01,
+    12: 0.002,
+    110: 6000,
+    111: 6000,
+    112: 6000,
+    120: 100,
+    121: 100,
+    122: 100,
+}
+
+
+
+def estimate_seconds(gcode, chunk_size=None):
+    return estimate(
+        io.BytesIO(gcode.encode("utf-8")), SETTINGS, chunk_size)["seconds"]
+
+
+
+def test_estimate():
+    # 0.1s accelerating to 10mm/s over 0.5mm, and the same decelerating.
+    assert estimate_seconds("G1 X100 F600\n") == pytest.approx(10.1)
+    # Too short to reach the feed rate.
+    assert estimate_seconds("G1 X0.1 F600\n") == pytest.approx(
+        2 * math.sqrt(0.1 / 100))
+    # Rapid moves at the maximum rate of 100mm/s.
+    assert estimate_seconds("G0 X100\n") == pytest.approx(2)
+    assert estimate_seconds("G93 G1 X10 F6\n") == pytest.approx(10.01)
+
+    # Straight segments run without slowing.
+    gcode = "G1 F600\n" + "".join("X%d\n" % (i + 1) for i in range(100))
+    assert estimate_seconds(gcode) == pytest.approx(10.1)
+    assert estimate_seconds(gcode, chunk_size=16) == pytest.approx(10.1)
+
+    # M commands and dwells stop motion.
+    assert estimate_seconds("G1 X50 F600\nM5\nX100\n") == pytest.approx(10.2)
+    assert estimate_seconds("G1 X50 F600\nG4 P1.5\nX100\n") == \
+        pytest.approx(11.7)
+
+    # Corners slow down, but do not stop.
+    seconds = estimate_seconds("G1 X50 F600\nY50\n")
+    assert 10.1 < seconds < 10.2
+
+    result = estimate(io.BytesIO(b"G2 X0 Y0 I10 F600\n"), SETTINGS)
+    assert result["distance"] == pytest.approx(20 * math.pi, rel=1e-3)
+    assert result["blocks"] > 100
+    assert result["seconds"] == pytest.approx(2 * math.pi + 0.1, rel=1e-3)
+
+
+
+def test_planner():
+    """\
+Chunked planning matches planning each block in turn with the same
+look-ahead.
+"""
+    rng = np.random.default_rng(1)
+    count = 200
+    length = rng.uniform(0.01, 5, count)
+    acceleration = rng.uniform(50, 500, count)
+    nominal = rng.uniform(1, 2500, count)
+    entry = np.minimum(nominal, rng.uniform(0, 3000, count))
+    entry[0] = 0
+
+    lookahead = 4
+    speed = [0]
+    for i in range(1, count + 1):
+        limit = 0
+        for k in range(min(count, i + lookahead) - 1, i - 1, -1):
+            limit = min(entry[k], limit + 2 * acceleration[k] * length[k])
+        speed.append(min(
+            limit, speed[-1] + 2 * acceleration[i - 1] * length[i - 1]))
+    expected = np.sum(block_times(
+        length, acceleration, nominal, np.array(speed[:-1]),
+        np.array(speed[1:])))
+
+    for size in (1, 7, count):
+        planner = Planner(lookahead)
+        for i in range(0, count, size):
+            planner.add(*(a[i:i + size] for a in (
+                length, acceleration, nominal, entry)))
+        assert planner.finish() == pytest.approx(expected)
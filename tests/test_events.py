@@ -0,0 +1,71 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+
+# Calabo imports
+sys.path.append("../")
+from calabo.events import EventHub
+
+
+
+LOG = logging.getLogger("test_events")
+
+
+
+def test_event_hub():
+    hub = EventHub()
+    hub.publish("status", 1)
+
+    fast = hub.subscribe()
+    slow = hub.subscribe()
+
+    # New subscribers receive the latest value of each event.
+    assert fast.get(0) == ("status", 1)
+    assert fast.get(0) is None
+
+    for i in range(2, 100):
+        hub.publish("status", i)
+        assert fast.get(0) == ("status", i)
+    hub.publish("alarm", 5, retain=False)
+
+    # Slow subscribers skip to the latest value, oldest event type first.
+    assert slow.get(0) == ("status", 99)
+    assert slow.get(0) == ("alarm", 5)
+    assert slow.get(0) is None
+
+    hub.unsubscribe(slow)
+    hub.publish("status", 100)
+    assert slow.get(0) is None
+    assert fast.get(0) == ("alarm", 5)
+    assert fast.get(0) == ("status", 100)
+
+    # Events published without `retain` are not sent to later subscribers.
+    late = hub.subscribe()
+    assert late.get(0) == ("status", 100)
+    assert late.get(0) is None
+
+
+
+def test_event_stream():
+    hub = EventHub()
+    hub.publish("status", {"state": "Idle"})
+
+    stream = hub.stream(keepalive=0)
+    assert next(stream) == 'event: status\ndata: {"state": "Idle"}\n\n'
+    assert next(stream) == ": keepalive\n\n"
+
+    hub.close()
+    assert list(stream) == []
+    assert not hub._subscribers
@@ -0,0 +1,119 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.gcode import compact, axis_decimals, GcodeException
+
+
+
+LOG = logging.getLogger("test_gcode")
+
+
+
+def test_axis_decimals():
+    assert axis_decimals({100: 40.0, 101: 800.0, 102: 188.975}) == {
+        "X": 3,
+        "Y": 4,
+        "Z": 3,
+    }
+    assert axis_decimals({}) == {}
+
+
+
+def test_compact():
+    lines = [
+        "%\n",
+        "(Job header)\n",
+        "G21 G90 G17\n",
+        "\n",
+        "G00 Z5.000000\n",
+        "G0 X10.000000 Y-0.250000 ; rapid\n",
+        "G01 Z-1.000000 F100.000000\n",
+        "G1 X20.123456 Y0.000000 F500.000000\n",
+        "G1 X30.000000 F500.000000\n",
+        "g2 x40 y10 i5.00004 j0\n",
+        "G2 X50 Y0 R5.0\n",
+        "G90\n",
+        "G53 G0 Z0\n",
+        "G20\n",
+        "G1 X1.1234567 F500.0\n",
+        "$H\n",
+    ]
+
+    stats = {}
+    out = list(compact(lines, {"X": 3, "Y": 3, "Z": 3}, stats))
+
+    assert out == [
+        "G21G90G17",
+        "G0Z5",
+        "X10Y-.25",
+        "G1Z-1F100",
+        "X20.123Y0F500",
+        "X30",
+        "G2X40Y10I5J0",
+        "X50Y0R5",
+        "G53G0Z0",
+        "G20",
+        "G1X1.12346F500",
+        "$H",
+    ]
+    assert stats["bytes_in"] == sum(len(line) for line in lines)
+    assert stats["bytes_out"] == sum(len(line) + 1 for line in out)
+
+    with pytest.raises(GcodeException):
+        list(compact(["G1 X"]))
+
+
+
+def test_compact_incremental():
+    lines = ["G91", "G1 X0.01234 F100"] * 3 + ["G90 X1.23456"]
+    assert list(compact(lines, {"X": 3})) == [
+        "G91",
+        "G1X.01234F100",
+        "X.01234",
+        "X.01234",
+        "G90X1.235",
+    ]
+
+
+
+def test_compact_program_end():
+    # Grbl resets distance mode to G90 at program end.
+    lines = ["G91", "G0 X1", "M30", "G91", "G0 X1"]
+    assert list(compact(lines)) == ["G91", "G0X1", "M30", "G91", "G0X1"]
+
+    # Grbl resets motion mode to G1 at program end.
+    lines = ["G0 X1", "M2", "G0 X5"]
+    assert list(compact(lines)) == ["G0X1", "M2", "G0X5"]
+
+    # Feed rates are sent again after program end.
+    lines = ["G1 X1 F100", "M2", "G1 X2 F100"]
+    assert list(compact(lines)) == ["G1X1F100", "M2", "X2F100"]
+
+
+
+def test_compact_feed_mode():
+    # Grbl needs a new feed rate after changing feed mode.
+    lines = ["G93 G1 X1 F10", "G94 G1 X2 F10", "X3 F10", "G93 X4 F10"]
+    assert list(compact(lines)) == [
+        "G93G1X1F10",
+        "G94X2F10",
+        "X3",
+        "G93X4F10",
+    ]
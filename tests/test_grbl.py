@@ -12,13 +12,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import time
 import logging
 
 import pytest
 
 # Calabo imports
 sys.path.append("../")
+import calabo.grbl
 import calabo.grbl_exc
+from calabo.grbl import Grbl
+from calabo.settings import SettingsCache
 
 
 
@@ -150,3 +154,228 @@ Test initializing mock Grbl with particular parameters.
     grbl = grbl_mock
     homing_enabled = grbl.setting("homing-cycle-enable")
     assert homing_enabled is False
+
+
+
+def test_stream(grbl):
+    """\
+Stream more lines than fit in Grbl's receive buffer at once.
+"""
+    grbl.setting("homing-cycle-enable", False)
+    lines = ("G0 X%f" % (i / 10) for i in range(200))
+    progress = grbl.stream(lines)
+    assert progress["sent"] == 200
+    assert progress["acknowledged"] == 200
+
+    # The link is usable for ordinary commands afterwards.
+    grbl.move(x=1)
+
+
+
+@pytest.mark.grbl_options({
+    "settings": {
+        "homing-cycle-enable": False,
+        "x-axis-maximum-rate": 6000,
+        "x-axis-maximum-acceleration": 200,
+    },
+})
+def test_stream_timing(grbl_mock, device_mock):
+    """\
+Streamed moves take the time allowed by feed rate and acceleration.
+"""
+    grbl = grbl_mock
+    mock = device_mock["mock"]
+
+    # 20mm at 10mm/s, with 0.05s to reach speed and to stop.
+    start = time.monotonic()
+    grbl.stream(["G1 F600"] + ["G1 X%d" % (i + 1) for i in range(20)])
+
+    # The last lines are acknowledged once the planner has room.
+    assert time.monotonic() - start > 0.4
+
+    status = grbl.status(max_age=0)
+    assert status.state == "Run"
+    assert 0 < status.mpos[0] < 20
+    assert status.feed == 600
+    assert status.planner_blocks < 15
+
+    while mock._state != "Idle":
+        time.sleep(0.01)
+    assert 2 <= time.monotonic() - start < 2.5
+    assert mock._rx_overflows == 0
+
+    status = grbl.status(max_age=0)
+    assert status.mpos[0] == 20
+    assert status.planner_blocks == 15
+    assert status.rx_bytes == 128
+
+
+
+def test_stream_error(grbl):
+    """\
+Errors in a stream are raised once lines in flight are acknowledged.
+"""
+    grbl.setting("homing-cycle-enable", True)
+    grbl.reset()
+
+    progress = {}
+    with pytest.raises(calabo.grbl_exc.GrblAlarmJogLockError):
+        grbl.stream(["G0 X%f" % i for i in range(50)], progress)
+
+    assert progress["sent"] < 50
+    assert progress["acknowledged"] == progress["sent"]
+
+
+
+def test_stream_long_line(grbl):
+    """\
+Lines that do not fit in Grbl's receive buffer are not sent.
+"""
+    grbl.setting("homing-cycle-enable", False)
+    grbl.reset()
+
+    # Non-ASCII characters take more than one byte.
+    assert grbl._serial.line_size("(\u00b5m)") == 6
+
+    progress = {}
+    with pytest.raises(calabo.grbl.StreamException):
+        grbl.stream(["G0 X1", "G0 X2 (%s)" % ("\u00b5" * 60), "G0 X3"],
+                    progress)
+
+    assert progress["sent"] == 1
+    assert progress["acknowledged"] == 1
+
+
+
+def test_status_poller(grbl):
+    grbl.setting("homing-cycle-enable", False)
+    grbl.start_status_poller(interval=0.01)
+    try:
+        (count, _when, _report) = grbl._status.snapshot()
+        assert grbl._status.wait(count + 2, timeout=1)
+
+        # Commands and settings share the link with the poller.
+        for i in range(20):
+            grbl.move(x=i)
+        grbl.setting("homing-cycle-enable", True)
+        grbl.setting("homing-cycle-enable", False)
+
+        assert grbl.status().state == "Idle"
+    finally:
+        grbl.stop_status_poller()
+
+
+
+def test_dispatch():
+    """\
+Responses are routed to handlers without a device.
+"""
+    grbl = Grbl("/dev/null")
+
+    grbl._dispatch("Grbl 1.1f ['$' for help]")
+    assert grbl._state == "ready"
+    assert grbl._version == "1.1f"
+
+    grbl._dispatch("[GC:G0 G54 G17 G21 G90 G94 M5 M9 T0 F0 S0]")
+    grbl._dispatch("<Idle|MPos:0.000,0.000,0.000|FS:0,0>")
+    assert grbl.status().state == "Idle"
+
+    grbl._set_state("expect_probe")
+    grbl._dispatch("ALARM:5")
+    grbl._dispatch("[PRB:-1.000,2.000,-3.500:0]")
+    grbl._dispatch("ok")
+    assert grbl._state == "ready"
+    assert grbl._probe == (-1, 2, -3.5, False)
+    with pytest.raises(calabo.grbl_exc.GrblProbeFailContactAlarm):
+        grbl._probe_result()
+
+    with pytest.raises(calabo.grbl.ResponseException):
+        grbl._dispatch("ok")
+    with pytest.raises(calabo.grbl.ResponseException):
+        grbl._dispatch("Unexpected")
+
+
+
+def test_write_settings(grbl):
+    """\
+Only changed settings are written, homing before soft limits.
+"""
+    grbl.setting("soft-limits-enable", False)
+    grbl.setting("homing-cycle-enable", False)
+
+    written = grbl.write_settings({
+        "soft-limits-enable": True,
+        "homing-cycle-enable": True,
+        "junction-deviation": 0.02,
+    })
+    assert written == [22, 11, 20]
+
+    assert grbl.write_settings({
+        "soft-limits-enable": True,
+        "homing-cycle-enable": True,
+    }) == []
+
+    # Disabling homing also disables soft limits.
+    assert grbl.write_settings({
+        "soft-limits-enable": False,
+        "homing-cycle-enable": False,
+    }) == [22]
+    grbl._read_settings()
+    assert grbl.setting("soft-limits-enable") is False
+    assert grbl.setting("homing-cycle-enable") is False
+
+
+
+def test_settings_cache(device_mock, tmp_path):
+    cache = SettingsCache(str(tmp_path))
+
+    with Grbl(device_mock, settings_cache=cache) as grbl:
+        assert grbl._settings_refresh is None
+        settings = dict(grbl._settings)
+        identity = grbl._identity()
+        version = grbl._version
+
+    assert cache.load(identity, version) == settings
+
+    with Grbl(device_mock, settings_cache=cache) as grbl:
+        # Settings come from the snapshot and are refreshed afterwards.
+        assert grbl._settings == settings
+        assert grbl._settings_refresh is not None
+        grbl._settings_refresh.join()
+        assert grbl._settings == settings
+
+        grbl.setting("homing-cycle-enable", not settings[22])
+        assert cache.load(identity, version) is None
+
+    assert cache.load(identity, "0.0x") is None
+
+
+
+def test_initialize_soft_reset(device_mock, monkeypatch):
+    """\
+Test that a device that does not reset on connection is soft reset.
+"""
+    monkeypatch.setattr(calabo.grbl, "DEFAULT_BOOT_RETRY_INTERVAL", 0.2)
+
+    with Grbl(dict(device_mock, reset=None)) as grbl:
+        assert grbl._version == "1.1f"
+        assert 0.2 <= grbl._boot_time < 1
+
+        grbl.reset()
+        assert grbl._boot_time < 0.2
+        assert grbl._settings
+
+
+
+def test_realtime(grbl_mock):
+    grbl = grbl_mock
+    grbl.realtime("feed-override-plus-10")
+    grbl.realtime("rapid-override-25")
+    grbl.realtime("spindle-override-minus-1")
+    assert grbl.status(max_age=0).overrides == (110, 25, 99)
+
+    grbl.realtime("feed-override-reset")
+    assert grbl.status(max_age=0).overrides == (100, 25, 99)
+
+    with pytest.raises(calabo.grbl.RealtimeException):
+        grbl.realtime("self-destruct")
@@ -15,7 +15,9 @@ import os
 import time
 import json
 import logging
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 
 import pytest
@@ -75,3 +77,369 @@ def test_settings(calabo_server, settings_1, settings_2):
     assert request.status_code == 200
     settings = request.json()
     assert settings == settings_2
+
+
+
+def test_status(calabo_server):
+    url = "http://127.0.0.1:5000/status"
+
+    request = requests.get(url)
+    assert request.status_code == 200
+    status = request.json()
+    assert status["state"] in ("Idle", "Alarm")
+    assert status["age"] >= 0
+
+
+
+def test_realtime(calabo_server):
+    url = "http://127.0.0.1:5000/realtime"
+
+    request = requests.post("%s/feed-override-minus-10" % url)
+    assert request.status_code == 200
+
+    request = requests.post("%s/self-destruct" % url)
+    assert request.status_code == 404
+
+    for i in range(20):
+        status = requests.get("http://127.0.0.1:5000/status").json()
+        if status["overrides"] == [90, 100, 100]:
+            break
+        time.sleep(0.05)
+    assert status["overrides"] == [90, 100, 100]
+
+
+
+def test_job(calabo_server):
+    url = "http://127.0.0.1:5000/jobs"
+
+    calabo_server.settings("homing-cycle-enable", False)
+    gcode = "".join("G0 X%f\n" % (i / 10) for i in range(500))
+
+    request = requests.post(url, data=gcode.encode("utf-8"), headers={
+        "Content-type": "application/octet-stream",
+    })
+    assert request.status_code == 201
+    job = request.json()
+    assert job["size"] == len(gcode)
+    assert job["state"] in ("checking", "pending")
+
+    for i in range(100):
+        request = requests.get("%s/%d" % (url, job["id"]))
+        assert request.status_code == 200
+        job = request.json()
+        if job["state"] not in ("checking", "pending", "running"):
+            break
+        time.sleep(0.05)
+
+    assert job["state"] == "complete"
+    assert job["estimate"]["lines"] == 500
+    assert job["sent"] == 500
+    assert job["acknowledged"] == 500
+    assert job["bytes"] + job["bytes_saved"] == len(gcode)
+    assert job["bytes_saved"] > len(gcode) / 2
+    assert job["elapsed"] > 0
+
+    request = requests.get("%s/%d" % (url, job["id"] + 1))
+    assert request.status_code == 404
+
+
+
+def test_job_busy(calabo_server):
+    url = "http://127.0.0.1:5000/jobs"
+
+    calabo_server.settings("homing-cycle-enable", False)
+    gcode = "".join("G0 X%f\n" % (i / 10) for i in range(500))
+
+    request = requests.post(url, data=gcode.encode("utf-8"))
+    assert request.status_code == 201
+    job = request.json()
+
+    request = requests.post(url, data=gcode.encode("utf-8"))
+    assert request.status_code == 409
+    request = requests.post("http://127.0.0.1:5000/jog", json={"x": 0.5})
+    assert request.status_code == 409
+
+    for i in range(100):
+        job = requests.get("%s/%d" % (url, job["id"])).json()
+        if job["state"] not in ("checking", "pending", "running"):
+            break
+        time.sleep(0.05)
+    assert job["state"] == "complete"
+
+    request = requests.post(url, data=b"G0 X1\n")
+    assert request.status_code == 201
+
+
+
+def test_job_storing(calabo_server):
+    """\
+The machine is reserved while a job is uploaded, without blocking
+requests that conflict with it.
+"""
+    machine = calabo_server.machine()
+    release = threading.Event()
+
+    class SlowStream():
+        def __init__(self, data, error=None):
+            self._data = [data]
+            self._error = error
+
+        def read(self, size):
+            assert release.wait(5)
+            if self._error:
+                raise self._error
+            return self._data.pop() if self._data else b""
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(machine.add_job, SlowStream(b"G0 X1\n"))
+        while not machine.job_running():
+            time.sleep(0.01)
+
+        start = time.monotonic()
+        request = requests.post("http://127.0.0.1:5000/jog", json={"x": 0})
+        assert request.status_code == 409
+        request = requests.post("http://127.0.0.1:5000/jobs", data=b"G0 X1\n")
+        assert request.status_code == 409
+        assert time.monotonic() - start < 1
+
+        release.set()
+        job = future.result()
+    assert job["size"] == 6
+
+    for i in range(100):
+        if not machine.job_running():
+            break
+        time.sleep(0.05)
+
+    # A failed upload frees the machine.
+    with pytest.raises(OSError):
+        machine.add_job(SlowStream(b"", OSError("Connection reset")))
+    assert not machine.job_running()
+
+
+
+@pytest.mark.grbl_options({
+    "settings": {
+        "soft-limits-enable": True,
+        "x-axis-maximum-travel": 100,
+    },
+})
+def test_job_travel(calabo_server):
+    url = "http://127.0.0.1:5000/jobs"
+
+    def checked(data):
+        request = requests.post(url, data=data)
+        assert request.status_code == 201
+        job = request.json()
+        for i in range(100):
+            if job["state"] != "checking":
+                break
+            time.sleep(0.05)
+            job = requests.get("%s/%d" % (url, job["id"])).json()
+        return job
+
+    job = checked(b"G0 X-50\nG0 X10\n")
+    assert job["state"] == "rejected"
+    assert "X to 10.000 is above 0.000" in job["error"]
+
+    # Rejected jobs do not stop others.
+    job = checked(b"G0 X-50\nG0 X0\n")
+    assert job["state"] != "rejected"
+    assert job["bounds"]["x"] == [-50, 0]
+
+
+
+@pytest.mark.grbl_options({
+    "settings": {
+        "x-axis-maximum-rate": 6000,
+        "x-axis-maximum-acceleration": 100,
+    },
+})
+def test_estimate(calabo_server):
+    url = "http://127.0.0.1:5000/estimate"
+
+    request = requests.post(url, data=b"G0 X100\n")
+    assert request.status_code == 200
+    assert request.json()["seconds"] == pytest.approx(2)
+
+    request = requests.post(url, data=b"G1 X100\n")
+    assert request.status_code == 400
+
+
+
+@pytest.mark.grbl_options({
+    "settings": {
+        "homing-cycle-enable": False,
+        "x-axis-maximum-rate": 8000,
+        "x-axis-maximum-acceleration": 500,
+    },
+})
+def test_jog(calabo_server, device):
+    url = "http://127.0.0.1:5000/jog"
+    mock = device["mock"]
+
+    request = requests.post(url, json={"w": 1})
+    assert request.status_code == 400
+
+    with requests.Session() as session:
+        for i in range(10):
+            request = session.post(url, json={"x": 0.5})
+            assert request.status_code == 200
+            time.sleep(0.05)
+
+        assert request.json()["running"]
+        assert mock._state == "Jog"
+
+        request = session.post(url, json={"x": 0})
+        assert request.status_code == 200
+
+    for i in range(20):
+        if mock._state == "Idle":
+            break
+        time.sleep(0.05)
+    assert mock._state == "Idle"
+    assert mock._jog_lines[0].startswith("$J=G91G21X")
+
+
+
+def test_events(calabo_server):
+    url = "http://127.0.0.1:5000/events"
+
+    count = calabo_server.machine()._grbl._status.snapshot()[0]
+
+    streams = [requests.get(url, stream=True, timeout=5) for i in range(5)]
+    for request in streams:
+        assert request.status_code == 200
+        assert request.headers["Content-Type"].startswith("text/event-stream")
+        lines = request.iter_lines(decode_unicode=True)
+        assert next(lines) == "event: status"
+        status = json.loads(next(lines)[len("data: "):])
+        assert status["state"] in ("Idle", "Alarm")
+
+    for request in streams:
+        request.close()
+
+    # Subscribers are served from the poller, not extra status requests.
+    (count_after, _time, _report) = calabo_server.machine()._grbl._status.snapshot()
+    assert count_after - count < 10
+
+
+
+def test_machines(calabo_server_machines):
+    url = "http://127.0.0.1:5000/machines"
+
+    request = requests.get(url)
+    assert request.status_code == 200
+    assert [m["id"] for m in request.json()] == ["a", "b", "c"]
+
+    request = requests.get("%s/%s/status" % (url, "x"))
+    assert request.status_code == 404
+
+    gcode = "".join("G0 X%f\n" % (i / 10) for i in range(500))
+
+    def run_job(machine_id):
+        machine_url = "%s/%s" % (url, machine_id)
+        request = requests.post("%s/settings" % machine_url, data=json.dumps({
+            "homing-cycle-enable": False,
+        }), headers={
+            "Content-type": "application/json",
+        })
+        assert request.status_code == 200
+
+        request = requests.post("%s/jobs" % machine_url, data=gcode)
+        assert request.status_code == 201
+        job = request.json()
+
+        for i in range(100):
+            job = requests.get("%s/jobs/%d" % (machine_url, job["id"])).json()
+            if job["state"] not in ("checking", "pending", "running"):
+                break
+            time.sleep(0.05)
+        return job
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        jobs = list(executor.map(run_job, ("a", "b", "c")))
+
+    for job in jobs:
+        assert job["state"] == "complete"
+        assert job["acknowledged"] == 500
+
+    # Stall machine `a` by holding its serial link.
+    stalled = calabo_server_machines.machine("a")
+    stalled._call_timeout = 0.5
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with stalled._grbl._lock:
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = {
+                machine_id: executor.submit(
+                    requests.get, "%s/%s/settings" % (url, machine_id),
+                    params={"from-device": "true"})
+                for machine_id in ("a", "b", "c")
+            }
+            start = time.monotonic()
+            assert futures["b"].result().status_code == 200
+            assert futures["c"].result().status_code == 200
+            assert time.monotonic() - start < 0.5
+            assert futures["a"].result().status_code == 504
+    finally:
+        release.set()
+        thread.join()
+
+
+
+def test_metrics(calabo_server):
+    url = "http://127.0.0.1:5000"
+
+    requests.post("%s/settings" % url, data=json.dumps({
+        "homing-cycle-enable": False,
+    }), headers={
+        "Content-type": "application/json",
+    })
+    requests.get("%s/settings" % url)
+
+    request = requests.get("%s/metrics" % url)
+    assert request.status_code == 200
+    assert request.headers["Content-Type"].startswith("text/plain")
+    lines = request.text.splitlines()
+
+    assert "# TYPE calabo_serial_bytes_total counter" in lines
+    assert any(
+        line.startswith('calabo_grbl_ok_seconds_count{machine="default"}')
+        for line in lines)
+    assert any(
+        line.startswith('calabo_http_request_seconds_count'
+                        '{endpoint="settings_get",method="GET"}')
+        for line in lines)
+
+
+
+def test_quit(calabo_server):
+    url = "http://127.0.0.1:5000/quit"
+
+    calabo_server.stop()
+    thread = threading.Thread(target=calabo_server.run)
+    thread.start()
+
+    for i in range(20):
+        if calabo_server._server:
+            break
+        time.sleep(0.05)
+
+    request = requests.post(url)
+    assert request.status_code == 200
+    thread.join(2)
+    assert not thread.is_alive()
+
+    with pytest.raises(requests.ConnectionError):
+        requests.get("http://127.0.0.1:5000/status")
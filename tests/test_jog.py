@@ -0,0 +1,130 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import logging
+import threading
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.jog import Jogger, JogException, jog_velocity, jog_increment, \
+    JOG_BLOCKS, MIN_JOG_INTERVAL
+
+
+
+LOG = logging.getLogger("test_jog")
+
+
+
+SETTINGS = {
+    110: 8000.0,
+    111: 8000.0,
+    112: 500.0,
+    120: 500.0,
+    121: 500.0,
+    122: 50.0,
+}
+
+
+
+class RecordingGrbl():
+    def __init__(self):
+        self._settings = SETTINGS
+        self.log = []
+
+
+    def realtime(self, command):
+        self.log.append(command)
+
+
+    def stream(self, lines, progress, flush=False):
+        assert flush
+        progress["sent"] = 0
+        for line in lines:
+            self.log.append(line)
+            progress["sent"] += 1
+
+
+
+def test_velocity():
+    assert jog_velocity({"x": 2, "y": "-0.5"}) == {"X": 1.0, "Y": -0.5}
+
+    with pytest.raises(JogException):
+        jog_velocity({"a": 1})
+    with pytest.raises(JogException):
+        jog_velocity({"x": "fast"})
+    with pytest.raises(JogException):
+        jog_velocity([1, 0, 0])
+
+
+
+def test_increment():
+    assert jog_increment({"X": 0}, SETTINGS) is None
+
+    # Slow increments last the minimum interval.
+    (line, duration) = jog_increment({"X": 0.1}, SETTINGS, {"X": 3})
+    assert line == "$J=G91G21X.267F800"
+    assert duration == MIN_JOG_INTERVAL
+
+    # Fast increments queue enough distance to stop.
+    (line, duration) = jog_increment({"X": 1}, SETTINGS)
+    speed = 8000 / 60
+    assert duration * speed * (JOG_BLOCKS - 1) == \
+        pytest.approx(speed ** 2 / (2 * 500))
+
+    # The slowest axis limits acceleration.
+    (line, duration) = jog_increment({"X": 0.1, "Z": -1}, SETTINGS)
+    assert "Z-" in line
+    assert duration > jog_increment({"X": 0.1}, SETTINGS)[1]
+
+
+
+def test_jogger_timeout():
+    grbl = RecordingGrbl()
+    jogger = Jogger(grbl, timeout=0.1)
+
+    assert jogger.update({"x": 0.5})
+    thread = threading.Thread(target=jogger.run)
+    thread.start()
+
+    for i in range(3):
+        time.sleep(0.05)
+        assert not jogger.update({"x": 0.5})
+    start = time.monotonic()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert time.monotonic() - start < 0.2
+
+    lines = [line for line in grbl.log if line.startswith("$J=")]
+    assert len(lines) >= JOG_BLOCKS
+    assert grbl.log[-1] == "jog-cancel"
+    assert not jogger.running()
+
+
+
+def test_jogger_stop():
+    grbl = RecordingGrbl()
+    jogger = Jogger(grbl, timeout=10)
+
+    assert jogger.update({"y": -1})
+    thread = threading.Thread(target=jogger.run)
+    thread.start()
+    time.sleep(0.05)
+
+    jogger.stop()
+    assert "jog-cancel" in grbl.log
+    thread.join(1)
+    assert not thread.is_alive()
@@ -0,0 +1,93 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import logging
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.serial import Serial, ConnectionClosedException
+from calabo.loopback import loopback_pair
+
+
+
+LOG = logging.getLogger("test_loopback")
+
+
+
+def test_loopback():
+    (host, device) = loopback_pair()
+
+    assert host.write(b"G0 X1\n") == 6
+    assert device.in_waiting == 6
+    assert device.read(3) == b"G0 "
+    assert device.read(10) == b"X1\n"
+    assert device.read(10) == b""
+
+    device.write(b"ok\r\n")
+    host.reset_input_buffer()
+    assert host.in_waiting == 0
+
+    changes = []
+    device.dsr_hook = changes.append
+    host.dtr = False
+    host.dtr = False
+    host.dtr = True
+    assert device.dsr
+    assert changes == [False, True]
+
+    # Bytes written while the other end is closed are lost.
+    host.close()
+    device.write(b"ok\r\n")
+    host.open()
+    assert host.in_waiting == 0
+
+
+
+def test_loopback_serial():
+    (host, device) = loopback_pair()
+
+    with Serial("device", port=device) as ser_device:
+        with Serial("host", port=host) as ser_host:
+            ser_host.write_line("$$")
+            assert ser_device.read_line(timeout=1) == "$$"
+
+            ser_device.write_line("ok")
+            assert ser_host.read_line(timeout=1) == "ok"
+
+        # Closing one end stops a read waiting on it.
+        ser_device._ser.close()
+        with pytest.raises(ConnectionClosedException):
+            ser_device.read_line(timeout=1)
+
+
+
+def test_loopback_latency():
+    (host, device) = loopback_pair(latency=0.05, baud_rate=10000)
+
+    start = time.monotonic()
+    host.write(b"x" * 100)
+    host.write(b"y" * 100)
+    while device.in_waiting < 100:
+        time.sleep(0.001)
+    first = time.monotonic() - start
+    while device.in_waiting < 200:
+        time.sleep(0.001)
+    second = time.monotonic() - start
+
+    # 1ms per byte, plus latency.
+    assert 0.14 < first < 0.2
+    assert 0.24 < second < 0.3
@@ -0,0 +1,82 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+
+# Calabo imports
+sys.path.append("../")
+from calabo.grbl import Grbl
+from calabo.metrics import Exposition, Histogram
+
+
+
+LOG = logging.getLogger("test_metrics")
+
+
+
+def test_exposition():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+
+    exposition = Exposition()
+    exposition.counter("test_total", "A counter.", 3, {"name": 'a"b'})
+    exposition.gauge("test_gauge", "A gauge.", None)
+    exposition.histogram("test_seconds", "A histogram.", histogram, {"x": 1})
+    exposition.counter("test_total", "A counter.", 4, {"name": "c"})
+
+    assert exposition.render().splitlines() == [
+        "# HELP test_total A counter.",
+        "# TYPE test_total counter",
+        'test_total{name="a\\"b"} 3',
+        'test_total{name="c"} 4',
+        "# HELP test_gauge A gauge.",
+        "# TYPE test_gauge gauge",
+        "test_gauge NaN",
+        "# HELP test_seconds A histogram.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{x="1",le="0.1"} 2',
+        'test_seconds_bucket{x="1",le="1"} 3',
+        'test_seconds_bucket{x="1",le="+Inf"} 4',
+        'test_seconds_sum{x="1"} 2.65',
+        'test_seconds_count{x="1"} 4',
+    ]
+
+
+
+def test_grbl_metrics():
+    """\
+Responses are counted without a device.
+"""
+    grbl = Grbl("/dev/null")
+    grbl._dispatch("Grbl 1.1f ['$' for help]")
+    grbl._dispatch("<Run|MPos:0.000,0.000,0.000|Bf:12,100|FS:0,0>")
+
+    grbl._set_state("stream")
+    grbl._stream_pending.extend([10, 10])
+    grbl._stream_sent.extend([0, 0])
+    grbl._stream_in_flight = 20
+    grbl._dispatch("ok")
+    grbl._dispatch("error:22")
+    grbl._dispatch("ALARM:5")
+
+    exposition = Exposition()
+    grbl.collect_metrics(exposition, {"machine": "a"})
+    lines = exposition.render().splitlines()
+
+    assert 'calabo_grbl_ok_seconds_count{machine="a"} 2' in lines
+    assert 'calabo_grbl_planner_blocks_free{machine="a"} 12' in lines
+    assert 'calabo_grbl_rx_in_flight_bytes{machine="a"} 0' in lines
+    assert 'calabo_grbl_errors_total{machine="a",code="22"} 1' in lines
+    assert 'calabo_grbl_alarms_total{machine="a",code="5"} 1' in lines
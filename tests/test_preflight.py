@@ -0,0 +1,104 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import sys
+import logging
+
+import pytest
+
+pytest.importorskip("numpy")
+
+# Calabo imports
+sys.path.append("../")
+from calabo.preflight import preflight, PreflightException
+
+
+
+LOG = logging.getLogger("test_preflight")
+
+
+
+SETTINGS = {
+    20: True,
+    130: 300,
+    131: 200,
+    132: 50,
+}
+
+
+
+def test_preflight():
+    gcode = (
+        b"G21 G90\n"
+        b"G0 Z5\n"
+        b"G0 X0 Y0\n"
+        b"G1 Z-1 F300\n"
+        b"G2 X20 Y0 I10\n"
+        b"G91 G1 X10 Y-10\n"
+        b"G90 G0 Z5\n"
+    )
+    offsets = {540: (-150, -100, -20)}
+
+    result = preflight(
+        io.BytesIO(gcode), SETTINGS, (-140, -100, -5), offsets)
+    assert result["bounds"] == {
+        "x": [-150, -120],
+        "y": [-110, -90],
+        "z": [-21, -5],
+    }
+    assert result["estimate"]["lines"] == 7
+
+    # The last move passes the end of the travel in X.
+    offsets = {540: (-20, -10, -20)}
+    with pytest.raises(PreflightException) as e:
+        preflight(io.BytesIO(gcode), SETTINGS, (-140, -100, -5), offsets)
+    assert str(e.value) == (
+        "Job exceeds machine travel: X to 10.000 is above 0.000")
+
+    # Nothing is checked without soft limits.
+    preflight(io.BytesIO(gcode), {**SETTINGS, 20: False},
+              (-140, -100, -5), offsets)
+
+    # Absolute moves are not checked if the work offset is unknown.
+    result = preflight(io.BytesIO(gcode), SETTINGS, (-140, -100, -5), {})
+    assert result["bounds"]["x"] == [None, None]
+    result = preflight(io.BytesIO(gcode), SETTINGS, (None, ) * 3, {})
+    assert result["bounds"]["x"] == [None, None]
+
+
+
+def test_preflight_home():
+    """\
+Positions after `G28` and `G30` are unknown until set by absolute words.
+"""
+    offsets = {540: (-150, -100, -20)}
+
+    # The intermediate point is checked.
+    with pytest.raises(PreflightException) as e:
+        preflight(io.BytesIO(b"G28 Z30\n"), SETTINGS, (-140, -100, -5),
+                  offsets)
+    assert str(e.value) == (
+        "Job exceeds machine travel: Z to 10.000 is above 0.000")
+
+    result = preflight(io.BytesIO(
+        b"G0 X10 Y10\n"
+        b"G30\n"
+        b"G91 G0 X-10\n"
+        b"G90 G0 X0 Y0\n"
+    ), SETTINGS, (-140, -100, -5), offsets)
+    assert result["bounds"] == {
+        "x": [None, None],
+        "y": [None, None],
+        "z": [None, None],
+    }
@@ -0,0 +1,81 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import logging
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.grbl import Grbl
+from calabo.grbl_settings import SETTINGS, setting_to_string
+from calabo.recorder import Recorder, ReplayPort, RecordingException, \
+    read_records, READ, WRITE
+
+
+
+LOG = logging.getLogger("test_recorder")
+
+
+
+def session():
+    """\
+Records of a short controller session: startup, `$$` and one move.
+"""
+    settings = "".join(
+        "$%d=%s\r\n" % (k, setting_to_string(k, v["default"]))
+        for (k, v) in SETTINGS.items())
+    return [
+        (0.05, READ, b"\r\nGrbl 1.1f ['$' for help]\r\n"),
+        (0.06, WRITE, b"$$\n"),
+        (0.08, READ, settings.encode("utf-8") + b"ok\r\n"),
+        (0.10, WRITE, b"G0 X1.000000\n"),
+        (0.13, READ, b"ok\r\n"),
+    ]
+
+
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / "session.rec")
+
+    port = ReplayPort(session())
+    with Recorder(path) as recorder:
+        with Grbl({"address": "replay", "port": port},
+                  recorder=recorder) as grbl:
+            grbl.move(x=1)
+    assert port.mismatches == 0
+    assert port.done()
+
+    records = list(read_records(path))
+    assert [(d, data) for (_t, d, data) in records] == \
+        [(d, data) for (_t, d, data) in session()]
+
+    # The recording replays with at least the recorded response delay of
+    # 0.03s. The upper bound only guards against waiting for a timeout.
+    port = ReplayPort(path)
+    with Grbl({"address": "replay", "port": port}) as grbl:
+        start = time.monotonic()
+        grbl.move(x=1)
+        assert 0.02 < time.monotonic() - start < 1.0
+        assert grbl._version == "1.1f"
+    assert port.mismatches == 0
+
+
+
+def test_read_invalid(tmp_path):
+    path = tmp_path / "invalid.rec"
+    path.write_bytes(b"G0 X1\n")
+    with pytest.raises(RecordingException):
+        list(read_records(str(path)))
@@ -0,0 +1,111 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.scheduler import Scheduler, SchedulerStoppedException, \
+    PRIORITY_STREAM, PRIORITY_SETTINGS, PRIORITY_QUERY
+
+
+
+LOG = logging.getLogger("test_scheduler")
+
+
+
+class RecordingGrbl():
+    def __init__(self):
+        self.log = []
+
+
+    def realtime(self, command):
+        self.log.append(command)
+
+
+
+def test_priority():
+    grbl = RecordingGrbl()
+    release = threading.Event()
+
+    with Scheduler(grbl, name="test") as scheduler:
+        blocker = scheduler.submit(release.wait)
+
+        futures = [
+            scheduler.submit(grbl.log.append, name, priority=priority)
+            for (name, priority) in (
+                ("query-1", PRIORITY_QUERY),
+                ("settings-1", PRIORITY_SETTINGS),
+                ("stream", PRIORITY_STREAM),
+                ("query-2", PRIORITY_QUERY),
+                ("settings-2", PRIORITY_SETTINGS),
+            )
+        ]
+
+        # Realtime commands do not wait for the queue.
+        scheduler.realtime("feed-hold")
+        assert grbl.log == ["feed-hold"]
+
+        release.set()
+        for future in futures:
+            future.result(1)
+        assert blocker.result() is True
+
+    assert grbl.log == [
+        "feed-hold", "stream", "settings-1", "settings-2", "query-1", "query-2"]
+
+    with pytest.raises(SchedulerStoppedException):
+        scheduler.submit(grbl.log.append, "late")
+
+
+
+def test_stop_cancels_pending():
+    grbl = RecordingGrbl()
+    release = threading.Event()
+
+    scheduler = Scheduler(grbl, name="test")
+    scheduler.start()
+    scheduler.submit(release.wait)
+    pending = scheduler.submit(grbl.log.append, "pending")
+
+    threading.Timer(0.1, release.set).start()
+    scheduler.stop()
+    assert pending.cancelled()
+    assert grbl.log == []
+
+
+
+def test_concurrent_settings(grbl_mock):
+    """\
+Settings written from many threads at once all reach the device.
+"""
+    values = {key: 1000 + key for key in (110, 111, 112, 120, 121, 122)}
+
+    with Scheduler(grbl_mock, name="mock") as scheduler:
+        def write(key):
+            return scheduler.submit(
+                grbl_mock.setting, key, values[key],
+                priority=PRIORITY_SETTINGS).result(5)
+
+        with ThreadPoolExecutor(max_workers=len(values)) as executor:
+            list(executor.map(write, values))
+
+        scheduler.submit(grbl_mock._read_settings).result(5)
+
+    for (key, value) in values.items():
+        assert grbl_mock.setting(key) == value
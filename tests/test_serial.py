@@ -0,0 +1,62 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+
+# Calabo imports
+sys.path.append("../")
+from calabo.serial import Serial
+
+
+
+LOG = logging.getLogger("test_serial")
+
+
+
+class BytesPort():
+    """\
+Minimal stand-in for a `serial.Serial` port that returns canned bytes.
+"""
+
+    def __init__(self, data):
+        self._data = bytearray(data)
+
+
+    @property
+    def in_waiting(self):
+        return len(self._data)
+
+
+    def read(self, size=1):
+        data = bytes(self._data[:size])
+        del self._data[:size]
+        return data
+
+
+
+def test_read_line_endings():
+    hook = object()
+    ser = Serial("test", realtime_hooks={"?": lambda: hook})
+    ser._ser = BytesPort(b"one\rtwo\nthree\r\nfo?ur\r\n\nok\r\n")
+
+    lines = []
+    while True:
+        line = ser.read_line()
+        if line is None:
+            break
+        if hasattr(line, "__call__"):
+            line = line()
+        lines.append(line)
+
+    assert lines == ["one", "two", "three", hook, "four", "", "ok"]
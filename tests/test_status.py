@@ -0,0 +1,61 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import logging
+
+import pytest
+
+# Calabo imports
+sys.path.append("../")
+from calabo.status import StatusParser, StatusException
+
+
+
+LOG = logging.getLogger("test_status")
+
+
+
+def test_parse_status():
+    parser = StatusParser()
+
+    report = parser.parse(
+        "<Hold:1|MPos:-10.000,-20.000,-5.000|Bf:15,128|FS:500,8000"
+        "|WCO:-5.000,-5.000,-1.000|Ov:100,100,100|Ln:99|Pn:XZ|A:SF>")
+    assert report.state == "Hold"
+    assert report.substate == 1
+    assert report.mpos == (-10, -20, -5)
+    assert report.wpos == (-5, -15, -4)
+    assert report.planner_blocks == 15
+    assert report.rx_bytes == 128
+    assert (report.feed, report.speed) == (500, 8000)
+    assert report.overrides == (100, 100, 100)
+    assert report.line == 99
+    assert report.pins == "XZ"
+    assert report.accessories == "SF"
+
+    # Work offset and overrides are carried forward when omitted.
+    report = parser.parse("<Run|WPos:1.000,2.000,3.000|F:250>")
+    assert report.state == "Run"
+    assert report.substate is None
+    assert report.wpos == (1, 2, 3)
+    assert report.mpos == (-4, -3, 2)
+    assert report.feed == 250
+    assert report.overrides == (100, 100, 100)
+
+    with pytest.raises(StatusException):
+        parser.parse("<Busy|MPos:0,0,0>")
+    with pytest.raises(StatusException):
+        parser.parse("<Idle|Bf:x,1>")
+    with pytest.raises(StatusException):
+        parser.parse("Idle")
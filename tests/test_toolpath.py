@@ -0,0 +1,160 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import sys
+import math
+import logging
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# Calabo imports
+sys.path.append("../")
+from calabo.toolpath import tokenize, read_chunks, read_moves, arcs, \
+    bounds, Toolpath, ToolpathException
+
+
+
+LOG = logging.getLogger("test_toolpath")
+
+
+
+def test_tokenize():
+    data = (
+        b"%\n"
+        b"(Job header)\n"
+        b"g21 G90\n"
+        b"G1 X-1.5 y+2 Z.25 F100. ; feed\n"
+        b"$H\n"
+        b"G38.2 Z-10 (probe) F50\n"
+    )
+    (lines, line, letter, value) = tokenize(data)
+    assert lines == 6
+    assert [(l, chr(ord("A") + c), v) for (l, c, v) in zip(
+        line.tolist(), letter.tolist(), value.tolist())] == [
+            (2, "G", 21), (2, "G", 90),
+            (3, "G", 1), (3, "X", -1.5), (3, "Y", 2), (3, "Z", 0.25),
+            (3, "F", 100),
+            (5, "G", 38.2), (5, "Z", -10), (5, "F", 50),
+        ]
+
+    for data in (b"G1 X\n", b"G1 X1.2.3\n", b"G1 X1-\n", b"G1\n12 G1\n"):
+        with pytest.raises(ToolpathException):
+            tokenize(data)
+
+
+
+def test_read_chunks():
+    data = b"G0 X1\nG0 X2\nG0 X3"
+    assert list(read_chunks(io.BytesIO(data), 8)) == [
+        b"G0 X1\n", b"G0 X2\n", b"G0 X3\n"]
+
+
+
+def test_moves():
+    toolpath = Toolpath()
+    moves = toolpath.parse(
+        b"G0 X10 Y10\n"
+        b"G91 G1 X5 F600\n"
+        b"G20 Y1\n"
+        b"G90 G21 G92 X0 Y0\n"
+        b"X1 M3\n"
+        b"G4 P2.5\n"
+        b"G28 Z5\n"
+    )
+    assert moves.line.tolist() == [1, 2, 3, 5, 7]
+    # Positions are in machine coordinates, so do not change with G92.
+    assert moves.start.tolist() == [
+        [0, 0, 0], [10, 10, 0], [15, 10, 0], [15, 35.4, 0], [16, 35.4, 0]]
+    assert moves.end.tolist() == [
+        [10, 10, 0], [15, 10, 0], [15, 35.4, 0], [16, 35.4, 0],
+        [16, 35.4, 5]]
+    # G28 moves to its intermediate point at the rapid rate.
+    assert moves.motion.tolist() == [0, 10, 10, 10, 0]
+    assert moves.feed[1:4].tolist() == [600, 600, 600]
+    assert moves.stops.tolist() == [5, 6, 7]
+    assert moves.dwell == 2.5
+
+    # Modal state carries over to the next chunk. The position after G28
+    # is unknown until set by absolute words.
+    moves = toolpath.parse(b"Y2\nG91 X1\nG90 X0 Z0\n")
+    assert moves.line.tolist() == [8, 9, 10]
+    np.testing.assert_equal(moves.start, [
+        [np.nan, np.nan, np.nan],
+        [np.nan, 37.4, np.nan],
+        [np.nan, 37.4, np.nan],
+    ])
+    np.testing.assert_equal(moves.end, [
+        [np.nan, 37.4, np.nan],
+        [np.nan, 37.4, np.nan],
+        [15, 37.4, 0],
+    ])
+
+    with pytest.raises(ToolpathException):
+        Toolpath().parse(b"G1 X1\n")
+
+
+
+def test_arcs():
+    data = (
+        b"G1 X10 F600\n"
+        b"G3 X0 Y10 I-10\n"
+        b"G2 X10 Y0 R-10\n"
+    )
+    moves = next(read_moves(io.BytesIO(data)))
+    (axes, center, radius, travel) = arcs(moves, moves.motion != 10)
+    assert axes.tolist() == [[0, 1, 2], [0, 1, 2]]
+    assert center.tolist() == [[0, 0, 0], [10, 10, 0]]
+    assert radius.tolist() == [10, 10]
+    assert travel == pytest.approx([math.pi / 2, -3 * math.pi / 2])
+
+    moves = next(read_moves(io.BytesIO(b"G2 X30 F600 R10\n")))
+    with pytest.raises(ToolpathException):
+        arcs(moves, moves.motion == 20)
+
+
+
+def test_offsets():
+    toolpath = Toolpath(
+        position=(-50, -50, -5), offsets={540: (-100, -100, -10)})
+    moves = toolpath.parse(
+        b"G0 X10 Y10\n"
+        b"G10 L2 P2 X-200 Y-200\n"
+        b"G55 X10\n"
+        b"G10 L20 P0 X0\n"
+        b"X1\n"
+        b"G92.1 G54 G53 Z-1\n"
+        b"G56 X0\n"
+        b"G91 Y1\n"
+        b"G90 G54 Z0\n"
+    )
+    assert moves.line.tolist() == [1, 3, 5, 6, 7, 8, 9]
+    assert moves.end[:4].tolist() == [
+        [-90, -90, -5], [-190, -90, -5], [-189, -90, -5], [-189, -90, -1]]
+    # The offset of G56 is not known.
+    assert np.isnan(moves.end[4:, 0]).all()
+    assert moves.end[4:, 1:].tolist() == [[-90, -1], [-89, -1], [-89, -10]]
+
+
+
+def test_bounds():
+    moves = next(read_moves(io.BytesIO(
+        b"G0 X5 Y0 Z1\n"
+        b"G1 Z-1 F100\n"
+        b"G2 X0 Y5 I-5\n"
+    )))
+    (lower, upper) = bounds(moves)
+    assert lower.tolist() == [-5, -5, -1]
+    assert upper.tolist() == [5, 5, 1]